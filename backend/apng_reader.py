@@ -0,0 +1,118 @@
+"""
+Chunk-level APNG reading.
+
+An APNG is a PNG with its animation in extra chunks: acTL holds the number of
+frames, every frame starts with an fcTL (size, offset, delay) and its
+compressed image data follows in IDAT (the default image) or fdAT chunks.
+Everything here works on the chunks alone, without decompressing pixels:
+
+  * apng_num_frames reads the header up to acTL (for scanning)
+  * read_apng_frames turns every frame into a standalone PNG by copying its
+    compressed data behind the file's header chunks
+
+Only the standard library is used, so scan and decode workers can import it
+cheaply.
+"""
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Header chunks every standalone frame needs a copy of (they all precede the image data)
+_SHARED_CHUNKS = {b"PLTE", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT", b"pHYs"}
+
+# png: the frame as a standalone PNG; offsets place it on the canvas
+ApngFrame = namedtuple("ApngFrame", "png width height x_offset y_offset delay_ms dispose_op blend_op")
+
+
+def apng_num_frames(path: str):
+    """num_frames from the acTL chunk, or None if the file isn't an APNG. Only the header is read."""
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type == b"acTL":
+                data = f.read(8)
+                return struct.unpack(">I", data[:4])[0] if len(data) == 8 else None
+            if chunk_type in (b"IDAT", b"IEND"):
+                return None   # acTL has to come before the image data
+            f.seek(length + 4, os.SEEK_CUR)   # data + CRC
+
+
+def iter_chunks(f):
+    """(type, data) of every chunk of a PNG file object positioned after the signature"""
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = f.read(length)
+        f.read(4)   # CRC
+        if len(data) < length:
+            return   # truncated file
+        yield chunk_type, data
+        if chunk_type == b"IEND":
+            return
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def _frame_png(ihdr: bytes, shared, width: int, height: int, data) -> bytes:
+    parts = [PNG_SIGNATURE, _chunk(b"IHDR", struct.pack(">II", width, height) + ihdr[8:])]
+    parts += [_chunk(chunk_type, body) for chunk_type, body in shared]
+    parts += [_chunk(b"IDAT", body) for body in data]
+    parts.append(_chunk(b"IEND", b""))
+    return b"".join(parts)
+
+
+def read_apng_frames(path: str):
+    """
+    The frames of an APNG as ApngFrame tuples. Each frame's PNG has the
+    file's header chunks, the frame's size and its IDAT / fdAT data copied
+    as-is. Raises ValueError for files that aren't PNGs.
+    """
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError(f"Not a PNG file: {path}")
+        chunks = list(iter_chunks(f))
+
+    ihdr = None
+    shared = []
+    frames = []
+    control = None   # fcTL fields of the frame being collected
+    data = []
+
+    def finish_frame():
+        if control is None or not data:
+            return
+        width, height, x_offset, y_offset, delay_num, delay_den, dispose_op, blend_op = control
+        delay_ms = int(1000 * delay_num / (delay_den or 100))
+        frames.append(ApngFrame(_frame_png(ihdr, shared, width, height, data), width, height,
+                                x_offset, y_offset, delay_ms, dispose_op, blend_op))
+
+    for chunk_type, body in chunks:
+        if chunk_type == b"IHDR":
+            ihdr = body
+        elif chunk_type in _SHARED_CHUNKS:
+            shared.append((chunk_type, body))
+        elif chunk_type == b"fcTL":
+            finish_frame()
+            control = struct.unpack(">IIIIHHBB", body[4:26])   # after the sequence number
+            data = []
+        elif chunk_type == b"IDAT" and control is not None:
+            # Without an fcTL before it the default image isn't part of the animation
+            data.append(body)
+        elif chunk_type == b"fdAT" and control is not None:
+            data.append(body[4:])   # drop the sequence number
+    finish_frame()
+    if ihdr is None:
+        raise ValueError(f"PNG without IHDR: {path}")
+    return frames
@@ -0,0 +1,308 @@
+"""
+Cache of encoded clip frames.
+
+Decoding a DICOM / APNG and re-encoding every frame is by far the most
+expensive thing the backend does, so rendered clips are cached in two tiers:
+
+  * a per-process memory tier (LRU, bounded by total frame bytes)
+  * an on-disk tier shared by all processes (LRU by file mtime, bounded by
+    directory size)
+
+Entries are keyed by the source file's path, size and mtime plus the render
+parameters, so an edited file or a different rendering never hits a stale
+entry.
+"""
+import os
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ----- Configuration -----
+FRAME_CACHE_MEMORY_MB = int(os.environ.get("ECHO_FRAME_CACHE_MEMORY_MB", "256"))
+FRAME_CACHE_DIR = os.environ.get("ECHO_FRAME_CACHE_DIR", "frame_cache")
+FRAME_CACHE_DISK_MB = int(os.environ.get("ECHO_FRAME_CACHE_DISK_MB", "2048"))
+# Extracted / transcoded videos (kept separate so they don't compete with frames)
+VIDEO_CACHE_DIR = os.environ.get("ECHO_VIDEO_CACHE_DIR", "video_cache")
+VIDEO_CACHE_DISK_MB = int(os.environ.get("ECHO_VIDEO_CACHE_DISK_MB", "4096"))
+
+_MAGIC = b"ECF1"
+
+
+def cache_key(filepath: str, params: dict):
+    """
+    Build a cache key for a rendered file.
+
+    The key covers the absolute path, size and mtime of the source file and the
+    render parameters. Returns None if the file cannot be stat'ed.
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    raw = json.dumps([os.path.abspath(filepath), st.st_size, st.st_mtime_ns, params], sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def serialize_clip(value: dict) -> bytes:
+    """
+    Pack a rendered clip ({"frames": [{"data": bytes, ...}], ...}) into one blob:
+    magic, header length, JSON header (frames without their data), frame data.
+    """
+    blobs = []
+    header = {k: v for k, v in value.items() if k != "frames"}
+    header["frames"] = []
+    for frame in value.get("frames", []):
+        meta = {k: v for k, v in frame.items() if k != "data"}
+        meta["size"] = len(frame["data"])
+        header["frames"].append(meta)
+        blobs.append(frame["data"])
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([_MAGIC, struct.pack(">I", len(header_bytes)), header_bytes] + blobs)
+
+
+def deserialize_clip(blob: bytes) -> dict:
+    if blob[:4] != _MAGIC:
+        raise ValueError("Not a frame cache entry")
+    (header_len,) = struct.unpack(">I", blob[4:8])
+    offset = 8 + header_len
+    value = json.loads(blob[8:offset].decode("utf-8"))
+    frames = []
+    for meta in value.get("frames", []):
+        size = meta.pop("size")
+        meta["data"] = blob[offset:offset + size]
+        offset += size
+        frames.append(meta)
+    value["frames"] = frames
+    return value
+
+
+def clip_size(value: dict) -> int:
+    """Approximate memory footprint of a rendered clip"""
+    return sum(len(frame["data"]) + 64 for frame in value.get("frames", [])) + 256
+
+
+class DiskLRU:
+    """
+    A directory of cache files bounded by total size.
+
+    Reads touch the file's mtime, and when the directory grows past max_bytes
+    the least recently used files are deleted until it is back under 90% of
+    the bound. Several processes may share the directory: writes are atomic
+    (temp file + rename) and eviction re-lists the directory instead of
+    trusting in-process bookkeeping.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._approx_size = None
+
+    def path_for(self, key: str, suffix: str = ".bin") -> str:
+        # Two-level fan-out keeps directories small on big archives
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get_path(self, key: str, suffix: str = ".bin"):
+        """Return the path of a cached file (marking it as recently used), or None"""
+        path = self.path_for(key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def read(self, key: str, suffix: str = ".bin"):
+        path = self.get_path(key, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write(self, key: str, data: bytes, suffix: str = ".bin") -> str:
+        path = self.path_for(key, suffix)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return self.commit(tmp_path, key, suffix)
+
+    def temp_path(self, key: str, suffix: str = ".bin") -> str:
+        """A temp path next to the final entry, for writers that need a filename (e.g. video encoders)"""
+        path = self.path_for(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        root, ext = os.path.splitext(path)
+        return f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}"
+
+    def commit(self, tmp_path: str, key: str, suffix: str = ".bin") -> str:
+        """Atomically move a finished temp file into place and enforce the size bound"""
+        path = self.path_for(key, suffix)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._approx_size is None:
+                self._approx_size = self._disk_usage()[0]
+            else:
+                self._approx_size += size
+            if self._approx_size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _disk_usage(self):
+        """Total size and (mtime, size, path) of the finished entries"""
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                # Finished entries are "<key><suffix>"; temp files still being
+                # written by this or another process have more dots in the name
+                if file.count(".") != 1:
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return total, entries
+
+    def _evict(self):
+        total, entries = self._disk_usage()
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._approx_size = total
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._disk_usage()[1]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._approx_size = 0
+
+
+class FrameCache:
+    """Two-tier (memory + disk) LRU cache of rendered clips with hit/miss counters"""
+
+    def __init__(self, memory_bytes: int, disk_dir: str = None, disk_bytes: int = 0):
+        self.memory_bytes = memory_bytes
+        self.disk = DiskLRU(disk_dir, disk_bytes) if disk_dir and disk_bytes > 0 else None
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+
+    def get(self, key: str, count: bool = True):
+        """Return a cached clip, or None on a miss. count=False leaves the lookup out of the hit/miss counters"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += count
+                return entry[0]
+
+        if self.disk is not None:
+            blob = self.disk.read(key)
+            if blob is not None:
+                try:
+                    value = deserialize_clip(blob)
+                except (ValueError, KeyError, struct.error, json.JSONDecodeError):
+                    value = None
+                if value is not None:
+                    with self._lock:
+                        self.disk_hits += count
+                    self._put_memory(key, value)
+                    return value
+
+        with self._lock:
+            self.misses += count
+        return None
+
+    def contains(self, key: str, memory_only: bool = False) -> bool:
+        """Check for an entry without counting a hit or miss"""
+        if key is None:
+            return False
+        with self._lock:
+            if key in self._memory:
+                return True
+        if memory_only or self.disk is None:
+            return False
+        return os.path.exists(self.disk.path_for(key))
+
+    def put(self, key: str, value: dict):
+        if key is None:
+            return
+        self._put_memory(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.write(key, serialize_clip(value))
+            except OSError as e:
+                print(f"Error writing frame cache entry {key}: {e}")
+
+    def _put_memory(self, key: str, value: dict):
+        size = clip_size(value)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= old[1]
+            self._memory[key] = (value, size)
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_size -= evicted_size
+                self.memory_evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memoryHits": self.memory_hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "hitRate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "memoryEntries": len(self._memory),
+                "memoryBytes": self._memory_size,
+                "memoryLimitBytes": self.memory_bytes,
+                "memoryEvictions": self.memory_evictions,
+                "diskEvictions": self.disk.evictions if self.disk is not None else 0,
+                "diskLimitBytes": self.disk.max_bytes if self.disk is not None else 0
+            }
+
+
+# Process-wide cache used by the API
+frame_cache = FrameCache(
+    FRAME_CACHE_MEMORY_MB * 1024 * 1024,
+    FRAME_CACHE_DIR,
+    FRAME_CACHE_DISK_MB * 1024 * 1024
+)
+
+video_cache = DiskLRU(VIDEO_CACHE_DIR, VIDEO_CACHE_DISK_MB * 1024 * 1024)
@@ -0,0 +1,958 @@
+"""
+Storage of per-user labels.
+
+Three backends are available, selected with ECHO_LABEL_BACKEND:
+
+  * "sqlite" (default) - one SQLite database (labels.sqlite3) holding every
+    user's labels, indexed on (username, patientName, dicomName, kind), so a
+    single label update is one indexed UPDATE in a transaction.
+  * "csv" - the original user_{username}_labels.csv files, rewritten on
+    every update.
+  * "journal" - the CSV files stay the primary artifact, but a label update
+    is one fsync'ed line appended to user_{username}_labels.csv.journal.
+    Reads merge the CSV with its journal, and a background compactor folds
+    journals back into the CSVs.
+
+A user's stored labels are a sparse overlay on the shared manifest
+(patient_dicom_labels.csv, written by the scan): only clips with a non-zero
+label are kept per user, and load_user_patients merges them onto the
+manifest at read time. New users start with an empty overlay.
+
+Parsed CSVs (user label files and the main manifest) are kept in memory by
+patient_index, keyed by patient name, and reloaded only when the file (or its
+journal) changes on disk.
+
+The endpoints only use the backend-neutral functions at the bottom of this
+module (load_user_patients, set_user_labels, ...). The per-user CSV files stay
+the interchange format: a user's existing CSV is imported into SQLite the
+first time the user is seen, and export_user_csv writes it back out.
+"""
+import os
+import io
+import csv
+import json
+import copy
+import time
+import atexit
+import inspect
+import sqlite3
+import functools
+import threading
+from concurrent.futures import Future
+from typing import List, Dict, Optional
+
+# ----- Configuration -----
+LABEL_BACKEND = os.environ.get("ECHO_LABEL_BACKEND", "sqlite")   # "sqlite", "csv" or "journal"
+LABEL_DB_PATH = os.environ.get("ECHO_LABEL_DB_PATH", "labels.sqlite3")
+# Shared manifest of every patient and clip (user label sets are overlays on it)
+MANIFEST_CSV_PATH = "patient_dicom_labels.csv"
+# Journal backend: compact every N seconds, or sooner once a journal has this many entries
+LABEL_JOURNAL_COMPACT_SECONDS = float(os.environ.get("ECHO_LABEL_JOURNAL_COMPACT_SECONDS", "30"))
+LABEL_JOURNAL_MAX_ENTRIES = int(os.environ.get("ECHO_LABEL_JOURNAL_MAX_ENTRIES", "1000"))
+# Single label updates from one user arriving within this window are written together
+LABEL_COALESCE_MS = float(os.environ.get("ECHO_LABEL_COALESCE_MS", "25"))
+
+LABEL_KINDS = ("dicom", "apng")
+
+CSV_HEADERS = [
+    "patientName", "originalName", "source", "dicomName", "label",
+    "filepath", "frameCount", "originalPatientName", "kind"
+]
+
+
+def get_user_csv_path(username: str):
+    """Get the CSV file path for a specific user"""
+    return f"user_{username}_labels.csv"
+
+
+# CSV files are read and rewritten from several worker threads; every access
+# to a given file goes through its lock
+_csv_locks: Dict[str, threading.RLock] = {}
+_csv_locks_guard = threading.Lock()
+
+
+def csv_lock(csv_path: str):
+    """Per-file lock for a CSV path"""
+    path = os.path.abspath(csv_path)
+    with _csv_locks_guard:
+        if path not in _csv_locks:
+            _csv_locks[path] = threading.RLock()
+        return _csv_locks[path]
+
+
+def locks_csv(fn):
+    """Run the decorated function while holding the lock of its csv_path argument"""
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        csv_path = signature.bind(*args, **kwargs).arguments["csv_path"]
+        with csv_lock(csv_path):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# ----- In-memory index of parsed CSVs -----
+class PatientIndex:
+    """
+    Parsed CSVs kept in memory, with a patient-name lookup per file.
+
+    An entry is valid while the CSV's and its journal's (size, mtime) are
+    unchanged, so files rewritten by another process (or by hand) are picked
+    up on the next read. Writes in this module go through the index
+    (save_to_csv, append_journal), so the common case never re-parses.
+    Callers get copies; the cached lists are never handed out.
+    """
+
+    def __init__(self):
+        self._entries = {}   # abspath -> (signature, patients, {patientName: patient})
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    @staticmethod
+    def _signature(csv_path: str):
+        signature = []
+        for path in (csv_path, journal_path(csv_path)):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_size, st.st_mtime_ns))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _entry(self, csv_path: str):
+        """The current entry for a CSV, (re)loading it if the files changed. Hold the CSV's lock."""
+        key = os.path.abspath(csv_path)
+        signature = self._signature(csv_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != signature:
+            patients = load_journaled_csv(csv_path)
+            entry = (signature, patients, {patient["patientName"]: patient for patient in patients})
+            with self._lock:
+                self._entries[key] = entry
+                self.loads += 1
+        return entry
+
+    def patients(self, csv_path: str) -> List[Dict]:
+        with csv_lock(csv_path):
+            return copy.deepcopy(self._entry(csv_path)[1])
+
+    def patient(self, csv_path: str, patient_name: str) -> Optional[Dict]:
+        with csv_lock(csv_path):
+            patient = self._entry(csv_path)[2].get(patient_name)
+            return copy.deepcopy(patient) if patient is not None else None
+
+    def put(self, csv_path: str, patients: List[Dict]):
+        """Record what was just written to a CSV (caller holds the CSV's lock)"""
+        entry = (self._signature(csv_path), patients, {patient["patientName"]: patient for patient in patients})
+        with self._lock:
+            self._entries[os.path.abspath(csv_path)] = entry
+
+    def current_signature(self, csv_path: str):
+        """Signature of the cached entry if it still matches the files, else None"""
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(csv_path))
+        if entry is not None and entry[0] == self._signature(csv_path):
+            return entry[0]
+        return None
+
+    def apply(self, csv_path: str, changes: List[Dict], signature_before):
+        """
+        Apply label changes that were just appended to the journal. Only done
+        if the entry was current before the write; otherwise it is dropped and
+        reloaded on the next read.
+        """
+        key = os.path.abspath(csv_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or signature_before is None or entry[0] != signature_before:
+                self._entries.pop(key, None)
+                return
+        apply_journal(entry[1], changes, entry[2])
+        with self._lock:
+            self._entries[key] = (self._signature(csv_path), entry[1], entry[2])
+
+    def touch(self, csv_path: str):
+        """The files changed but the cached contents are still right (e.g. after compaction)"""
+        key = os.path.abspath(csv_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (self._signature(csv_path), entry[1], entry[2])
+
+    def invalidate(self, csv_path: str):
+        with self._lock:
+            self._entries.pop(os.path.abspath(csv_path), None)
+
+
+patient_index = PatientIndex()
+
+
+def indexed_patients(csv_path: str) -> List[Dict]:
+    """All patients of a CSV (with its journal applied), from the in-memory index"""
+    return patient_index.patients(csv_path)
+
+
+def indexed_patient(csv_path: str, patient_name: str) -> Optional[Dict]:
+    """One patient of a CSV by name, from the in-memory index, or None"""
+    return patient_index.patient(csv_path, patient_name)
+
+
+def write_csv(patients_data: List[Dict], csvfile):
+    """Write patients data in the CSV format to an open text file"""
+    writer = csv.writer(csvfile)
+    writer.writerow(CSV_HEADERS)
+    for patient in patients_data:
+        # unified writer for both kinds
+        for key, kind in (("dicoms", "dicom"), ("apngs", "apng")):
+            items = patient.get(key, [])
+            if isinstance(items, dict):
+                items = list(items.values())
+            for item in items:
+                writer.writerow([
+                    patient["patientName"],
+                    patient.get("originalName", ""),
+                    item.get("source", patient.get("source", "")),
+                    item["dicomName"],
+                    item.get("label", 0),
+                    item.get("filepath", ""),
+                    item.get("frameCount", 0),
+                    item.get("originalPatientName", ""),
+                    kind
+                ])
+
+
+@locks_csv
+def save_to_csv(patients_data: List[Dict], csv_path: str):
+    """
+    Save patients data to CSV. Writes both dicoms and apngs.
+    Adds 'kind' column ('dicom' or 'apng'). Older readers without 'kind'
+    can default to 'dicom'.
+    """
+    dirname = os.path.dirname(csv_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    # Write to a temp file and rename it into place, so a crash mid-write
+    # leaves the previous file intact
+    tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='') as csvfile:
+        write_csv(patients_data, csvfile)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(tmp_path, csv_path)
+    # Write through to the index, in the shape load_from_csv would give back
+    saved = _patients_from_rows(dict(zip(_ROW_COLUMNS, row)) for row in _rows_from_patients(patients_data))
+    patient_index.put(csv_path, apply_journal(saved, read_journal(csv_path)))
+    print(f"Data saved to {csv_path}")
+
+
+@locks_csv
+def load_from_csv(csv_path: str):
+    if not os.path.exists(csv_path):
+        print(f"CSV file {csv_path} not found")
+        return []
+
+    patients = {}
+    with open(csv_path, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        headers = next(reader)
+
+        # Column indices (with fallbacks)
+        patient_name_idx = headers.index("patientName") if "patientName" in headers else 0
+        dicom_name_idx = headers.index("dicomName") if "dicomName" in headers else 1
+        label_idx = headers.index("label") if "label" in headers else 2
+        filepath_idx = headers.index("filepath") if "filepath" in headers else 3
+        frame_count_idx = headers.index("frameCount") if "frameCount" in headers else 4
+        source_idx = headers.index("source") if "source" in headers else -1
+        original_name_idx = headers.index("originalName") if "originalName" in headers else -1
+        original_patient_name_idx = headers.index("originalPatientName") if "originalPatientName" in headers else -1
+        kind_idx = headers.index("kind") if "kind" in headers else -1
+
+        for row in reader:
+            if len(row) <= max(patient_name_idx, dicom_name_idx, label_idx):
+                print(f"Skipping malformed row: {row}")
+                continue
+
+            patient_name = row[patient_name_idx]
+            dicom_name = row[dicom_name_idx]
+            label_str = row[label_idx]
+
+            filepath = row[filepath_idx] if 0 <= filepath_idx < len(row) else ""
+            try:
+                frame_count = int(row[frame_count_idx]) if 0 <= frame_count_idx < len(row) and row[frame_count_idx].isdigit() else 0
+            except:
+                frame_count = 0
+            source = row[source_idx] if 0 <= source_idx < len(row) else ""
+            original_name = row[original_name_idx] if 0 <= original_name_idx < len(row) else ""
+            original_patient_name = row[original_patient_name_idx] if 0 <= original_patient_name_idx < len(row) else ""
+            kind = (row[kind_idx].strip().lower() if 0 <= kind_idx < len(row) and row[kind_idx] else "dicom")
+
+            if patient_name not in patients:
+                patients[patient_name] = {
+                    "patientName": patient_name,
+                    "originalName": original_name,
+                    "source": source,
+                    "dicoms": [],
+                    "apngs": []
+                }
+
+            entry = {
+                "dicomName": dicom_name,
+                "label": int(label_str),
+                "filepath": filepath,
+                "frameCount": frame_count,
+                "source": source,
+                "originalPatientName": original_patient_name
+            }
+            if kind == "apng":
+                patients[patient_name]["apngs"].append(entry)
+            else:
+                patients[patient_name]["dicoms"].append(entry)
+
+    patient_list = list(patients.values())
+    print(f"Loaded {len(patient_list)} patients from CSV: {csv_path}")
+    return patient_list
+
+
+
+# ----- Journal backend -----
+def journal_path(csv_path: str) -> str:
+    return csv_path + ".journal"
+
+
+@locks_csv
+def append_journal(csv_path: str, changes: List[Dict]):
+    """Append label changes ({"patientName", "dicomName", "kind", "label"}) to the CSV's journal with one fsync"""
+    now = time.time()
+    line = "".join(json.dumps({
+        "patientName": change["patientName"],
+        "dicomName": change["dicomName"],
+        "kind": change.get("kind") or "dicom",
+        "label": int(change["label"]),
+        "time": now
+    }) + "\n" for change in changes)
+    signature_before = patient_index.current_signature(csv_path)
+    fd = os.open(journal_path(csv_path), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # Don't glue the entry onto a line torn by an earlier crash
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            line = "\n" + line
+        os.write(fd, line.encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    patient_index.apply(csv_path, changes, signature_before)
+
+
+@locks_csv
+def read_journal(csv_path: str) -> List[Dict]:
+    """Journal entries in order. A torn last line (crash mid-append) is skipped."""
+    entries = []
+    try:
+        with open(journal_path(csv_path), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping unreadable journal line in {journal_path(csv_path)}")
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def apply_journal(patients: List[Dict], entries: List[Dict], by_name: Optional[Dict] = None) -> List[Dict]:
+    """
+    Apply journal entries to a user's overlay in place. Clips are matched on
+    patient and clip name (preferring the same kind); unknown clips are added. A label of 0 removes the clip instead, so
+    the overlay stays sparse. by_name, if given, is the list's patient-name
+    lookup and is kept up to date.
+    """
+    if by_name is None:
+        by_name = {patient["patientName"]: patient for patient in patients}
+    for change in entries:
+        patient = by_name.get(change["patientName"])
+        if patient is None:
+            if not change["label"]:
+                continue
+            patient = {"patientName": change["patientName"], "originalName": "", "source": "",
+                       "dicoms": [], "apngs": []}
+            patients.append(patient)
+            by_name[change["patientName"]] = patient
+        kind = change.get("kind") or "dicom"
+        matches = [e for e in patient.get(f"{kind}s", []) if e["dicomName"] == change["dicomName"]]
+        if not matches:
+            matches = [e for key in ("dicoms", "apngs") for e in patient.get(key, [])
+                       if e["dicomName"] == change["dicomName"]]
+        if not change["label"]:
+            for key in ("dicoms", "apngs"):
+                patient[key] = [e for e in patient.get(key, []) if not any(e is match for match in matches)]
+            if not patient["dicoms"] and not patient["apngs"]:
+                patients.remove(patient)
+                del by_name[change["patientName"]]
+        elif matches:
+            for entry in matches:
+                entry["label"] = change["label"]
+        else:
+            patient.setdefault(f"{kind}s", []).append({
+                "dicomName": change["dicomName"],
+                "label": change["label"],
+                "filepath": "",
+                "frameCount": 0,
+                "source": "",
+                "originalPatientName": ""
+            })
+    return patients
+
+
+@locks_csv
+def load_journaled_csv(csv_path: str) -> List[Dict]:
+    """The CSV with its journal applied"""
+    return apply_journal(load_from_csv(csv_path), read_journal(csv_path))
+
+
+@locks_csv
+def compact_journal(csv_path: str) -> bool:
+    """
+    Fold the journal into the CSV. The CSV is replaced atomically before the
+    journal is removed; if we crash in between, replaying the journal on the
+    new CSV gives the same result, since entries set absolute labels.
+    """
+    entries = read_journal(csv_path)
+    if not entries:
+        return False
+    save_to_csv(apply_journal(load_from_csv(csv_path), entries), csv_path)
+    os.remove(journal_path(csv_path))
+    patient_index.touch(csv_path)
+    print(f"Compacted {len(entries)} journal entries into {csv_path}")
+    return True
+
+
+@locks_csv
+def drop_journal(csv_path: str):
+    if os.path.exists(journal_path(csv_path)):
+        os.remove(journal_path(csv_path))
+
+
+class JournalCompactor:
+    """Background thread folding label journals back into their CSVs"""
+
+    def __init__(self, interval: float, max_entries: int):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._pending = {}   # csv_path -> entries appended since last compaction
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def note_append(self, csv_path: str, count: int = 1):
+        with self._lock:
+            self._pending[csv_path] = self._pending.get(csv_path, 0) + count
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="label-journal", daemon=True)
+                self._thread.start()
+            if self._pending[csv_path] >= self.max_entries:
+                self._wake.set()
+
+    def flush(self):
+        """Compact every journal with pending entries"""
+        with self._lock:
+            paths = list(self._pending)
+            self._pending.clear()
+        for csv_path in paths:
+            try:
+                compact_journal(csv_path)
+            except Exception as e:
+                print(f"Error compacting journal of {csv_path}: {e}")
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+
+journal_compactor = JournalCompactor(LABEL_JOURNAL_COMPACT_SECONDS, LABEL_JOURNAL_MAX_ENTRIES)
+atexit.register(journal_compactor.flush)
+
+
+# ----- SQLite backend -----
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS labels (
+    username TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    patientName TEXT NOT NULL,
+    originalName TEXT NOT NULL DEFAULT '',
+    source TEXT NOT NULL DEFAULT '',
+    dicomName TEXT NOT NULL,
+    label INTEGER NOT NULL DEFAULT 0,
+    filepath TEXT NOT NULL DEFAULT '',
+    frameCount INTEGER NOT NULL DEFAULT 0,
+    originalPatientName TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL DEFAULT 'dicom'
+);
+CREATE UNIQUE INDEX IF NOT EXISTS labels_item ON labels (username, patientName, dicomName, kind);
+CREATE INDEX IF NOT EXISTS labels_position ON labels (username, position);
+"""
+
+_ROW_COLUMNS = ("patientName", "originalName", "source", "dicomName", "label",
+                "filepath", "frameCount", "originalPatientName", "kind")
+
+
+def _rows_from_patients(patients_data: List[Dict]):
+    """Flatten a patient list into rows in CSV order (same layout as save_to_csv)"""
+    for patient in patients_data:
+        for key, kind in (("dicoms", "dicom"), ("apngs", "apng")):
+            items = patient.get(key, [])
+            if isinstance(items, dict):
+                items = list(items.values())
+            for item in items:
+                yield (
+                    patient["patientName"],
+                    patient.get("originalName", ""),
+                    item.get("source", patient.get("source", "")),
+                    item["dicomName"],
+                    int(item.get("label", 0) or 0),
+                    item.get("filepath", ""),
+                    int(item.get("frameCount", 0) or 0),
+                    item.get("originalPatientName", ""),
+                    kind
+                )
+
+
+def _patients_from_rows(rows) -> List[Dict]:
+    """Group rows back into the patient list load_from_csv returns"""
+    patients = {}
+    for row in rows:
+        patient_name = row["patientName"]
+        if patient_name not in patients:
+            patients[patient_name] = {
+                "patientName": patient_name,
+                "originalName": row["originalName"],
+                "source": row["source"],
+                "dicoms": [],
+                "apngs": []
+            }
+        entry = {
+            "dicomName": row["dicomName"],
+            "label": row["label"],
+            "filepath": row["filepath"],
+            "frameCount": row["frameCount"],
+            "source": row["source"],
+            "originalPatientName": row["originalPatientName"]
+        }
+        patients[patient_name]["apngs" if row["kind"] == "apng" else "dicoms"].append(entry)
+    return list(patients.values())
+
+
+class SQLiteLabelStore:
+    """
+    All users' labels in one SQLite database.
+
+    Each thread gets its own connection. The database runs in WAL mode so
+    reads don't block behind a label write.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._import_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def has_user(self, username: str) -> bool:
+        row = self._connect().execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone()
+        return row is not None
+
+    def load(self, username: str) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT * FROM labels WHERE username = ? ORDER BY position", (username,)
+        ).fetchall()
+        return _patients_from_rows(rows)
+
+    def load_patient(self, username: str, patient_name: str) -> Optional[Dict]:
+        rows = self._connect().execute(
+            "SELECT * FROM labels WHERE username = ? AND patientName = ? ORDER BY position",
+            (username, patient_name)
+        ).fetchall()
+        patients = _patients_from_rows(rows)
+        return patients[0] if patients else None
+
+    def replace(self, username: str, patients_data: List[Dict]):
+        """Replace all of a user's rows in one transaction"""
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO users (username, created_at) VALUES (?, ?)", (username, time.time()))
+            conn.execute("DELETE FROM labels WHERE username = ?", (username,))
+            conn.executemany(
+                f"INSERT OR REPLACE INTO labels (username, position, {', '.join(_ROW_COLUMNS)}) "
+                f"VALUES (?, ?, {', '.join('?' * len(_ROW_COLUMNS))})",
+                ((username, position) + row for position, row in enumerate(_rows_from_patients(patients_data)))
+            )
+
+    def set_labels(self, username: str, changes: List[Dict]):
+        """
+        Set several labels in one transaction. Each matches on (patientName,
+        dicomName, kind) first, then on (patientName, dicomName) like the CSV
+        backend; a clip that isn't known yet is added as a new row. Label 0
+        deletes the row instead.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO users (username, created_at) VALUES (?, ?)", (username, time.time()))
+            for change in changes:
+                patient_name, dicom_name = change["patientName"], change["dicomName"]
+                label, kind = int(change["label"]), change.get("kind") or "dicom"
+                if not label:
+                    cursor = conn.execute(
+                        "DELETE FROM labels WHERE username = ? AND patientName = ? AND dicomName = ? AND kind = ?",
+                        (username, patient_name, dicom_name, kind)
+                    )
+                    if cursor.rowcount == 0:
+                        conn.execute("DELETE FROM labels WHERE username = ? AND patientName = ? AND dicomName = ?",
+                                     (username, patient_name, dicom_name))
+                    continue
+                cursor = conn.execute(
+                    "UPDATE labels SET label = ? WHERE username = ? AND patientName = ? AND dicomName = ? AND kind = ?",
+                    (label, username, patient_name, dicom_name, kind)
+                )
+                if cursor.rowcount == 0:
+                    cursor = conn.execute(
+                        "UPDATE labels SET label = ? WHERE username = ? AND patientName = ? AND dicomName = ?",
+                        (label, username, patient_name, dicom_name)
+                    )
+                if cursor.rowcount == 0:
+                    conn.execute(
+                        "INSERT INTO labels (username, position, patientName, dicomName, label, kind) "
+                        "VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM labels WHERE username = ?), ?, ?, ?, ?)",
+                        (username, username, patient_name, dicom_name, label, kind)
+                    )
+        return True
+
+    def delete(self, username: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM labels WHERE username = ?", (username,))
+            conn.execute("DELETE FROM users WHERE username = ?", (username,))
+
+    def delete_all(self):
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM labels")
+            conn.execute("DELETE FROM users")
+
+    def import_csv(self, username: str, csv_path: str):
+        """Load a user's labels from a CSV file and its journal (replacing what is stored)"""
+        self.replace(username, sparse_labels(load_journaled_csv(csv_path)))
+
+    def ensure_imported(self, username: str):
+        """First time a user is seen, pick up their existing CSV file if there is one"""
+        if self.has_user(username):
+            return
+        with self._import_lock:
+            if not self.has_user(username) and os.path.exists(get_user_csv_path(username)):
+                print(f"Importing {get_user_csv_path(username)} into {self.db_path}")
+                self.import_csv(username, get_user_csv_path(username))
+
+
+_sqlite_store = None
+_sqlite_store_lock = threading.Lock()
+
+
+def sqlite_store() -> SQLiteLabelStore:
+    global _sqlite_store
+    with _sqlite_store_lock:
+        if _sqlite_store is None:
+            _sqlite_store = SQLiteLabelStore(LABEL_DB_PATH)
+        return _sqlite_store
+
+
+# ----- Overlays -----
+def sparse_labels(patients_data: List[Dict]) -> List[Dict]:
+    """Only the labeled clips (label != 0) of a patient list; patients without any are dropped"""
+    sparse = []
+    for patient in patients_data:
+        kept = {}
+        for key in ("dicoms", "apngs"):
+            items = patient.get(key, [])
+            if isinstance(items, dict):
+                items = list(items.values())
+            kept[key] = [item for item in items if item.get("label", 0)]
+        if kept["dicoms"] or kept["apngs"]:
+            sparse.append(dict(patient, **kept))
+    return sparse
+
+
+def merge_labels(manifest: List[Dict], overlay: List[Dict]) -> List[Dict]:
+    """
+    A user's full label set: the manifest's patients and clips, all at label
+    0, with the overlay's labels applied (in place). Overlay clips are matched
+    by name, preferring the same kind (older label writes without a kind were
+    stored as dicoms). Overlay clips and patients the manifest doesn't have
+    (e.g. dropped by a later scan) are left out: they have no file to show.
+    """
+    by_name = {}
+    for patient in manifest:
+        by_name[patient["patientName"]] = patient
+        for key in ("dicoms", "apngs"):
+            for item in patient.get(key, []):
+                item["label"] = 0
+    for overlay_patient in overlay:
+        patient = by_name.get(overlay_patient["patientName"])
+        if patient is None:
+            continue
+        items = {key: {item["dicomName"]: item for item in patient.setdefault(key, [])}
+                 for key in ("dicoms", "apngs")}
+        for key, other in (("dicoms", "apngs"), ("apngs", "dicoms")):
+            for overlay_item in overlay_patient.get(key, []):
+                item = items[key].get(overlay_item["dicomName"]) or items[other].get(overlay_item["dicomName"])
+                if item is not None:
+                    item["label"] = overlay_item.get("label", 0)
+    return manifest
+
+
+# ----- Backend-neutral API -----
+def user_labels_exist(username: str) -> bool:
+    """Does this user have a label set yet?"""
+    if LABEL_BACKEND == "sqlite":
+        store = sqlite_store()
+        store.ensure_imported(username)
+        return store.has_user(username)
+    user_csv_path = get_user_csv_path(username)
+    if LABEL_BACKEND == "journal" and os.path.exists(journal_path(user_csv_path)):
+        return True
+    return os.path.exists(user_csv_path)
+
+
+def create_user_labels(username: str):
+    """Start an empty label set for a new user (nothing is copied from the manifest)"""
+    save_user_patients(username, [])
+
+
+def load_user_overlay(username: str) -> List[Dict]:
+    """The labels stored for a user, without the manifest"""
+    if LABEL_BACKEND == "sqlite":
+        store = sqlite_store()
+        store.ensure_imported(username)
+        return store.load(username)
+    return indexed_patients(get_user_csv_path(username))
+
+
+def load_user_patients(username: str) -> List[Dict]:
+    """All of a user's patients with their labels (same shape as load_from_csv)"""
+    return merge_labels(indexed_patients(MANIFEST_CSV_PATH), load_user_overlay(username))
+
+
+def load_user_patient(username: str, patient_name: str) -> Optional[Dict]:
+    """One of a user's patients, or None"""
+    if LABEL_BACKEND == "sqlite":
+        store = sqlite_store()
+        store.ensure_imported(username)
+        overlay = store.load_patient(username, patient_name)
+    else:
+        overlay = indexed_patient(get_user_csv_path(username), patient_name)
+    manifest = indexed_patient(MANIFEST_CSV_PATH, patient_name)
+    merged = merge_labels([manifest] if manifest else [], [overlay] if overlay else [])
+    return merged[0] if merged else None
+
+
+def save_user_patients(username: str, patients_data: List[Dict]):
+    """Replace a user's whole label set (only the labeled clips are stored)"""
+    patients_data = sparse_labels(patients_data)
+    if LABEL_BACKEND == "sqlite":
+        sqlite_store().replace(username, patients_data)
+        return
+    user_csv_path = get_user_csv_path(username)
+    with csv_lock(user_csv_path):
+        # The new label set replaces whatever the journal held
+        drop_journal(user_csv_path)
+        save_to_csv(patients_data, user_csv_path)
+
+
+def manifest_kind(patient_name: str, dicom_name: str, kind: str = None) -> Optional[str]:
+    """
+    The kind of a clip in the manifest: the given kind if the patient has a
+    clip of that kind and name, else whichever kind has one. None if the
+    manifest doesn't have the clip.
+    """
+    patient = indexed_patient(MANIFEST_CSV_PATH, patient_name)
+    if patient is None:
+        return None
+    for candidate in sorted(LABEL_KINDS, key=lambda k: k != kind):
+        if any(item["dicomName"] == dicom_name for item in patient.get(f"{candidate}s", [])):
+            return candidate
+    return None
+
+
+def validate_label_update(change: Dict) -> Dict:
+    """
+    The label update in the form it is stored ({"patientName", "dicomName",
+    "label", "kind"}), with the kind taken from the manifest (clients don't
+    have to send it). Raises ValueError if it can't be applied.
+    """
+    if not change.get("patientName") or not change.get("dicomName"):
+        raise ValueError("patientName and dicomName are required")
+    if change.get("kind") and change["kind"] not in LABEL_KINDS:
+        raise ValueError(f"Unknown kind '{change['kind']}'")
+    try:
+        label = int(change["label"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("label must be an integer")
+    kind = manifest_kind(change["patientName"], change["dicomName"], change.get("kind"))
+    if kind is None:
+        raise ValueError(f"Unknown clip {change['patientName']}/{change['dicomName']}")
+    return {"patientName": change["patientName"], "dicomName": change["dicomName"], "label": label, "kind": kind}
+
+
+def set_user_labels(username: str, changes: List[Dict]) -> List[Dict]:
+    """
+    Apply many label updates ({"patientName", "dicomName", "label", "kind"?})
+    with a single write; label 0 removes the clip from the user's overlay.
+    Returns one {"success": bool, "error"?: str} per update, in order;
+    invalid updates (including clips the manifest doesn't have) are skipped,
+    the rest are applied together (so they fail together if the write fails).
+    """
+    results = []
+    valid = []
+    for change in changes:
+        try:
+            valid.append(validate_label_update(change))
+            results.append({"success": True})
+        except ValueError as e:
+            results.append({"success": False, "error": str(e)})
+    if not valid:
+        return results
+
+    try:
+        if LABEL_BACKEND == "sqlite":
+            store = sqlite_store()
+            store.ensure_imported(username)
+            store.set_labels(username, valid)
+        elif LABEL_BACKEND == "journal":
+            user_csv_path = get_user_csv_path(username)
+            append_journal(user_csv_path, valid)
+            journal_compactor.note_append(user_csv_path, len(valid))
+        else:
+            user_csv_path = get_user_csv_path(username)
+            with csv_lock(user_csv_path):
+                save_to_csv(apply_journal(indexed_patients(user_csv_path), valid), user_csv_path)
+    except Exception as e:
+        print(f"Error saving {len(valid)} labels for {username}: {e}")
+        for result in results:
+            if result["success"]:
+                result.update(success=False, error=str(e))
+    return results
+
+
+class LabelWriteCoalescer:
+    """
+    Coalesces single label updates. The first update from a user opens a
+    short window; everything that user sends during it is written with one
+    set_user_labels call. Each submit returns a Future resolving to that
+    update's result. Flushes of the same user never overlap, so a later
+    burst can't be written before an earlier one.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window = window_seconds
+        self._pending = {}       # username -> [(change, future)]
+        self._flush_locks = {}   # username -> Lock
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.updates = 0
+
+    def submit(self, username: str, change: Dict) -> Future:
+        future = Future()
+        with self._lock:
+            batch = self._pending.setdefault(username, [])
+            batch.append((change, future))
+            if len(batch) == 1:
+                timer = threading.Timer(self.window, self.flush, args=(username,))
+                timer.daemon = True
+                timer.start()
+        return future
+
+    def flush(self, username: str):
+        with self._lock:
+            flush_lock = self._flush_locks.setdefault(username, threading.Lock())
+        with flush_lock:
+            with self._lock:
+                batch = self._pending.pop(username, [])
+            if not batch:
+                return
+            try:
+                results = set_user_labels(username, [change for change, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            with self._lock:
+                self.batches += 1
+                self.updates += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def flush_all(self):
+        with self._lock:
+            usernames = list(self._pending)
+        for username in usernames:
+            self.flush(username)
+
+
+label_writer = LabelWriteCoalescer(LABEL_COALESCE_MS / 1000.0)
+atexit.register(label_writer.flush_all)
+
+
+def delete_user_labels(username: str) -> bool:
+    """Delete a user's labels. Returns False if there was nothing to delete."""
+    existed = user_labels_exist(username)
+    if LABEL_BACKEND == "sqlite":
+        sqlite_store().delete(username)
+    # Remove the CSV (and journal) too, or it would be imported again on next access
+    user_csv_path = get_user_csv_path(username)
+    with csv_lock(user_csv_path):
+        if os.path.exists(user_csv_path):
+            os.remove(user_csv_path)
+        drop_journal(user_csv_path)
+    return existed
+
+
+def delete_all_user_labels():
+    """Delete every user's labels (CSV files, journals and database rows)"""
+    if LABEL_BACKEND == "sqlite":
+        sqlite_store().delete_all()
+    for file in os.listdir():
+        if file.startswith("user_") and file.endswith(("_labels.csv", "_labels.csv.journal")):
+            os.remove(file)
+            print(f"Deleted user CSV file: {file}")
+
+
+def export_user_csv(username: str) -> str:
+    """The user's full label set (manifest merged with their labels) as CSV text"""
+    buffer = io.StringIO()
+    write_csv(load_user_patients(username), buffer)
+    return buffer.getvalue()
+
+
+def import_user_csv(username: str):
+    """Replace the user's stored labels with the contents of user_{username}_labels.csv"""
+    if LABEL_BACKEND == "sqlite":
+        sqlite_store().import_csv(username, get_user_csv_path(username))
+    elif LABEL_BACKEND == "journal":
+        drop_journal(get_user_csv_path(username))
@@ -1,19 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, Response, FileResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Dict
-import os, re, csv, io, base64, copy
+import os, re, csv
 import json
 import random
-import pydicom
-import numpy as np
-from PIL import Image
-from pydicom.encaps import generate_pixel_data_frame
-import tempfile
-import cv2
-import base64
-from apng import APNG
+import time
+import uuid
+import asyncio
+import threading
+import struct
+from collections import OrderedDict
+from urllib.parse import urlencode
+from media import (render_clip, render_params, render_thumbnail, thumbnail_params, render_frame_range,
+                   frame_range_params, frames_to_images, open_dicom, is_video_dicom, video_bitstream, transcode_clip,
+                   VIDEO_CONTAINERS, VIDEO_PASSTHROUGH_PARAMS, RENDER_VERSION, ENCODING_PROFILES, THUMBNAIL_SIZE,
+                   render_options)
+from frame_cache import frame_cache, video_cache, cache_key, clip_size
+from workers import offload, run_blocking, decode_pool, reset_decode_pool
+from concurrent.futures.process import BrokenProcessPool
+from label_store import (MANIFEST_CSV_PATH, save_to_csv, get_user_csv_path, user_labels_exist, load_user_patients,
+                         load_user_patient, save_user_patients, create_user_labels, delete_user_labels,
+                         delete_all_user_labels, export_user_csv, import_user_csv, set_user_labels,
+                         validate_label_update, indexed_patients, label_writer)
+from scanner import scan_sources, load_scan_index, save_scan_index, SCAN_INDEX_PATH, ScanProgress, ScanCancelled
 
 app = FastAPI()
 
@@ -24,6 +37,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Frame-Count", "X-Clip-ROI", "ETag"],
 )
 
 # ----- API Models -----
@@ -39,6 +53,7 @@ class ScanDirectoryRequest(BaseModel):
     vave_directory_path: str = ""
     butterfly_2_directory_path: str = ""
     username: str
+    full_rescan: bool = False   # ignore the scan index and re-probe every file
 
 from typing import Optional
 
@@ -47,21 +62,31 @@ class UpdateRequest(BaseModel):
     dicomName: str
     label: int
     username: str
-    kind: Optional[str] = "dicom"   # "dicom" or "apng"
+    kind: Optional[str] = None   # "dicom" or "apng"; taken from the manifest if not given
+
+class LabelUpdate(BaseModel):
+    patientName: str
+    dicomName: str
+    label: int
+    kind: Optional[str] = None
+
+class BatchUpdateRequest(BaseModel):
+    username: str
+    updates: List[LabelUpdate]
 
 class PatientDicomsRequest(BaseModel):
     patientName: str
     username: str
+    transport: Optional[str] = "datauri"   # "datauri" (inline base64) or "url" (per-frame image URLs)
+    profile: Optional[str] = None          # encoding profile, see media.ENCODING_PROFILES
+    preview: bool = False                  # downscaled frames (see media.render_options)
+    crop: bool = False                     # crop frames to the ultrasound sector
 
 # ----- Helper Functions -----
-MAIN_CSV_FILE_PATH = "patient_dicom_labels.csv"
+MAIN_CSV_FILE_PATH = MANIFEST_CSV_PATH
 ACCOUNTS_CSV_PATH = "user_accounts.csv"
 PATIENT_MAPPING_FILE = "patient_mapping.json"
 
-def get_user_csv_path(username: str):
-    """Get the CSV file path for a specific user"""
-    return f"user_{username}_labels.csv"
-
 def load_accounts():
     """Load all user accounts from CSV"""
     if not os.path.exists(ACCOUNTS_CSV_PATH):
@@ -102,29 +127,6 @@ def save_account(username: str):
     
     return True
 
-def convert_frame_to_base64(frame):
-    """Convert a frame (numpy array) to base64 encoded image string"""
-    # Ensure frame is in the right format for OpenCV
-    if isinstance(frame, np.ndarray):
-        # Handle different color formats
-        if len(frame.shape) == 2:  # Grayscale
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
-        elif frame.shape[2] == 3:  # Already RGB/BGR
-            if frame.dtype != np.uint8:
-                # Normalize and convert to uint8 if not already
-                frame = ((frame - frame.min()) / (frame.max() - frame.min()) * 255).astype(np.uint8)
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        else:
-            # Handle other formats as needed
-            frame_rgb = frame
-        
-        # Encode as JPEG
-        _, buffer = cv2.imencode('.jpg', frame_rgb)
-        image_data = base64.b64encode(buffer).decode('utf-8')
-        return f"data:image/jpeg;base64,{image_data}"
-    else:
-        raise ValueError("Frame is not a numpy array")
-
 def extract_patient_number(name: str) -> int:
     match = re.search(r'\d+', name)
     return int(match.group()) if match else float('inf')
@@ -140,24 +142,29 @@ def get_or_create_patient_mapping(patients_by_source):
     Returns:
         Dictionary mapping source keys to new sequential patient IDs
     """
+    mapping = {}
     if os.path.exists(PATIENT_MAPPING_FILE):
         # Load existing mapping if it exists
         try:
             with open(PATIENT_MAPPING_FILE, 'r') as f:
-                return json.load(f)
+                mapping = json.load(f)
         except json.JSONDecodeError:
             print(f"Error decoding {PATIENT_MAPPING_FILE}, creating new mapping")
     
-    # Create a new mapping with randomized order
-    unique_patients = list(patients_by_source.keys())
+    # Patients not mapped yet (e.g. from a source root scanned for the first
+    # time) get the next numbers, in randomized order
+    unique_patients = [key for key in patients_by_source if key not in mapping]
+    if not unique_patients and mapping:
+        return mapping
     # Shuffle the list to randomize order
     random.shuffle(unique_patients)
     
     # Create sequential mapping (Patient 1, Patient 2, etc.)
-    mapping = {}
+    numbers = [int(match.group()) for match in (re.search(r'\d+', name) for name in mapping.values()) if match]
+    first = max(numbers, default=0) + 1
     for i, patient_key in enumerate(unique_patients):
         # Use 1-indexed patient numbers for better UX
-        new_patient_id = f"Patient {i+1}"
+        new_patient_id = f"Patient {first + i}"
         mapping[patient_key] = new_patient_id
     
     # Save the mapping for future use
@@ -166,185 +173,30 @@ def get_or_create_patient_mapping(patients_by_source):
     
     return mapping
 
-def save_to_csv(patients_data: List[Dict], csv_path: str):
+def build_label_lookup(user_patients: List[Dict]):
     """
-    Save patients data to CSV. Writes both dicoms and apngs.
-    Adds 'kind' column ('dicom' or 'apng'). Older readers without 'kind'
-    can default to 'dicom'.
-    """
-    headers = [
-        "patientName", "originalName", "source", "dicomName", "label",
-        "filepath", "frameCount", "originalPatientName", "kind"
-    ]
-    dirname = os.path.dirname(csv_path)
-    if dirname:
-        os.makedirs(dirname, exist_ok=True)
-
-    with open(csv_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)
-        for patient in patients_data:
-            # unified writer for both kinds
-            for key, kind in (("dicoms", "dicom"), ("apngs", "apng")):
-                items = patient.get(key, [])
-                if isinstance(items, dict):
-                    items = list(items.values())
-                for item in items:
-                    writer.writerow([
-                        patient["patientName"],
-                        patient.get("originalName", ""),
-                        item.get("source", patient.get("source", "")),
-                        item["dicomName"],
-                        item.get("label", 0),
-                        item.get("filepath", ""),
-                        item.get("frameCount", 0),
-                        item.get("originalPatientName", ""),
-                        kind
-                    ])
-    print(f"Data saved to {csv_path}")
-
-def load_from_csv(csv_path: str):
-    if not os.path.exists(csv_path):
-        print(f"CSV file {csv_path} not found")
-        return []
-
-    patients = {}
-    with open(csv_path, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-
-        # Column indices (with fallbacks)
-        patient_name_idx = headers.index("patientName") if "patientName" in headers else 0
-        dicom_name_idx = headers.index("dicomName") if "dicomName" in headers else 1
-        label_idx = headers.index("label") if "label" in headers else 2
-        filepath_idx = headers.index("filepath") if "filepath" in headers else 3
-        frame_count_idx = headers.index("frameCount") if "frameCount" in headers else 4
-        source_idx = headers.index("source") if "source" in headers else -1
-        original_name_idx = headers.index("originalName") if "originalName" in headers else -1
-        original_patient_name_idx = headers.index("originalPatientName") if "originalPatientName" in headers else -1
-        kind_idx = headers.index("kind") if "kind" in headers else -1
-
-        for row in reader:
-            if len(row) <= max(patient_name_idx, dicom_name_idx, label_idx):
-                print(f"Skipping malformed row: {row}")
-                continue
-
-            patient_name = row[patient_name_idx]
-            dicom_name = row[dicom_name_idx]
-            label_str = row[label_idx]
-
-            filepath = row[filepath_idx] if 0 <= filepath_idx < len(row) else ""
-            try:
-                frame_count = int(row[frame_count_idx]) if 0 <= frame_count_idx < len(row) and row[frame_count_idx].isdigit() else 0
-            except:
-                frame_count = 0
-            source = row[source_idx] if 0 <= source_idx < len(row) else ""
-            original_name = row[original_name_idx] if 0 <= original_name_idx < len(row) else ""
-            original_patient_name = row[original_patient_name_idx] if 0 <= original_patient_name_idx < len(row) else ""
-            kind = (row[kind_idx].strip().lower() if 0 <= kind_idx < len(row) and row[kind_idx] else "dicom")
-
-            if patient_name not in patients:
-                patients[patient_name] = {
-                    "patientName": patient_name,
-                    "originalName": original_name,
-                    "source": source,
-                    "dicoms": [],
-                    "apngs": []
-                }
-
-            entry = {
-                "dicomName": dicom_name,
-                "label": int(label_str),
-                "filepath": filepath,
-                "frameCount": frame_count,
-                "source": source,
-                "originalPatientName": original_patient_name
-            }
-            if kind == "apng":
-                patients[patient_name]["apngs"].append(entry)
-            else:
-                patients[patient_name]["dicoms"].append(entry)
-
-    patient_list = list(patients.values())
-    print(f"Loaded {len(patient_list)} patients from CSV: {csv_path}")
-    return patient_list
-
-def update_csv_with_label(patient_name: str, dicom_name: str, label: int, csv_path: str):
-    """Update a specific CSV with the given label"""
-    if not os.path.exists(csv_path):
-        patients_data = [{
-            "patientName": patient_name,
-            "originalName": "",
-            "source": "",
-            "dicoms": [{
-                "dicomName": dicom_name,
-                "label": label,
-                "filepath": "",
-                "frameCount": 0,
-                "originalPatientName": ""
-            }]
-        }]
-        save_to_csv(patients_data, csv_path)
-        return True
-    
-    rows = []
-    found = False
-    with open(csv_path, 'r', newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        headers = next(reader)
-        rows.append(headers)
-        
-        # Determine column indices
-        patient_name_idx = headers.index("patientName") if "patientName" in headers else 0
-        dicom_name_idx = headers.index("dicomName") if "dicomName" in headers else 1
-        label_idx = headers.index("label") if "label" in headers else 2
-        
-        for row in reader:
-            if len(row) <= max(patient_name_idx, dicom_name_idx, label_idx):
-                rows.append(row)
-                continue
-                
-            if row[patient_name_idx] == patient_name and row[dicom_name_idx] == dicom_name:
-                row[label_idx] = str(label)
-                found = True
-                
-            rows.append(row)
-    
-    if not found:
-        # If adding a new row, include empty fields for new columns
-        new_row = [""] * len(headers)
-        new_row[patient_name_idx] = patient_name
-        new_row[dicom_name_idx] = dicom_name
-        new_row[label_idx] = str(label)
-        rows.append(new_row)
-    
-    with open(csv_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        for row in rows:
-            writer.writerow(row)
-    
-    print(f"Updated CSV {csv_path} for {patient_name}/{dicom_name} with label {label}")
-    return True
+    Build a lookup of existing labels from a user's patient list.
 
-@app.post("/scan-directory")
-async def scan_directory(request: ScanDirectoryRequest):
-    """Scan directories for DICOM files and update user's CSV"""
-    # Get username from request
-    username = request.username
-    if not username:
+    Returns {"dicoms": {...}, "apngs": {...}} where each dict maps
+    (source, originalPatientName, dicomName) -> label. When the same key appears
+    more than once, the last entry wins.
+    """
+    lookup = {"dicoms": {}, "apngs": {}}
+    for patient in user_patients:
+        for key in ("dicoms", "apngs"):
+            for item in patient.get(key, []):
+                lookup[key][(item.get("source"), item.get("originalPatientName"), item["dicomName"])] = item.get("label", 0)
+    return lookup
+
+def validate_scan_request(request: ScanDirectoryRequest):
+    """Check the username and directory paths of a scan request"""
+    if not request.username:
         raise HTTPException(status_code=400, detail="Username is required")
     
-    # Get path for user's CSV
-    user_csv_path = get_user_csv_path(username)
-    
     butterfly_path = request.butterfly_directory_path
     vave_path = request.vave_directory_path
     butterfly_path_2 = request.butterfly_2_directory_path 
     
-    print(f"Scanning Butterfly directory: {butterfly_path}")
-    print(f"Scanning Vave directory: {vave_path}")
-    print(f"Scanning Butterfly 2 directory: {butterfly_path_2}")
-    
     # Ensure at least one path is provided
     if not butterfly_path and not vave_path and not butterfly_path_2:
         raise HTTPException(status_code=400, detail="At least one directory path must be provided")
@@ -355,149 +207,46 @@ async def scan_directory(request: ScanDirectoryRequest):
             raise HTTPException(status_code=404, detail=f"{source.capitalize()} directory not found: {path}")
         if path and not os.path.isdir(path):
             raise HTTPException(status_code=400, detail=f"Not a directory: {path}")
+
+# Only one scan writes the main CSV / scan index at a time
+_scan_lock = threading.Lock()
+
+def run_scan(request: ScanDirectoryRequest, progress: ScanProgress = None):
+    """
+    Scan directories for DICOM files and update the main and user's CSV.
+    Blocking; call from a worker thread. Raises ScanCancelled if the
+    progress object is cancelled before the CSVs are written.
+    """
+    progress = progress or ScanProgress()
+    username = request.username
     
-    # Load existing CSV data (only user-specific for labels)
-    user_patients = load_from_csv(user_csv_path) if os.path.exists(user_csv_path) else []
+    butterfly_path = request.butterfly_directory_path
+    vave_path = request.vave_directory_path
+    butterfly_path_2 = request.butterfly_2_directory_path 
     
-    # Create dictionaries for faster lookup
-    user_patient_dict = {}
-    for patient in user_patients:
-        user_patient_dict[patient["patientName"]] = {
-            "patientName": patient["patientName"],
-            "dicoms": {},
-            "apngs": {}
-        }
-        for dicom in patient.get("dicoms", []):
-            user_patient_dict[patient["patientName"]]["dicoms"][dicom["dicomName"]] = dicom
-        for apng in patient.get("apngs", []):
-            user_patient_dict[patient["patientName"]]["apngs"][apng["dicomName"]] = apng
+    print(f"Scanning Butterfly directory: {butterfly_path}")
+    print(f"Scanning Vave directory: {vave_path}")
+    print(f"Scanning Butterfly 2 directory: {butterfly_path_2}")
     
-    # Process both directories and collect patients by source
-    patients_by_source = {}
-
-    # Helper function to create apng
-    def is_apng_file(path: str) -> bool:
-        """
-        Fast APNG check: PNG signature + presence of 'acTL' chunk.
-        Falls back to APNG.open() if needed.
-        """
-        try:
-            with open(path, "rb") as f:
-                sig = f.read(8)
-                if sig != b"\x89PNG\r\n\x1a\n":
-                    return False
-                while True:
-                    len_bytes = f.read(4)
-                    if len(len_bytes) < 4:
-                        break
-                    length = int.from_bytes(len_bytes, "big", signed=False)
-                    ctype = f.read(4)
-                    if len(ctype) < 4:
-                        break
-                    if ctype == b"acTL":
-                        return True
-                    # skip data + crc
-                    f.seek(length + 4, os.SEEK_CUR)
-            return False
-        except Exception:
-            # Last resort: try parsing
-            try:
-                APNG.open(path)
-                return True
-            except Exception:
-                return False
-
-    def apng_frame_count(path: str) -> int:
-        try:
-            ap = APNG.open(path)
-            return max(1, len(ap.frames))
-        except Exception:
-            return 1
-    
-    # Helper function to process a directory
-    def process_directory(directory_path, source):
-        if not directory_path:
-            return
-            
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                rel_path = os.path.relpath(root, directory_path)
-                if rel_path == ".":
-                    continue
-                parts = rel_path.split(os.sep)
-                if not parts:
-                    continue
-                
-                # The original patient name from the directory
-                original_patient_name = parts[0]
-                filepath = os.path.join(root, file)
-                dicomName = file
-                ext = os.path.splitext(file)[1].lower()
-
-                # Create a unique key combining source and original name
-                patient_key = f"{source}:{original_patient_name}"
-
-                # Ensure structure exists (now with BOTH keys)
-                if patient_key not in patients_by_source:
-                    patients_by_source[patient_key] = {
-                        "originalName": original_patient_name,
-                        "source": source,
-                        "dicoms": {},   # unchanged
-                        "apngs": {}     # NEW
-                    }
-
-                # Only look at DICOMs or APNGs
-                # 1) APNG path (accept .apng or .png that truly has acTL)
-                if ext in (".apng", ".png"):
-                    try:
-                        if is_apng_file(filepath):
-                            frame_count = apng_frame_count(filepath)
-                            print(f"Found APNG: {original_patient_name}/{dicomName} (frames={frame_count}, source={source})")
-                            patients_by_source[patient_key]["apngs"][dicomName] = {
-                                "dicomName": dicomName,           # keep same field naming for now
-                                "label": 0,
-                                "filepath": filepath,
-                                "frameCount": frame_count,
-                                "source": source,
-                                "originalPatientName": original_patient_name
-                            }
-                            continue
-                        else:
-                            # It's a plain PNG, and per your request we only include APNGs (skip)
-                            continue
-                    except Exception as e:
-                        print(f"Error checking APNG {filepath}: {e}")
-                        continue
-                else:
-                # 2) DICOM path (many DICOMs have no extension; try read unless definitely APNG)
-                    try:
-                        ds = pydicom.dcmread(filepath, stop_before_pixels=True)
-                        if not hasattr(ds, 'SOPClassUID'):
-                            # Not a valid DICOM; skip
-                            continue
-                        frame_count = int(ds.NumberOfFrames) if hasattr(ds, 'NumberOfFrames') else 1
-                        print(f"Found DICOM: {original_patient_name}/{dicomName} (frames={frame_count}, source={source})")
-                    except Exception as e:
-                        # Not APNG, not DICOM -> skip
-                        continue
-                
-                # Store DICOM info
-                patients_by_source[patient_key]["dicoms"][dicomName] = {
-                    "dicomName": dicomName,
-                    "label": 0,
-                    "filepath": filepath,
-                    "frameCount": frame_count,
-                    "source": source,
-                    "originalPatientName": original_patient_name
-                }
-
-    # Process both directories
-    if butterfly_path:
-        process_directory(butterfly_path, "butterfly")
-    if vave_path:
-        process_directory(vave_path, "vave")
-    if butterfly_path_2:
-        process_directory(butterfly_path_2, "butterfly_2")
+    # Load the user's existing labels
+    user_patients = load_user_patients(username) if user_labels_exist(username) else []
+    
+    # Index existing labels once so carrying them forward is a dict lookup per file
+    label_lookup = build_label_lookup(user_patients)
+    
+    # Walk all source roots in parallel and collect patients by source.
+    # Unchanged files are taken from the scan index instead of being re-read.
+    roots = [(butterfly_path, "butterfly"), (vave_path, "vave"), (butterfly_path_2, "butterfly_2")]
+    scanned_sources = {source for path, source in roots if path}
+    scan_index = load_scan_index()
+    patients_by_source = scan_sources(
+        roots,
+        index=scan_index,
+        reprobe=request.full_rescan,
+        progress=progress
+    )
+    progress.check()
+    save_scan_index(scan_index)
     
     # Get or create the mapping from source patients to sequential IDs
     patient_mapping = get_or_create_patient_mapping(patients_by_source)
@@ -521,38 +270,15 @@ async def scan_directory(request: ScanDirectoryRequest):
                     "apngs": {}
                 }
             
-            # Add all DICOMs from this source patient
+            # Add all DICOMs from this source patient, keeping any label the
+            # user already gave it (matched on source + original patient + DICOM name)
             for dicom_name, dicom_data in patient_data["dicoms"].items():
-                # Check if this DICOM already has a label in the user's CSV
-                label = 0
-                original_name = dicom_data["originalPatientName"]
-                
-                # Complex lookup: try to find this DICOM in the user's CSV
-                # We need to match both the original patient name and the DICOM name
-                for user_patient_name, user_patient in user_patient_dict.items():
-                    for user_dicom_name, user_dicom in user_patient["dicoms"].items():
-                        if (user_dicom.get("originalPatientName") == original_name and 
-                            user_dicom_name == dicom_name and
-                            user_dicom.get("source") == source):
-                            label = user_dicom.get("label", 0)
-                            print(f"Found existing user label for {original_name}/{dicom_name} (source: {source}): {label}")
-                            break
-                
-                # Update the label and add to the new patients dictionary
-                dicom_data["label"] = label
+                dicom_data["label"] = label_lookup["dicoms"].get(
+                    (source, dicom_data["originalPatientName"], dicom_name), 0)
                 patients[new_patient_name]["dicoms"][dicom_name] = dicom_data
             for apng_name, apng_data in patient_data.get("apngs", {}).items():
-                label = 0
-                original_name = apng_data["originalPatientName"]
-                # If you later add APNG labels, this will pick them up
-                for _, user_patient in user_patient_dict.items():
-                    for user_apng_name, user_apng in user_patient.get("apngs", {}).items():
-                        if (user_apng.get("originalPatientName") == original_name and
-                            user_apng_name == apng_name and
-                            user_apng.get("source") == source):
-                            label = user_apng.get("label", 0)
-                            break
-                apng_data["label"] = label
+                apng_data["label"] = label_lookup["apngs"].get(
+                    (source, apng_data["originalPatientName"], apng_name), 0)
                 patients[new_patient_name]["apngs"][apng_name] = apng_data
     
     # Convert to list format for the response
@@ -572,13 +298,20 @@ async def scan_directory(request: ScanDirectoryRequest):
         match = re.search(r'\d+', patient["patientName"])
         return int(match.group()) if match else float('inf')
     
-    patient_list_sorted = sorted(patient_list, key=extract_patient_number_from_mapped)
+    # The main CSV is shared: only the sources scanned here are replaced. The
+    # patients of other sources (scanned by other users) are kept, both there
+    # and in this user's list (which starts from the main CSV for a new user)
+    manifest = [patient for patient in indexed_patients(MAIN_CSV_FILE_PATH)
+                if patient.get("source") not in scanned_sources]
+    user_patients = [patient for patient in user_patients if patient.get("source") not in scanned_sources] \
+        if user_patients else manifest
+    patient_list_sorted = sorted(patient_list + user_patients, key=extract_patient_number_from_mapped)
 
     # Save to main CSV (structure with filepath info) - this serves as the template for new users
-    save_to_csv(patient_list_sorted, MAIN_CSV_FILE_PATH)
+    save_to_csv(sorted(patient_list + manifest, key=extract_patient_number_from_mapped), MAIN_CSV_FILE_PATH)
     
     # For the current user, preserve their labels if they had any
-    save_to_csv(patient_list_sorted, user_csv_path)
+    save_user_patients(username, patient_list_sorted)
 
     # Remove source info before sending to frontend
     for patient in patient_list_sorted:
@@ -590,146 +323,529 @@ async def scan_directory(request: ScanDirectoryRequest):
     print(f"Returning {len(patient_list_sorted)} patients with metadata")
     return {"patients": patient_list_sorted}
 
-def _pil_to_data_uri(pil_img, mime="image/png") -> str:
-    buf = io.BytesIO()
-    pil_img.save(buf, format="PNG")
-    data = base64.b64encode(buf.getvalue()).decode("utf-8")
-    return f"data:{mime};base64,{data}"
+def _run_scan_locked(request: ScanDirectoryRequest, progress: ScanProgress = None):
+    with _scan_lock:
+        return run_scan(request, progress)
 
-@app.post("/fetch-patient-dicoms")
-async def fetch_patient_dicoms(request: PatientDicomsRequest):
+@app.post("/scan-directory")
+async def scan_directory(request: ScanDirectoryRequest):
+    """Scan directories for DICOM files and update user's CSV (blocks until done)"""
+    validate_scan_request(request)
+    # Run in a worker thread so the scan doesn't block the event loop
+    return await run_in_threadpool(_run_scan_locked, request)
+
+# ----- Background scan jobs -----
+SCAN_PROGRESS_INTERVAL = float(os.environ.get("ECHO_SCAN_PROGRESS_INTERVAL", "0.5"))  # seconds between progress events
+MAX_FINISHED_SCAN_JOBS = 20
+
+class ScanJob:
+    """A scan running in a background thread, tracked by ID"""
+
+    def __init__(self, request: ScanDirectoryRequest):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.progress = ScanProgress()
+        self.status = "queued"   # queued -> running -> completed / failed / cancelled
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def run(self):
+        try:
+            with _scan_lock:
+                # Cancelled while waiting for another scan to finish
+                self.progress.check()
+                self.status = "running"
+                self.progress.started_at = time.time()
+                self.result = run_scan(self.request, self.progress)
+            self.status = "completed"
+        except ScanCancelled:
+            self.status = "cancelled"
+        except Exception as e:
+            print(f"Scan job {self.id} failed: {e}")
+            self.error = str(e)
+            self.status = "failed"
+        finally:
+            self.progress.finish()
+
+    def snapshot(self):
+        snapshot = {
+            "jobId": self.id,
+            "username": self.request.username,
+            "status": self.status,
+            **self.progress.snapshot()
+        }
+        if self.error:
+            snapshot["error"] = self.error
+        if self.result is not None:
+            snapshot["patientCount"] = len(self.result["patients"])
+        return snapshot
+
+scan_jobs: Dict[str, ScanJob] = {}
+
+def _prune_scan_jobs():
+    finished = sorted((job for job in scan_jobs.values() if job.done), key=lambda job: job.created_at)
+    for job in finished[:-MAX_FINISHED_SCAN_JOBS]:
+        scan_jobs.pop(job.id, None)
+
+def get_scan_job(job_id: str) -> ScanJob:
+    job = scan_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Scan job not found: {job_id}")
+    return job
+
+@app.post("/scan-jobs")
+async def start_scan_job(request: ScanDirectoryRequest):
+    """Start a scan in the background and return its job ID"""
+    validate_scan_request(request)
+    _prune_scan_jobs()
+    job = ScanJob(request)
+    scan_jobs[job.id] = job
+    threading.Thread(target=job.run, name=f"scan-{job.id}", daemon=True).start()
+    return job.snapshot()
+
+@app.get("/scan-jobs/{job_id}")
+async def get_scan_job_status(job_id: str):
+    """Current status and counters of a scan job"""
+    return get_scan_job(job_id).snapshot()
+
+@app.get("/scan-jobs/{job_id}/events")
+async def stream_scan_job(job_id: str):
     """
-    Fetch media for a specific patient using the user's CSV.
-    Returns two lists: dicoms[] and apngs[], each item has images[] just like DICOMs.
+    Stream scan progress as Server-Sent Events. Each event carries the job
+    snapshot (files seen, DICOMs/APNGs found, throughput); the stream ends
+    after the event reporting the final status.
     """
-    patient_name = request.patientName
-    username = request.username
+    job = get_scan_job(job_id)
+
+    async def events():
+        while True:
+            snapshot = job.snapshot()
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            if job.done:
+                break
+            await asyncio.sleep(SCAN_PROGRESS_INTERVAL)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/scan-jobs/{job_id}/result")
+async def get_scan_job_result(job_id: str):
+    """Patient list of a completed scan job (same shape as /scan-directory)"""
+    job = get_scan_job(job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"Scan job is {job.status}")
+    return job.result
+
+@app.delete("/scan-jobs/{job_id}")
+async def cancel_scan_job(job_id: str):
+    """Cancel a queued or running scan job"""
+    job = get_scan_job(job_id)
+    if not job.done:
+        job.progress.cancel()
+    return job.snapshot()
+
+class RenderActivity:
+    """Number of live (non-background) load_clips calls in flight"""
+
+    def __init__(self):
+        self._active = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            self._active += 1
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._active -= 1
+            if self._active == 0:
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Wait until no live render is running. Returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._active == 0, timeout)
+
+live_renders = RenderActivity()
+
+def load_clips(clips, profile: Optional[str] = None, max_size: Optional[int] = None,
+               thumbnail: bool = False, crop: bool = False, background: bool = False) -> List[dict]:
+    """
+    Rendered frames for several clips, given as (kind, filepath, name) tuples,
+    encoded with the given profile (each kind's default if None) and
+    downscaled to max_size if given. With thumbnail=True each clip is
+    rendered as its single keyframe thumbnail instead (max_size is then the
+    thumbnail size). crop cuts frames down to the ultrasound sector.
+    Cached clips come from the frame cache; the rest are decoded in parallel on
+    the decode pool. Results are returned in the order given, and a clip that
+    fails to decode gets an "error" instead of failing the whole batch.
+    Live calls are counted in live_renders so background work (background=True,
+    see Prefetcher) can stay out of their way; its cache lookups aren't
+    counted in the frame cache's hit rate either.
+    """
+    if background:
+        return _load_clips(clips, profile, max_size, thumbnail, crop, count=False)
+    with live_renders:
+        return _load_clips(clips, profile, max_size, thumbnail, crop)
 
+def submit_render(render, *args):
+    """Submit a render function to the decode pool"""
+    try:
+        return decode_pool().submit(render, *args)
+    except BrokenProcessPool:
+        # A previous worker crash left the pool unusable; start a fresh one
+        reset_decode_pool()
+        return decode_pool().submit(render, *args)
+
+def render_result(future, name: str) -> dict:
+    """
+    The rendered clip of a submitted render, or an empty clip with an "error"
+    (and a "frameCount" of 0, as frame range renders have) if it failed
+    """
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        print(f"Decode worker crashed while rendering {name}: {e}")
+        reset_decode_pool()
+        return {"frames": [], "frameCount": 0, "error": "Decode worker crashed"}
+    except Exception as e:
+        print(f"Error rendering {name}: {e}")
+        return {"frames": [], "frameCount": 0, "error": str(e)}
+
+def _load_clips(clips, profile, max_size, thumbnail, crop, count: bool = True) -> List[dict]:
+    results = [None] * len(clips)
+    pending = []
+    if thumbnail:
+        render, params, size = render_thumbnail, thumbnail_params, max_size or THUMBNAIL_SIZE
+    else:
+        render, params, size = render_clip, render_params, max_size
+    for i, (kind, filepath, name) in enumerate(clips):
+        key = cache_key(filepath, params(kind, profile, size, crop))
+        cached = frame_cache.get(key, count)
+        if cached is not None:
+            results[i] = cached
+            continue
+        future = submit_render(render, kind, filepath, name, profile, size, crop)
+        pending.append((i, key, name, future))
+
+    for i, key, name, future in pending:
+        clip = render_result(future, name)
+        # Don't cache failures or empty renders, they may be transient
+        if clip["frames"] and "error" not in clip:
+            frame_cache.put(key, clip)
+        results[i] = clip
+    return results
+
+def load_clip(kind: str, filepath: str, name: str = "", profile: Optional[str] = None,
+              max_size: Optional[int] = None, crop: bool = False) -> dict:
+    """Rendered frames for a clip, from the frame cache when possible"""
+    return load_clips([(kind, filepath, name)], profile, max_size, crop=crop)[0]
+
+def load_frame_range(kind: str, filepath: str, name: str, profile: Optional[str], max_size: Optional[int],
+                     crop: bool, start: int = 0, end: Optional[int] = None, stride: int = 1):
+    """
+    Frames start:end:stride of a clip. Returns (clip, indices, frames): clip
+    has the clip-level fields ("frameCount", "roi", "error") and frames are
+    the rendered frames at indices.
+
+    The full rendering is used when it's cached or needed anyway (the whole
+    clip, APNGs, crop, which looks at every frame). Otherwise only the
+    requested frames of a DICOM are decoded, seeking in video streams (see
+    media.render_frame_range), and cached as a range of their own.
+    """
+    whole = start == 0 and end is None and stride == 1
+    if whole or kind != "dicom" or crop or \
+            frame_cache.contains(cache_key(filepath, render_params(kind, profile, max_size))):
+        clip = load_clip(kind, filepath, name, profile, max_size, crop)
+        indices = frame_range(len(clip["frames"]), start, end, stride)
+        return dict(clip, frameCount=len(clip["frames"])), indices, [clip["frames"][i] for i in indices]
+
+    frame_range(0, start, end, stride)   # reject bad ranges before decoding anything
+    key = cache_key(filepath, frame_range_params(kind, profile, max_size, start, end, stride))
+    clip = frame_cache.get(key)
+    if clip is None:
+        with live_renders:
+            clip = render_result(submit_render(render_frame_range, kind, filepath, name, profile, max_size,
+                                               start, end, stride), name)
+        if clip["frames"] and "error" not in clip:
+            frame_cache.put(key, clip)
+    indices = frame_range(clip.get("frameCount", 0), start, end, stride)
+    if len(clip["frames"]) < len(indices):
+        indices = indices[:len(clip["frames"])]   # the stream ended early
+    return clip, indices, clip["frames"]
+
+# How frames are delivered in JSON responses: inline data URIs, or URLs of
+# /clip-frame that return the raw JPEG/PNG bytes
+FRAME_TRANSPORTS = ("datauri", "url")
+
+def check_transport(transport: str):
+    if transport not in FRAME_TRANSPORTS:
+        raise HTTPException(status_code=400, detail=f"Unknown transport: {transport}")
+
+def check_profile(profile: Optional[str]):
+    if profile is not None and profile not in ENCODING_PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown profile: {profile} "
+                                                    f"(one of {', '.join(ENCODING_PROFILES)})")
+
+def clip_version(kind: str, filepath: str, profile: Optional[str] = None, max_size: Optional[int] = None,
+                 crop: bool = False) -> str:
+    """Short tag that changes whenever the clip's file or rendering changes (used for ETags / URLs)"""
+    return (cache_key(filepath, render_params(kind, profile, max_size, crop)) or "")[:16]
+
+def build_images(frames, indices, kind: str, entry: Dict, username: str = None,
+                 patient_name: str = None, transport: str = "datauri", profile: Optional[str] = None,
+                 max_size: Optional[int] = None, crop: bool = False):
+    """Image objects for a list of rendered frames, in the requested transport"""
+    name = entry["dicomName"]
+    if transport != "url":
+        return frames_to_images(name, frames, indices)
+
+    version = clip_version(kind, entry["filepath"], profile, max_size, crop)
+    images = []
+    for index, frame in zip(indices, frames):
+        params = {
+            "username": username, "patientName": patient_name, "dicomName": name,
+            "kind": kind, "index": index, "v": version
+        }
+        if profile:
+            params["profile"] = profile
+        if max_size:
+            params["preview"] = "true"
+        if crop:
+            params["crop"] = "true"
+        query = urlencode(params)
+        image = {"id": f"{name}-{index + 1}", "src": f"/clip-frame?{query}", "mime": frame["mime"]}
+        if "delayMs" in frame:
+            image["delayMs"] = frame["delayMs"]
+        images.append(image)
+    return images
+
+def clip_items(clips, username: str = None, patient_name: str = None, transport: str = "datauri",
+               profile: Optional[str] = None, max_size: Optional[int] = None, crop: bool = False) -> List[Dict]:
+    """
+    Build the response items (dicomName, label, images[, error]) for a list of
+    (kind, entry) clips, decoding them in parallel. Order is preserved.
+    """
+    items = [None] * len(clips)
+    to_load = []
+    for i, (kind, entry) in enumerate(clips):
+        filepath = entry.get("filepath")
+        if not (filepath and os.path.exists(filepath)):
+            items[i] = {"dicomName": entry["dicomName"], "label": entry.get("label", 0),
+                        "images": [], "error": "Missing file"}
+        else:
+            to_load.append(i)
+
+    loaded = load_clips([(clips[i][0], clips[i][1]["filepath"], clips[i][1]["dicomName"]) for i in to_load],
+                        profile, max_size, crop=crop)
+    for i, clip in zip(to_load, loaded):
+        kind, entry = clips[i]
+        images = build_images(clip["frames"], range(len(clip["frames"])), kind, entry,
+                              username, patient_name, transport, profile, max_size, crop)
+        items[i] = {"dicomName": entry["dicomName"], "label": entry.get("label", 0), "images": images}
+        if "roi" in clip:
+            items[i]["roi"] = clip["roi"]
+        if "error" in clip:
+            items[i]["error"] = clip["error"]
+    return items
+
+def find_patient(username: str, patient_name: str):
+    """Find a patient in the user's labels, or None"""
+    return load_user_patient(username, patient_name)
+
+def find_clip_entry(patient: Dict, dicom_name: str, kind: Optional[str] = None):
+    """Find a clip of a patient by name. Returns (kind, entry) or (None, None)"""
+    kinds = [kind] if kind else ["dicom", "apng"]
+    for k in kinds:
+        for entry in patient.get(f"{k}s", []):
+            if entry["dicomName"] == dicom_name:
+                return k, entry
+    return None, None
+
+def resolve_clip(username: str, patient_name: str, dicom_name: str, kind: Optional[str] = None):
+    """Look up a clip for a request, raising 400/404 as appropriate. Returns (kind, entry)"""
     if not username:
         raise HTTPException(status_code=400, detail="Username is required")
+    if kind not in (None, "dicom", "apng"):
+        raise HTTPException(status_code=400, detail=f"Unknown kind: {kind}")
+    patient = find_patient(username, patient_name)
+    if patient is None:
+        raise HTTPException(status_code=404, detail=f"Patient not found: {patient_name}")
+    kind, entry = find_clip_entry(patient, dicom_name, kind)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Clip not found: {patient_name}/{dicom_name}")
+    return kind, entry
+
+def frame_range(frame_count: int, start: int = 0, end: Optional[int] = None, stride: int = 1):
+    """Validate a start/end/stride request against a clip's frame count and return the frame indices"""
+    if start < 0 or stride < 1 or (end is not None and end < start):
+        raise HTTPException(status_code=400, detail="Invalid frame range: need 0 <= start <= end and stride >= 1")
+    end = frame_count if end is None else min(end, frame_count)
+    return range(start, end, stride)
+
+# ----- Prefetching -----
+# Once a patient is served, the clips of the user's next few patients that
+# still have unlabeled clips are rendered in the background, so moving on is a
+# frame cache hit. 0 disables prefetching.
+PREFETCH_PATIENTS = int(os.environ.get("ECHO_PREFETCH_PATIENTS", "2"))
+# Upper bound on how much a single prefetch may add to the frame cache (MB), so
+# it can't push the patient being labeled out of the memory tier
+PREFETCH_MAX_MB = int(os.environ.get("ECHO_PREFETCH_MAX_MB", "64"))
+
+class Prefetcher:
+    """
+    Background warming of the frame cache, one plan per user.
 
-    user_csv_path = get_user_csv_path(username)
-    print(f'Fetching media for patient {patient_name} for user {username}')
-
-    csv_patients = load_from_csv(user_csv_path)
-    dicom_items = []
-    apng_items  = []
+    Every schedule() supersedes the user's previous plan (the user's
+    generation goes up), so jumping to another patient cancels the old
+    prefetch between clips. Plans run on a single thread, one clip at a time,
+    and only while no live request is rendering: prefetching never holds more
+    than one decode worker and always yields to live requests.
+    """
 
-    for patient in csv_patients:
-        if patient["patientName"] != patient_name:
-            continue
+    def __init__(self, depth: int, max_bytes: int):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._plans = OrderedDict()   # username -> (generation, patient_name, render options)
+        self._generations = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.clips_warmed = 0
+        self.bytes_warmed = 0
+        self.cancelled = 0
+
+    def schedule(self, username: str, patient_name: str, profile: Optional[str] = None,
+                 max_size: Optional[int] = None, crop: bool = False):
+        """Prefetch the patients after patient_name, replacing the user's previous plan"""
+        if self.depth <= 0:
+            return
+        with self._cond:
+            generation = self._generations.get(username, 0) + 1
+            self._generations[username] = generation
+            self._plans.pop(username, None)
+            self._plans[username] = (generation, patient_name, (profile, max_size, crop))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self, username: str):
+        """Drop the user's queued or running plan"""
+        with self._cond:
+            self._generations[username] = self._generations.get(username, 0) + 1
+            self._plans.pop(username, None)
+
+    def _is_current(self, username: str, generation: int) -> bool:
+        with self._cond:
+            if self._generations.get(username) == generation:
+                return True
+            self.cancelled += 1
+            return False
 
-        # ---------- DICOMs (existing logic) ----------
-        for dicom in patient.get("dicoms", []):
-            dicomName = dicom["dicomName"]
-            filepath  = dicom.get("filepath")
-            label     = dicom.get("label", 0)
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._plans:
+                    self._cond.wait()
+                username, (generation, patient_name, options) = self._plans.popitem(last=False)
+            try:
+                self._prefetch(username, generation, patient_name, *options)
+            except Exception as e:
+                print(f"Prefetch after {patient_name} for user {username} failed: {e}")
 
-            if not (filepath and os.path.exists(filepath)):
-                dicom_items.append({"dicomName": dicomName, "label": label, "images": [], "error": "Missing file"})
+    def upcoming_clips(self, username: str, patient_name: str):
+        """(kind, filepath, name) of the clips of the next `depth` patients that still need labels"""
+        patients = load_user_patients(username)
+        names = [patient["patientName"] for patient in patients]
+        if patient_name not in names:
+            return []
+        clips = []
+        found = 0
+        for patient in patients[names.index(patient_name) + 1:]:
+            entries = [("dicom", entry) for entry in patient.get("dicoms", [])] + \
+                      [("apng", entry) for entry in patient.get("apngs", [])]
+            if all(entry.get("label", 0) != 0 for _, entry in entries):
+                continue
+            clips.extend((kind, entry["filepath"], entry["dicomName"]) for kind, entry in entries
+                         if entry.get("filepath") and os.path.exists(entry["filepath"]))
+            found += 1
+            if found >= self.depth:
+                break
+        return clips
+
+    def _prefetch(self, username: str, generation: int, patient_name: str,
+                  profile: Optional[str], max_size: Optional[int], crop: bool):
+        warmed = 0
+        for kind, filepath, name in self.upcoming_clips(username, patient_name):
+            if frame_cache.contains(cache_key(filepath, render_params(kind, profile, max_size, crop))):
+                continue
+            # Wait for live requests to finish; give up if the user moved on meanwhile
+            while not live_renders.wait_idle(timeout=1.0):
+                if not self._is_current(username, generation):
+                    return
+            if not self._is_current(username, generation):
+                return
+            clip = load_clips([(kind, filepath, name)], profile, max_size, crop=crop, background=True)[0]
+            if "error" in clip:
                 continue
+            warmed += clip_size(clip)
+            with self._cond:
+                self.clips_warmed += 1
+                self.bytes_warmed += clip_size(clip)
+            if warmed >= self.max_bytes:
+                return
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": self.depth,
+                "queued": len(self._plans),
+                "clipsWarmed": self.clips_warmed,
+                "bytesWarmed": self.bytes_warmed,
+                "cancelled": self.cancelled
+            }
 
-            try:
-                ds = pydicom.dcmread(filepath)
-                images = []
-
-                # Is this a video-encoded DICOM?
-                is_video_dicom = False
-                if hasattr(ds.file_meta, 'TransferSyntaxUID'):
-                    ts_uid = str(ds.file_meta.TransferSyntaxUID)
-                    if ts_uid == '1.2.840.10008.1.2.4.102' or 'MPEG-4' in ds.file_meta.TransferSyntaxUID.name:
-                        is_video_dicom = True
-
-                if is_video_dicom:
-                    print(f"Processing video DICOM: {dicomName}")
-                    try:
-                        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True) as temp_file:
-                            temp_file.write(next(generate_pixel_data_frame(ds.PixelData)))
-                            temp_file.flush()
-
-                            cap = cv2.VideoCapture(temp_file.name)
-                            if cap.isOpened():
-                                frame_count = 0
-                                while True:
-                                    ret, frame = cap.read()
-                                    if not ret:
-                                        break
-                                    image_data = convert_frame_to_base64(frame)  # your existing encoder
-                                    images.append({
-                                        "id": f"{dicomName}-{frame_count+1}",
-                                        "src": image_data
-                                    })
-                                    frame_count += 1
-                                cap.release()
-                            else:
-                                raise Exception("Could not open video from DICOM")
-                    except Exception as video_error:
-                        print(f"Error extracting video frames: {video_error}")
-                        images = []
-                else:
-                    # Standard non-video DICOMs
-                    try:
-                        pixel_array = ds.pixel_array
-                        if len(pixel_array.shape) > 2:
-                            frames = [pixel_array[i] for i in range(pixel_array.shape[0])]
-                        else:
-                            frames = [pixel_array]
-                        images = [{"id": f"{dicomName}-{i+1}", "src": convert_frame_to_base64(frame)} for i, frame in enumerate(frames)]
-                    except Exception as pixel_error:
-                        print(f"Error processing pixel data: {pixel_error}")
-                        images = []
-
-                dicom_items.append({"dicomName": dicomName, "label": label, "images": images})
-            except Exception as e:
-                print(f"Error reading DICOM: {e}")
-                dicom_items.append({"dicomName": dicomName, "label": label, "images": [], "error": str(e)})
+prefetcher = Prefetcher(PREFETCH_PATIENTS, PREFETCH_MAX_MB * 1024 * 1024)
 
-        # ---------- APNGs (new, frame-by-frame like DICOM) ----------
-        for apng_entry in patient.get("apngs", []):
-            apng_name = apng_entry["dicomName"]  # keeping same field name for consistency
-            filepath  = apng_entry.get("filepath")
-            label     = apng_entry.get("label", 0)
+@app.post("/fetch-patient-dicoms")
+@offload("media", "fetch-patient-dicoms")
+def fetch_patient_dicoms(request: PatientDicomsRequest):
+    """
+    Fetch media for a specific patient using the user's CSV.
+    Returns two lists: dicoms[] and apngs[], each item has images[] just like DICOMs.
+    """
+    patient_name = request.patientName
+    username = request.username
 
-            if not (filepath and os.path.exists(filepath)):
-                apng_items.append({"dicomName": apng_name, "label": label, "images": [], "error": "Missing file"})
-                continue
+    if not username:
+        raise HTTPException(status_code=400, detail="Username is required")
+    check_transport(request.transport)
+    check_profile(request.profile)
 
-            try:
-                ap = APNG.open(filepath)
-                images = []
-                idx = 0
-                for png, ctrl in ap.frames:
-                    try:
-                        pil_img = Image.open(io.BytesIO(png.to_bytes()))
-                        if pil_img.mode not in ("RGB", "RGBA", "L"):
-                            pil_img = pil_img.convert("RGBA")
-                        src = _pil_to_data_uri(pil_img, mime="image/png")
-
-                        img_obj = {"id": f"{apng_name}-{idx+1}", "src": src}
-                        # Optional: attach original per-frame delay if available
-                        try:
-                            num = getattr(ctrl, "delay_num", getattr(ctrl, "delay", None))
-                            den = getattr(ctrl, "delay_den", None) or 100
-                            if num is not None:
-                                img_obj["delayMs"] = int(1000 * float(num) / float(den))
-                        except Exception:
-                            pass
-
-                        images.append(img_obj)
-                        idx += 1
-                    except Exception as frame_err:
-                        print(f"Error decoding APNG frame for {apng_name}: {frame_err}")
-                        continue
-
-                apng_items.append({"dicomName": apng_name, "label": label, "images": images})
-            except Exception as e:
-                print(f"Error reading APNG {filepath}: {e}")
-                apng_items.append({"dicomName": apng_name, "label": label, "images": [], "error": str(e)})
+    print(f'Fetching media for patient {patient_name} for user {username}')
 
-        break  # found the patient we wanted
+    patient = find_patient(username, patient_name) or {}
+    dicoms = patient.get("dicoms", [])
+    apngs = patient.get("apngs", [])
+    # Decode all of the patient's clips at once so they spread over the decode pool
+    profile, max_size = render_options(request.profile, request.preview)
+    items = clip_items([("dicom", dicom) for dicom in dicoms] + [("apng", apng_entry) for apng_entry in apngs],
+                       username, patient_name, request.transport, profile, max_size, request.crop)
+    dicom_items = items[:len(dicoms)]
+    apng_items = items[len(dicoms):]
 
     if not dicom_items and not apng_items:
         raise HTTPException(status_code=404, detail=f"No DICOMs or APNGs found for patient: {patient_name}")
+    # Get the next patients ready while this one is being labeled
+    prefetcher.schedule(username, patient_name, profile, max_size, request.crop)
 
     # Return them in separate arrays to avoid index/shape confusion on the frontend
     return {
@@ -738,65 +854,390 @@ async def fetch_patient_dicoms(request: PatientDicomsRequest):
         "apngs": apng_items
     }
 
+@app.get("/patient-thumbnails")
+@offload("media", "patient-thumbnails")
+def fetch_patient_thumbnails(username: str, patientName: str, size: int = THUMBNAIL_SIZE,
+                             profile: Optional[str] = None, crop: bool = False):
+    """
+    Overview of a patient: one small keyframe thumbnail per DICOM / APNG
+    (a representative frame, see media.pick_keyframe) instead of every frame.
+    Thumbnails are cached like rendered clips; crop=true crops them to the
+    ultrasound sector.
+    """
+    if not username:
+        raise HTTPException(status_code=400, detail="Username is required")
+    if not 16 <= size <= 1024:
+        raise HTTPException(status_code=400, detail="size must be between 16 and 1024")
+    check_profile(profile)
+
+    patient = find_patient(username, patientName)
+    if patient is None:
+        raise HTTPException(status_code=404, detail=f"Patient not found: {patientName}")
+    clips = [("dicom", entry) for entry in patient.get("dicoms", [])] + \
+            [("apng", entry) for entry in patient.get("apngs", [])]
+
+    items = [None] * len(clips)
+    to_load = []
+    for i, (kind, entry) in enumerate(clips):
+        items[i] = {"dicomName": entry["dicomName"], "kind": kind, "label": entry.get("label", 0)}
+        filepath = entry.get("filepath")
+        if filepath and os.path.exists(filepath):
+            to_load.append(i)
+        else:
+            items[i].update(frameCount=0, thumbnail=None, error="Missing file")
+
+    loaded = load_clips([(clips[i][0], clips[i][1]["filepath"], clips[i][1]["dicomName"]) for i in to_load],
+                        profile, size, thumbnail=True, crop=crop)
+    for i, thumb in zip(to_load, loaded):
+        name = clips[i][1]["dicomName"]
+        images = frames_to_images(name, thumb["frames"], [thumb.get("keyframe", 0)])
+        items[i].update(frameCount=thumb.get("frameCount", 0), keyframe=thumb.get("keyframe", 0),
+                        thumbnail=images[0] if images else None)
+        if "roi" in thumb:
+            items[i]["roi"] = thumb["roi"]
+        if "error" in thumb:
+            items[i]["error"] = thumb["error"]
+
+    return {
+        "patientName": patientName,
+        "dicoms": [item for item in items if item["kind"] == "dicom"],
+        "apngs": [item for item in items if item["kind"] == "apng"]
+    }
+
+@app.get("/fetch-clip")
+@offload("media", "fetch-clip")
+def fetch_clip(username: str, patientName: str, dicomName: str, kind: Optional[str] = None,
+               start: int = 0, end: Optional[int] = None, stride: int = 1, transport: str = "datauri",
+               profile: Optional[str] = None, preview: bool = False, crop: bool = False):
+    """
+    Fetch a single DICOM or APNG of a patient, optionally limited to a frame
+    range. start is inclusive, end exclusive (default: last frame), and stride
+    picks every n-th frame. Image ids keep the frame's position in the full
+    clip, so ranges fetched separately can be merged on the frontend.
+    profile picks the encoding ("label", "preview", "lossless"),
+    preview=true returns downscaled frames, and crop=true crops frames to
+    the ultrasound sector (the crop box is returned as "roi").
+    """
+    check_transport(transport)
+    check_profile(profile)
+    profile, max_size = render_options(profile, preview)
+    kind, entry = resolve_clip(username, patientName, dicomName, kind)
+    filepath = entry.get("filepath")
+    response = {
+        "patientName": patientName,
+        "dicomName": dicomName,
+        "kind": kind,
+        "label": entry.get("label", 0)
+    }
+
+    if not (filepath and os.path.exists(filepath)):
+        return {**response, "frameCount": 0, "images": [], "error": "Missing file"}
+
+    clip, indices, frames = load_frame_range(kind, filepath, dicomName, profile, max_size, crop,
+                                             start, end, stride)
+    response.update({
+        "frameCount": clip.get("frameCount", len(clip["frames"])),
+        "start": indices.start,
+        "end": indices.stop,
+        "stride": indices.step,
+        "images": build_images(frames, indices, kind, entry,
+                               username, patientName, transport, profile, max_size, crop)
+    })
+    if "roi" in clip:
+        response["roi"] = clip["roi"]
+    if "error" in clip:
+        response["error"] = clip["error"]
+    return response
+
+def resolve_clip_file(username: str, patient_name: str, dicom_name: str, kind: Optional[str] = None,
+                      profile: Optional[str] = None):
+    """resolve_clip for the binary endpoints, which also need the clip's file on disk. Returns (kind, entry)"""
+    check_profile(profile)
+    kind, entry = resolve_clip(username, patient_name, dicom_name, kind)
+    filepath = entry.get("filepath")
+    if not (filepath and os.path.exists(filepath)):
+        raise HTTPException(status_code=404, detail=f"Missing file for clip: {patient_name}/{dicom_name}")
+    return kind, entry
+
+def load_resolved_clip(username: str, patient_name: str, dicom_name: str, kind: Optional[str] = None,
+                       profile: Optional[str] = None, max_size: Optional[int] = None, crop: bool = False,
+                       start: int = 0, end: Optional[int] = None, stride: int = 1):
+    """
+    Resolve and render frames of a clip for the binary endpoints.
+    Returns (kind, entry, clip, indices, frames), see load_frame_range
+    """
+    kind, entry = resolve_clip_file(username, patient_name, dicom_name, kind, profile)
+    return (kind, entry) + load_frame_range(kind, entry["filepath"], dicom_name, profile, max_size, crop,
+                                            start, end, stride)
+
+@app.get("/clip-frame")
+@offload("media", "clip-frame")
+def get_clip_frame(username: str, patientName: str, dicomName: str, index: int,
+                   kind: Optional[str] = None, profile: Optional[str] = None, preview: bool = False,
+                   crop: bool = False, if_none_match: Optional[str] = Header(None)):
+    """
+    A single frame of a clip as raw image bytes (image/jpeg or image/png), so
+    the browser can decode it natively. index is 0-based. Responses carry an
+    ETag and may be cached by the browser; the ETag only needs a stat of the
+    file, so a revalidation is answered without decoding anything.
+    """
+    profile, max_size = render_options(profile, preview)
+    if index < 0:
+        raise HTTPException(status_code=404, detail=f"Frame {index} out of range for {dicomName}")
+    kind, entry = resolve_clip_file(username, patientName, dicomName, kind, profile)
+    filepath = entry["filepath"]
+
+    etag = f'"{clip_version(kind, filepath, profile, max_size, crop)}-{index}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    _, _, frames = load_frame_range(kind, filepath, dicomName, profile, max_size, crop, index, index + 1)
+    if not frames:
+        raise HTTPException(status_code=404, detail=f"Frame {index} out of range for {dicomName}")
+    frame = frames[0]
+    return Response(content=frame["data"], media_type=frame["mime"], headers=headers)
+
+@app.get("/fetch-clip-binary")
+@offload("media", "fetch-clip-binary")
+def fetch_clip_binary(username: str, patientName: str, dicomName: str, kind: Optional[str] = None,
+                      start: int = 0, end: Optional[int] = None, stride: int = 1,
+                      profile: Optional[str] = None, preview: bool = False, crop: bool = False):
+    """
+    Frames of a clip as one length-prefixed binary stream
+    (application/octet-stream) instead of base64 inside JSON.
+
+    The body is a sequence of records, one per frame:
+        4-byte big-endian header length, UTF-8 JSON header
+        ({"id", "index", "mime", "size"[, "delayMs"]}),
+        then "size" bytes of encoded image data.
+    The total number of frames in the clip is sent in the X-Frame-Count header,
+    and with crop=true the crop box (JSON) in X-Clip-ROI.
+    """
+    profile, max_size = render_options(profile, preview)
+    kind, entry, clip, indices, frames = load_resolved_clip(username, patientName, dicomName, kind, profile,
+                                                            max_size, crop, start, end, stride)
+
+    headers = {"X-Frame-Count": str(clip.get("frameCount", len(clip["frames"])))}
+    if "roi" in clip:
+        headers["X-Clip-ROI"] = json.dumps(clip["roi"])
+
+    def records():
+        for index, frame in zip(indices, frames):
+            header = {"id": f"{dicomName}-{index + 1}", "index": index,
+                      "mime": frame["mime"], "size": len(frame["data"])}
+            if "delayMs" in frame:
+                header["delayMs"] = frame["delayMs"]
+            header_bytes = json.dumps(header).encode("utf-8")
+            yield struct.pack(">I", len(header_bytes)) + header_bytes
+            yield frame["data"]
+
+    return StreamingResponse(
+        records(),
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+def load_clip_video(kind: str, filepath: str, container: str = "auto"):
+    """
+    Path and mime type of a playable video for a clip, from the video cache
+    when possible. MPEG-4 DICOMs are served as their embedded MP4 stream
+    unchanged; everything else (and MPEG-4 when webm is asked for) is
+    transcoded once and cached.
+    """
+    if kind == "dicom" and container in ("auto", "mp4"):
+        ds = open_dicom(filepath)
+        if is_video_dicom(ds):
+            key = cache_key(filepath, VIDEO_PASSTHROUGH_PARAMS)
+            path = video_cache.get_path(key, ".mp4")
+            if path is None:
+                # Same cache entry the decode workers extract into
+                data = video_bitstream(filepath, ds)
+                path = video_cache.get_path(key, ".mp4") or video_cache.write(key, data, ".mp4")
+            return path, "video/mp4"
+
+    if container == "auto":
+        container = "webm"
+    suffix = f".{container}"
+    key = cache_key(filepath, {"video": "transcode", "kind": kind, "container": container, "version": RENDER_VERSION})
+    path = video_cache.get_path(key, suffix)
+    if path is None:
+        tmp_path = video_cache.temp_path(key, suffix)
+        try:
+            transcode_clip(kind, filepath, tmp_path, container)
+            path = video_cache.commit(tmp_path, key, suffix)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return path, VIDEO_CONTAINERS[container][0]
+
+@app.get("/fetch-clip-video")
+@offload("media", "fetch-clip-video")
+def fetch_clip_video(username: str, patientName: str, dicomName: str, kind: Optional[str] = None,
+                     container: str = "auto"):
+    """
+    A clip as a video file the browser can play with hardware decoding.
+    container is "auto" (pass MPEG-4 DICOMs through as MP4, transcode the
+    rest to WebM), "mp4" or "webm".
+    """
+    if container != "auto" and container not in VIDEO_CONTAINERS:
+        raise HTTPException(status_code=400, detail=f"Unknown container: {container}")
+    kind, entry = resolve_clip(username, patientName, dicomName, kind)
+    filepath = entry.get("filepath")
+    if not (filepath and os.path.exists(filepath)):
+        raise HTTPException(status_code=404, detail=f"Missing file for clip: {patientName}/{dicomName}")
+
+    try:
+        path, mime = load_clip_video(kind, filepath, container)
+    except Exception as e:
+        print(f"Error preparing video for {dicomName}: {e}")
+        raise HTTPException(status_code=500, detail=f"Could not produce video: {e}")
+    return FileResponse(path, media_type=mime, headers={"Cache-Control": "private, max-age=86400"})
+
+@app.get("/encoding-profiles")
+async def get_encoding_profiles():
+    """The encoding profiles clip endpoints accept in their profile parameter"""
+    return {"profiles": ENCODING_PROFILES}
+
+@app.get("/frame-cache/stats")
+async def get_frame_cache_stats():
+    """Hit/miss counters and sizes of the decoded-frame cache, plus prefetch counters"""
+    return {**frame_cache.stats(), "prefetch": prefetcher.stats()}
+
+def load_or_create_user_patients(username: str):
+    """The user's patients; a new user starts from the main CSV with all labels at 0"""
+    if not user_labels_exist(username):
+        # New users get an empty overlay; the main CSV supplies the patients
+        create_user_labels(username)
+    return load_user_patients(username)
+
+CSV_FIELD_MODES = ("full", "compact")
+COMPACT_CLIP_FIELDS = ("dicomName", "label", "frameCount")
+
+def filter_clips(clips: List[Dict], unlabeled: bool = False, label: Optional[int] = None):
+    """Clips matching the label filters (all of them if no filter is set)"""
+    if unlabeled:
+        clips = [clip for clip in clips if clip.get("label", 0) == 0]
+    if label is not None:
+        clips = [clip for clip in clips if clip.get("label", 0) == label]
+    return clips
+
+def patient_view(patient: Dict, unlabeled: bool = False, label: Optional[int] = None,
+                 kind: Optional[str] = None, fields: str = "full"):
+    """
+    A patient as returned by /fetch-csv: clips filtered, and in compact mode
+    only the fields the viewer needs. None if a filter left no clips.
+    """
+    view = {"patientName": patient["patientName"]}
+    if fields == "full":
+        view.update({k: v for k, v in patient.items() if k not in ("dicoms", "apngs")})
+    matched = 0
+    for k in ("dicom", "apng"):
+        clips = filter_clips(patient.get(f"{k}s", []), unlabeled, label) if kind in (None, k) else []
+        if fields == "compact":
+            clips = [{f: clip[f] for f in COMPACT_CLIP_FIELDS if f in clip} for clip in clips]
+        view[f"{k}s"] = clips
+        matched += len(clips)
+    if matched == 0 and (unlabeled or label is not None or kind is not None):
+        return None
+    return view
+
+def patient_summary(patient: Dict):
+    """Per-patient clip counts for /fetch-csv?summary=true"""
+    clips = patient.get("dicoms", []) + patient.get("apngs", [])
+    label_counts = {}
+    for clip in clips:
+        key = str(clip.get("label", 0))
+        label_counts[key] = label_counts.get(key, 0) + 1
+    unlabeled_count = label_counts.get("0", 0)
+    return {
+        "patientName": patient["patientName"],
+        "dicoms": len(patient.get("dicoms", [])),
+        "apngs": len(patient.get("apngs", [])),
+        "labeled": len(clips) - unlabeled_count,
+        "unlabeled": unlabeled_count,
+        "labelCounts": label_counts
+    }
+
 @app.get("/fetch-csv")
-async def fetch_csv(username: str = None):
-    """Fetch CSV data for a specific user or the main CSV if no username is provided"""
+@offload("io", "fetch-csv")
+def fetch_csv(username: str = None, offset: int = 0, limit: Optional[int] = None,
+              unlabeled: bool = False, label: Optional[int] = None, kind: Optional[str] = None,
+              fields: str = "full", summary: bool = False):
+    """
+    Fetch a user's patients and labels.
+
+    Without options this returns every patient with every clip, as before.
+    Optional:
+      - offset / limit: page through patients (after filtering); "total" is the filtered count
+      - unlabeled=true, label=N, kind=dicom|apng: only clips matching, and only patients with any
+      - fields=compact: clips carry just dicomName, label and frameCount
+      - summary=true: per-patient counts instead of clips
+    """
     if not username:
         raise HTTPException(status_code=400, detail="Username parameter is required")
-    
-    # Get path for user's CSV
-    user_csv_path = get_user_csv_path(username)
-    
-    if not os.path.exists(user_csv_path):
-        # If user CSV doesn't exist but main does, copy structure from main but with all labels set to 0
-        if os.path.exists(MAIN_CSV_FILE_PATH):
-            main_patients = load_from_csv(MAIN_CSV_FILE_PATH)
-            # Set all labels to 0
-            for patient in main_patients:
-                for dicom in patient["dicoms"]:
-                    dicom["label"] = 0
-            # Save this clean version to the user's CSV
-            save_to_csv(main_patients, user_csv_path)
-            return {"patients": main_patients}
-        return {"patients": []}
-    
-    # Load from user's CSV
-    return {"patients": load_from_csv(user_csv_path)}
+    if offset < 0 or (limit is not None and limit < 1):
+        raise HTTPException(status_code=400, detail="offset must be >= 0 and limit >= 1")
+    if kind is not None and kind not in ("dicom", "apng"):
+        raise HTTPException(status_code=400, detail=f"Unknown kind: {kind}")
+    if fields not in CSV_FIELD_MODES:
+        raise HTTPException(status_code=400, detail=f"fields must be one of {', '.join(CSV_FIELD_MODES)}")
+
+    patients = load_or_create_user_patients(username)
+
+    views = []
+    for patient in patients:
+        view = patient_view(patient, unlabeled, label, kind, fields)
+        if view is not None:
+            views.append(view)
+    page = views[offset:offset + limit] if limit is not None else views[offset:]
+    response = {"total": len(views), "offset": offset, "limit": limit}
+    if summary:
+        response["patients"] = [patient_summary(view) for view in page]
+    else:
+        response["patients"] = page
+    return response
 
 @app.post("/update-csv")
 async def update_csv(update_request: UpdateRequest):
-    """Update a label in both the main CSV and user-specific CSV"""
+    """
+    Update a label in the user's labels. Updates a user sends in quick
+    succession are coalesced and written together (see LabelWriteCoalescer).
+    """
+    username = update_request.username
+    if not username:
+        raise HTTPException(status_code=400, detail="Username is required")
+
     try:
-        username = update_request.username
-        
-        if not username:
-            raise HTTPException(status_code=400, detail="Username is required")
-        
-        # Get path for user's CSV
-        user_csv_path = get_user_csv_path(username)
-        
-        # Update only the user's CSV
-        user_success = update_csv_with_label(
-            update_request.patientName, 
-            update_request.dicomName, 
-            update_request.label,
-            user_csv_path
-        )
-        
-        return {"success": user_success}
+        # Looks the clip up in the manifest, so off the event loop
+        change = await run_blocking("io", "update-csv", validate_label_update, update_request.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        result = await asyncio.wrap_future(label_writer.submit(username, change))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not result["success"]:
+        raise HTTPException(status_code=500, detail=result["error"])
+    return {"success": True}
+
+@app.post("/update-csv-batch")
+@offload("io", "update-csv")
+def update_csv_batch(request: BatchUpdateRequest):
+    """Apply many label updates with one write; returns a result per update"""
+    if not request.username:
+        raise HTTPException(status_code=400, detail="Username is required")
+    results = set_user_labels(request.username, [update.model_dump() for update in request.updates])
+    return {"success": all(result["success"] for result in results), "results": results}
     
 @app.get("/reset-csv")
-async def reset_csv(username: str = None, delete_all: bool = False):
+@offload("io", "reset-csv")
+def reset_csv(username: str = None, delete_all: bool = False):
     """Delete user's CSV file and optionally all application data"""
     if not username:
         raise HTTPException(status_code=400, detail="Username parameter is required")
     
     try:
-        # Get path for user's CSV
-        user_csv_path = get_user_csv_path(username)
-        
         if delete_all:
             # Delete main CSV, patient mapping, and user accounts if requested
             if os.path.exists(MAIN_CSV_FILE_PATH):
@@ -807,35 +1248,62 @@ async def reset_csv(username: str = None, delete_all: bool = False):
                 os.remove(PATIENT_MAPPING_FILE)
                 print(f"Deleted patient mapping file: {PATIENT_MAPPING_FILE}")
             
+            if os.path.exists(SCAN_INDEX_PATH):
+                os.remove(SCAN_INDEX_PATH)
+                print(f"Deleted scan index file: {SCAN_INDEX_PATH}")
+            
             if os.path.exists(ACCOUNTS_CSV_PATH):
                 os.remove(ACCOUNTS_CSV_PATH)
                 print(f"Deleted accounts CSV file: {ACCOUNTS_CSV_PATH}")
             
-            # Delete all user CSV files
-            for file in os.listdir():
-                if file.startswith("user_") and file.endswith("_labels.csv"):
-                    os.remove(file)
-                    print(f"Deleted user CSV file: {file}")
+            # Delete all user labels (database rows and CSV files)
+            delete_all_user_labels()
                     
             return {"success": True, "message": "All application data has been deleted successfully"}
         
-        # Just delete the user's CSV file
-        if os.path.exists(user_csv_path):
-            os.remove(user_csv_path)
+        # Just delete the user's labels
+        prefetcher.cancel(username)
+        if delete_user_labels(username):
             return {"success": True, "message": f"CSV file for user {username} deleted successfully"}
         
         return {"success": True, "message": f"No CSV file found for user {username}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/export-csv")
+@offload("io", "fetch-csv")
+def export_csv(username: str = None):
+    """Download the user's full label set (every clip of the main CSV with their labels) as a CSV"""
+    if not username:
+        raise HTTPException(status_code=400, detail="Username parameter is required")
+    if not user_labels_exist(username):
+        raise HTTPException(status_code=404, detail=f"No labels found for user {username}")
+    filename = os.path.basename(get_user_csv_path(username))
+    return Response(export_user_csv(username), media_type="text/csv",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/import-csv")
+@offload("io", "update-csv")
+def import_csv(username: str = None):
+    """Replace the user's stored labels with the contents of user_{username}_labels.csv"""
+    if not username:
+        raise HTTPException(status_code=400, detail="Username parameter is required")
+    user_csv_path = get_user_csv_path(username)
+    if not os.path.exists(user_csv_path):
+        raise HTTPException(status_code=404, detail=f"CSV file {user_csv_path} not found")
+    import_user_csv(username)
+    return {"success": True, "patients": len(load_user_patients(username))}
     
 @app.get("/accounts")
-async def get_accounts():
+@offload("io", "accounts")
+def get_accounts():
     """Get all user accounts"""
     accounts = load_accounts()
     return {"accounts": accounts}
 
 @app.post("/accounts")
-async def create_account(request: AccountRequest):
+@offload("io", "accounts")
+def create_account(request: AccountRequest):
     """Create a new user account"""
     username = request.username.strip()
     
@@ -849,7 +1317,8 @@ async def create_account(request: AccountRequest):
     return {"success": True, "username": username}
 
 @app.post("/login")
-async def login(request: LoginRequest):
+@offload("io", "login")
+def login(request: LoginRequest):
     """Login with username"""
     username = request.username.strip()
     accounts = load_accounts()
@@ -860,16 +1329,9 @@ async def login(request: LoginRequest):
         # Auto-create the account if it doesn't exist
         save_account(username)
     
-    # If a main CSV exists but no user-specific CSV, create one with all labels set to 0
-    user_csv_path = get_user_csv_path(username)
-    if os.path.exists(MAIN_CSV_FILE_PATH) and not os.path.exists(user_csv_path):
-        main_patients = load_from_csv(MAIN_CSV_FILE_PATH)
-        # Reset all labels to 0
-        for patient in main_patients:
-            for dicom in patient["dicoms"]:
-                dicom["label"] = 0
-        # Save this clean version to the user's CSV
-        save_to_csv(main_patients, user_csv_path)
+    # New users start with an empty label set over the main CSV
+    if not user_labels_exist(username):
+        create_user_labels(username)
     
     return {"success": True, "username": username}
 
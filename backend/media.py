@@ -0,0 +1,931 @@
+"""
+Decoding of DICOM / APNG clips into browser-ready encoded frames.
+
+A rendered clip is a dict {"frames": [{"mime": str, "data": bytes, ...}]} with
+an optional "error" key. Frames carry raw encoded image bytes; turning them
+into data URIs (or anything else) is up to the caller, which keeps the output
+cacheable (see frame_cache.py).
+
+This module does not import FastAPI, so its functions can run in worker
+processes.
+"""
+import os, io, base64
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import cv2
+import pydicom
+from pydicom.encaps import generate_pixel_data_frame
+try:
+    from pydicom.pixels import apply_modality_lut, apply_voi_lut, apply_color_lut, convert_color_space
+    from pydicom.pixels import iter_pixels, pixel_array as read_pixel_frame
+except ImportError:  # pydicom < 3
+    from pydicom.pixel_data_handlers.util import apply_modality_lut, apply_voi_lut, apply_color_lut, convert_color_space
+    iter_pixels = read_pixel_frame = None
+from PIL import Image
+from apng_reader import read_apng_frames
+from frame_cache import video_cache, cache_key
+
+# Bump when the rendering output changes so stale cache entries are not reused
+RENDER_VERSION = 4
+
+# Encoding profiles: which codec frames are encoded with, and its settings
+ENCODING_PROFILES = {
+    "label": {"codec": "jpeg", "quality": 95},       # full quality for labeling
+    "preview": {"codec": "webp", "quality": 60},     # small payloads for slow links
+    "lossless": {"codec": "png", "compression": 3},
+}
+# Used when a request doesn't name a profile (JPEG for DICOMs, PNG for APNGs as before)
+DEFAULT_PROFILES = {"dicom": "label", "apng": "lossless"}
+_CODECS = {
+    # codec: (file extension for OpenCV, mime type)
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png"),
+}
+
+# pydicom 3 hands out YBR pixel data already converted to RGB
+_PIXEL_ARRAY_IS_RGB = int(pydicom.__version__.split(".")[0]) >= 3
+
+
+def prepare_frame(frame):
+    """Convert a decoded frame into the 3-channel array handed to OpenCV's encoders"""
+    # Ensure frame is in the right format for OpenCV
+    if isinstance(frame, np.ndarray):
+        # Handle different color formats
+        if len(frame.shape) == 2:  # Grayscale
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+        elif frame.shape[2] == 3:  # Already RGB/BGR
+            if frame.dtype != np.uint8:
+                # Normalize and convert to uint8 if not already
+                frame = ((frame - frame.min()) / (frame.max() - frame.min()) * 255).astype(np.uint8)
+            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        else:
+            # Handle other formats as needed
+            frame_rgb = frame
+        return frame_rgb
+    else:
+        raise ValueError("Frame is not a numpy array")
+
+
+def _scale_to_uint8(arr, lo=None, hi=None):
+    """Linearly map [lo, hi] (default: the array's own range) onto 0..255"""
+    lo = float(arr.min()) if lo is None else lo
+    hi = float(arr.max()) if hi is None else hi
+    scale = 255.0 / (hi - lo) if hi > lo else 0.0
+    out = np.subtract(arr, lo, dtype=np.float32)
+    out *= scale
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+# Elements bigger than this stay on disk when a DICOM is opened, so pixel data
+# is only read (or memory-mapped) frame by frame
+DICOM_DEFER_SIZE = 64 * 1024
+_PIXEL_DATA_TAG = 0x7FE00010
+_DEFLATED_TRANSFER_SYNTAX = "1.2.840.10008.1.2.1.99"
+_BIG_ENDIAN_TRANSFER_SYNTAX = "1.2.840.10008.1.2.2"
+
+
+def open_dicom(filepath: str):
+    """Read a DICOM's header; large elements like the pixel data are read when needed"""
+    return pydicom.dcmread(filepath, defer_size=DICOM_DEFER_SIZE)
+
+
+def native_pixel_view(ds, filepath: str):
+    """
+    Read-only (frames, rows, cols[, samples]) view of uncompressed pixel data,
+    memory-mapped from the file so only the frames being read are paged in.
+    None for compressed pixel data, for layouts this doesn't map (bit-packed,
+    YBR 4:2:2, signed values with unused high bits) and with pydicom < 3,
+    which can't leave a deferred element unread.
+    """
+    if read_pixel_frame is None:
+        return None
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if transfer_syntax.is_compressed or transfer_syntax == _DEFLATED_TRANSFER_SYNTAX:
+        return None
+    bits = int(getattr(ds, "BitsAllocated", 0) or 0)
+    signed = int(getattr(ds, "PixelRepresentation", 0) or 0) == 1
+    if bits not in (8, 16, 32) or (signed and int(getattr(ds, "BitsStored", bits) or bits) != bits):
+        return None
+    photometric = str(getattr(ds, "PhotometricInterpretation", "")).strip().upper()
+    if photometric.endswith(("_422", "_420")):
+        return None
+    elem = ds.get_item(_PIXEL_DATA_TAG, keep_deferred=True)
+    if elem is None:
+        return None
+
+    frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    samples = int(getattr(ds, "SamplesPerPixel", 1) or 1)
+    byte_order = ">" if transfer_syntax == _BIG_ENDIAN_TRANSFER_SYNTAX else "<"
+    dtype = np.dtype(f"{byte_order}{'i' if signed else 'u'}{bits // 8}")
+    count = frames * rows * cols * samples
+    if elem.value is not None:
+        # Small enough to have been read with the header
+        if len(elem.value) < count * dtype.itemsize:
+            return None
+        flat = np.frombuffer(elem.value, dtype, count)
+    else:
+        if elem.length < count * dtype.itemsize:
+            return None
+        flat = np.memmap(filepath, dtype, mode="r", offset=elem.value_tell, shape=(count,))
+
+    planar = samples > 1 and int(getattr(ds, "PlanarConfiguration", 0) or 0) == 1
+    if samples == 1:
+        return flat.reshape(frames, rows, cols)
+    if planar:
+        return flat.reshape(frames, samples, rows, cols).transpose(0, 2, 3, 1)
+    return flat.reshape(frames, rows, cols, samples)
+
+
+def voi_lut_bits(ds):
+    """Output bits of the dataset's VOI LUT table, or None if it has none"""
+    items = ds.get("VOILUTSequence")
+    if not items or items[0].get("LUTDescriptor") is None or items[0].get("LUTData") is None:
+        return None
+    return int(items[0].LUTDescriptor[2])
+
+
+def voi_window(ds):
+    """
+    (center, width, function) of the dataset's first VOI window, or None if
+    it has none or it isn't usable (width <= 0)
+    """
+    if ds.get("WindowCenter") is None or ds.get("WindowWidth") is None:
+        return None
+    values = []
+    for keyword in ("WindowCenter", "WindowWidth"):
+        elem = ds[keyword]
+        values.append(float(elem.value[0] if elem.VM > 1 else elem.value))
+    center, width = values
+    if width <= 0:
+        return None
+    return center, width, str(getattr(ds, "VOILUTFunction", "LINEAR") or "LINEAR").strip().upper()
+
+
+class DicomFrames:
+    """
+    The frames of a (non-video) DICOM as a lazy sequence of display-ready
+    uint8 arrays: (rows, cols) for grayscale, (rows, cols, 3) RGB for color.
+
+    Frames are read one at a time: uncompressed pixel data through a
+    memory-mapped view (see native_pixel_view), encapsulated data decoded
+    frame by frame, so memory doesn't grow with the number of frames.
+    pydicom < 3 can do neither, so there clips are still decoded as a whole.
+
+    Every frame gets palette / YBR conversion, modality LUT (rescale
+    slope/intercept) and VOI LUT or window/level, then all frames share one
+    normalization range (see value_range), so brightness doesn't jump
+    between frames. MONOCHROME1 is inverted.
+    """
+
+    def __init__(self, ds, filepath: str):
+        self.ds = ds
+        self.filepath = filepath
+        self.photometric = str(getattr(ds, "PhotometricInterpretation", "MONOCHROME2")).strip().upper()
+        self.samples = int(getattr(ds, "SamplesPerPixel", 1) or 1)
+        self.count = int(getattr(ds, "NumberOfFrames", 1) or 1)
+        self._view = None
+        self._stack = None
+        self._range = None
+        self._voi_failed = False
+        # VOI LUT table first, as pydicom's apply_voi_lut prefers it
+        grayscale = self.samples == 1 and self.photometric != "PALETTE COLOR"
+        self._lut_bits = voi_lut_bits(ds) if grayscale else None
+        self._window = voi_window(ds) if grayscale and self._lut_bits is None else None
+        try:
+            self._view = native_pixel_view(ds, filepath)
+        except Exception as e:
+            print(f"Could not memory-map pixel data of {filepath}: {e}")
+        if self._view is not None:
+            # Raw samples: YBR has to be converted here
+            self._convert_ybr = True
+        elif read_pixel_frame is None:
+            arr = ds.pixel_array
+            self._stack = arr if self.count > 1 else arr[np.newaxis]
+            self.count = len(self._stack)
+            # Compressed YBR is converted to RGB by the decoder; raw YBR isn't
+            self._convert_ybr = not _PIXEL_ARRAY_IS_RGB and not ds.file_meta.TransferSyntaxUID.is_compressed
+        else:
+            # pydicom 3 hands out RGB
+            self._convert_ybr = False
+        if self.count:
+            # Fail here rather than halfway through rendering if the data can't be decoded at all
+            self._raw(0)
+
+    def _raw(self, index: int):
+        if self._view is not None:
+            return self._view[index]
+        if self._stack is not None:
+            return self._stack[index]
+        return read_pixel_frame(self.filepath, index=index)
+
+    def _iter_raw(self):
+        if self._view is None and self._stack is None:
+            yield from iter_pixels(self.filepath)
+        else:
+            for index in range(self.count):
+                yield self._raw(index)
+
+    def _convert(self, arr):
+        """Color conversion and LUTs, before normalization"""
+        if self.photometric == "PALETTE COLOR":
+            return apply_color_lut(arr, self.ds)
+        if self.samples == 3:
+            if self._convert_ybr and self.photometric.startswith("YBR"):
+                arr = convert_color_space(arr, self.photometric, "RGB")
+            return arr
+        arr = apply_modality_lut(arr, self.ds)
+        if self._lut_bits is not None and not self._voi_failed:
+            try:
+                arr = apply_voi_lut(arr, self.ds)
+            except Exception as e:
+                # e.g. a VOI LUT that doesn't fit the rescaled values; fall back to plain normalization
+                print(f"Ignoring VOI LUT: {e}")
+                self._voi_failed = True
+        # A window is applied in _display, straight onto 0..255
+        return arr
+
+    def _metadata_range(self):
+        """The display range if the header gives it, else None"""
+        if self._window is not None:
+            center, width, _ = self._window
+            return center - width / 2, center + width / 2
+        if self._lut_bits is not None and not self._voi_failed:
+            return 0.0, float(2 ** self._lut_bits - 1)
+        if self.photometric == "PALETTE COLOR":
+            return None
+        bits = int(getattr(self.ds, "BitsStored", 0) or 0)
+        signed = int(getattr(self.ds, "PixelRepresentation", 0) or 0) == 1
+        rescaled = self.samples == 1 and (
+            self.ds.get("ModalityLUTSequence") or float(getattr(self.ds, "RescaleSlope", 1) or 1) != 1
+            or float(getattr(self.ds, "RescaleIntercept", 0) or 0) != 0)
+        if 0 < bits <= 8 and not signed and not rescaled:
+            return 0.0, float(2 ** bits - 1)
+        return None
+
+    def value_range(self):
+        """
+        (lo, hi) of the values mapped onto 0..255: the VOI window
+        [center - width/2, center + width/2], the VOI LUT's output range, or
+        the BitsStored range of plain 8-bit data. Anything else uses the
+        (min, max) of all frames after the LUTs, which takes one extra pass
+        over the frames. Computed on first use.
+        """
+        if self._range is None:
+            self._range = self._metadata_range()
+        if self._range is None:
+            lo, hi = float("inf"), float("-inf")
+            for raw in self._iter_raw():
+                arr = self._convert(raw)
+                lo = min(lo, float(arr.min()))
+                hi = max(hi, float(arr.max()))
+            self._range = (lo, hi)
+        return self._range
+
+    def _display(self, arr):
+        if self._window is not None and self._window[2] == "SIGMOID":
+            center, width, _ = self._window
+            out = np.subtract(arr, center, dtype=np.float32)
+            out *= -4.0 / width
+            out = (255.0 / (1.0 + np.exp(out))).astype(np.uint8)
+        else:
+            lo, hi = self.value_range()
+            if arr.dtype == np.uint8 and (lo, hi) == (0, 255) and self.photometric != "MONOCHROME1":
+                return np.ascontiguousarray(arr)
+            out = _scale_to_uint8(arr, lo, hi)
+        if self.photometric == "MONOCHROME1":
+            np.subtract(255, out, out=out)
+        return out
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self._display(self._convert(self._raw(index)))
+
+    def __iter__(self):
+        for raw in self._iter_raw():
+            yield self._display(self._convert(raw))
+
+
+def resolve_profile(kind: str, profile: str = None) -> str:
+    """Name of the encoding profile to use (the kind's default if none is given)"""
+    name = profile or DEFAULT_PROFILES.get(kind, "label")
+    if name not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {name}")
+    return name
+
+
+def encode_image(frame, settings: dict, bgr: bool = False):
+    """
+    Encode a frame (numpy array) with the given profile settings. Returns
+    (bytes, mime). Color frames are RGB(A) unless bgr is set (frames straight
+    from OpenCV); grayscale frames stay single-channel. Alpha is kept for
+    PNG and WebP and dropped for JPEG.
+    """
+    codec = settings["codec"]
+    if frame.dtype != np.uint8:
+        frame = prepare_frame(frame)   # gives BGR-ordered uint8
+        bgr = True
+    if frame.ndim == 3 and frame.shape[2] == 3 and not bgr:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    elif frame.ndim == 3 and frame.shape[2] == 4:
+        if codec == "jpeg":
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR if bgr else cv2.COLOR_RGBA2BGR)
+        elif not bgr:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGRA)
+
+    if codec == "jpeg":
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(settings.get("quality", 95))]
+    elif codec == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(settings.get("quality", 80))]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(settings.get("compression", 3))]
+    extension, mime = _CODECS[codec]
+    ok, buffer = cv2.imencode(extension, frame, params)
+    if not ok:
+        raise RuntimeError(f"Could not encode frame as {codec}")
+    return buffer.tobytes(), mime
+
+
+def to_data_uri(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def is_video_dicom(ds) -> bool:
+    """Is this an MPEG-4 encapsulated (video) DICOM?"""
+    if hasattr(ds.file_meta, 'TransferSyntaxUID'):
+        ts_uid = str(ds.file_meta.TransferSyntaxUID)
+        if ts_uid == '1.2.840.10008.1.2.4.102' or 'MPEG-4' in ds.file_meta.TransferSyntaxUID.name:
+            return True
+    return False
+
+
+def extract_video_bitstream(ds) -> bytes:
+    """The embedded MP4 bitstream of an MPEG-4 encapsulated DICOM"""
+    return next(generate_pixel_data_frame(ds.PixelData))
+
+
+# Cache parameters of an MPEG-4 DICOM's extracted MP4 in the video cache
+VIDEO_PASSTHROUGH_PARAMS = {"video": "passthrough"}
+
+
+def video_bitstream(filepath: str, ds=None) -> bytes:
+    """
+    extract_video_bitstream of a file, through the on-disk video cache. The
+    MP4 is stored under the same key /fetch-clip-video serves it from, so it
+    is extracted once and shared by every decode worker.
+    """
+    key = cache_key(filepath, VIDEO_PASSTHROUGH_PARAMS)
+    data = video_cache.read(key, ".mp4") if key is not None else None
+    if data is None:
+        data = extract_video_bitstream(ds if ds is not None else open_dicom(filepath))
+        if key is not None:
+            try:
+                video_cache.write(key, data, ".mp4")
+            except OSError as e:
+                print(f"Could not cache the video stream of {filepath}: {e}")
+    return data
+
+
+def _stream_capture_supported() -> bool:
+    """Can OpenCV's FFmpeg backend read from a Python file object (OpenCV >= 4.10)?"""
+    try:
+        return cv2.CAP_FFMPEG in cv2.videoio_registry.getStreamBufferedBackends()
+    except AttributeError:
+        return False
+
+
+_STREAM_CAPTURE = _stream_capture_supported()
+
+
+@contextmanager
+def open_video(bitstream: bytes):
+    """
+    A cv2.VideoCapture reading an MP4 bitstream from memory: through
+    OpenCV's stream API when available, else from an anonymous RAM-backed
+    file (memfd, Linux). A temp file on disk is the last resort.
+    """
+    cap = stream = fd = tmp_path = None
+    try:
+        if _STREAM_CAPTURE:
+            stream = io.BytesIO(bitstream)
+            cap = cv2.VideoCapture(stream, cv2.CAP_FFMPEG, [])
+        elif hasattr(os, "memfd_create"):
+            fd = os.memfd_create("dicom-video")
+            with open(fd, "wb", closefd=False) as f:
+                f.write(bitstream)
+            cap = cv2.VideoCapture(f"/proc/self/fd/{fd}")
+        else:
+            with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+                temp_file.write(bitstream)
+                tmp_path = temp_file.name
+            cap = cv2.VideoCapture(tmp_path)
+        if not cap.isOpened():
+            raise RuntimeError("Could not open video from DICOM")
+        yield cap
+    finally:
+        if cap is not None:
+            cap.release()
+        if fd is not None:
+            os.close(fd)
+        if tmp_path is not None:
+            os.remove(tmp_path)
+
+
+def read_video_frames(bitstream: bytes, start: int = 0, end: int = None, stride: int = 1):
+    """
+    Decode frames start:end:stride of an MP4 bitstream into BGR arrays,
+    seeking to start rather than decoding everything before it. Returns
+    (frames, frame_count); the count is exact when the stream was read to its
+    end, otherwise it's the container's.
+    """
+    frames = []
+    with open_video(bitstream) as cap:
+        count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0), 0)
+        if count and start >= count:
+            return [], count
+        index = 0
+        if start > 0 and count:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            index = start
+        while index < start:
+            # No frame count to seek with; skip frames without converting them
+            if not cap.grab():
+                return [], index
+            index += 1
+        while end is None or index < end:
+            if (index - start) % stride:
+                ok = cap.grab()
+            else:
+                ok, frame = cap.read()
+                if ok:
+                    frames.append(frame)
+            if not ok:
+                return frames, index
+            index += 1
+    return frames, max(count, index)
+
+
+def decode_dicom(filepath: str, name: str = "") -> dict:
+    """
+    Decode a DICOM into frame arrays: {"frames": [...], "bgr": bool}.
+    Frames are RGB / grayscale uint8, or BGR when they come from the video
+    decoder. For other DICOMs "frames" is a DicomFrames, which reads frames
+    as they are used. Frame-level decode problems give an empty frame list;
+    an unreadable file gives an "error" as well.
+    """
+    try:
+        ds = open_dicom(filepath)
+        video = is_video_dicom(ds)
+    except Exception as e:
+        print(f"Error reading DICOM: {e}")
+        return {"frames": [], "bgr": False, "error": str(e)}
+
+    frames = []
+    if video:
+        print(f"Processing video DICOM: {name}")
+        try:
+            frames, _ = read_video_frames(video_bitstream(filepath, ds))
+        except Exception as video_error:
+            print(f"Error extracting video frames: {video_error}")
+            frames = []
+        return {"frames": frames, "bgr": True}
+
+    # Standard non-video DICOMs, read frame by frame
+    try:
+        frames = DicomFrames(ds, filepath)
+    except Exception as pixel_error:
+        print(f"Error processing pixel data: {pixel_error}")
+        frames = []
+    return {"frames": frames, "bgr": False}
+
+
+def decode_apng(filepath: str, name: str = "") -> dict:
+    """
+    Split an APNG into its frames as RGB(A) / grayscale arrays, with the
+    original per-frame delays: {"frames": [...], "delays": [ms], "bgr": False}.
+    Frames that fail to decode are skipped.
+    """
+    try:
+        apng_frames = read_apng_frames(filepath)
+    except Exception as e:
+        print(f"Error reading APNG {filepath}: {e}")
+        return {"frames": [], "delays": [], "bgr": False, "error": str(e)}
+
+    frames = []
+    delays = []
+    for apng_frame in apng_frames:
+        try:
+            pil_img = Image.open(io.BytesIO(apng_frame.png))
+            if pil_img.mode not in ("RGB", "RGBA", "L"):
+                pil_img = pil_img.convert("RGBA")
+            frame = np.asarray(pil_img)
+        except Exception as frame_err:
+            print(f"Error decoding APNG frame for {name}: {frame_err}")
+            continue
+        frames.append(frame)
+        delays.append(apng_frame.delay_ms)
+
+    return {"frames": frames, "delays": delays, "bgr": False}
+
+
+def apng_passthrough(profile: str = None, max_size: int = None, crop: bool = False) -> bool:
+    """
+    Can an APNG rendering use its frames' PNG data as-is? Yes for a PNG
+    profile (the APNG default) without downscaling or cropping.
+    """
+    return not max_size and not crop and ENCODING_PROFILES[resolve_profile("apng", profile)]["codec"] == "png"
+
+
+def render_apng_passthrough(filepath: str, name: str = "") -> dict:
+    """
+    An APNG's frames as the standalone PNGs read_apng_frames builds: the
+    compressed data is copied, never decoded and re-encoded.
+    """
+    try:
+        apng_frames = read_apng_frames(filepath)
+    except Exception as e:
+        print(f"Error reading APNG {filepath}: {e}")
+        return {"frames": [], "error": str(e)}
+    return {"frames": [{"mime": "image/png", "data": frame.png, "delayMs": frame.delay_ms}
+                       for frame in apng_frames]}
+
+
+def decode_clip(kind: str, filepath: str, name: str = "") -> dict:
+    """Decode a clip of the given kind ("dicom" or "apng") into frame arrays"""
+    if kind == "apng":
+        return decode_apng(filepath, name)
+    return decode_dicom(filepath, name)
+
+
+def fit_size(frame, max_size: int = None):
+    """Downscale a frame so its longer edge is at most max_size (never upscales)"""
+    if not max_size:
+        return frame
+    height, width = frame.shape[:2]
+    scale = max_size / float(max(height, width))
+    if scale >= 1:
+        return frame
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+# ----- Sector ROI cropping -----
+ROI_SAMPLE_FRAMES = 32   # frames sampled (evenly) for the projections
+ROI_MARGIN = 4           # pixels kept around the detected sector
+
+
+def _gray(frame):
+    if frame.ndim == 3:
+        return cv2.cvtColor(np.ascontiguousarray(frame[..., :3]), cv2.COLOR_RGB2GRAY)
+    return frame
+
+
+def detect_roi(frames):
+    """
+    Bounding box (x, y, width, height) of the active ultrasound sector, or
+    None if there is nothing worth cropping.
+
+    The sector is where the image changes over the clip (standard deviation
+    projection); static black borders and burned-in UI chrome don't. For
+    single-frame clips the max projection is used instead, which only drops
+    the black borders. The mask is cleaned up morphologically and the
+    largest connected region wins, so blinking overlays such as timestamps
+    don't widen the box.
+    """
+    if not frames:
+        return None
+    height, width = frames[0].shape[:2]
+    # DICOM frames always share one size; APNG sub-frames at offsets may not
+    if not isinstance(frames, DicomFrames) and any(frame.shape[:2] != (height, width) for frame in frames):
+        return None
+
+    step = max(1, len(frames) // ROI_SAMPLE_FRAMES)
+    stack = np.stack([_gray(frame) for frame in frames[::step]]).astype(np.float32)
+    if len(stack) > 1:
+        mask = stack.std(axis=0) > 2.0
+    else:
+        mask = stack[0] > 10
+    mask = mask.astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if count <= 1:
+        return None
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    x, y, w, h = (int(v) for v in stats[largest, :4])
+    if w * h < 0.05 * width * height:
+        return None   # too small to be the sector; don't trust it
+    x0, y0 = max(0, x - ROI_MARGIN), max(0, y - ROI_MARGIN)
+    x1, y1 = min(width, x + w + ROI_MARGIN), min(height, y + h + ROI_MARGIN)
+    if (x1 - x0) * (y1 - y0) > 0.95 * width * height:
+        return None   # cropping would save next to nothing
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def encode_clip(kind: str, decoded: dict, profile: str = None, max_size: int = None, name: str = "",
+                roi=None) -> dict:
+    """
+    Encode decoded frames with an encoding profile, optionally cropped to
+    roi (x, y, width, height) and downscaled. A DICOM frame that fails to
+    encode empties the clip (as a failed decode would); a bad APNG frame is
+    skipped. Frames are consumed one at a time, so lazily decoded frames
+    (DicomFrames) are never all in memory.
+    """
+    settings = ENCODING_PROFILES[resolve_profile(kind, profile)]
+    delays = decoded.get("delays") or []
+    frames = []
+    source_height = source_width = 0
+    try:
+        for i, array in enumerate(decoded["frames"]):
+            if i == 0:
+                source_height, source_width = array.shape[:2]
+            if roi is not None:
+                x, y, w, h = roi
+                array = np.ascontiguousarray(array[y:y + h, x:x + w])
+            try:
+                data, mime = encode_image(fit_size(array, max_size), settings, decoded["bgr"])
+            except Exception as e:
+                print(f"Error encoding frame {i} of {name}: {e}")
+                if kind == "apng":
+                    continue
+                frames = []
+                break
+            frame = {"mime": mime, "data": data}
+            if i < len(delays) and delays[i] is not None:
+                frame["delayMs"] = delays[i]
+            frames.append(frame)
+    except Exception as e:
+        # A DICOM frame that can't be decoded halfway through the clip
+        print(f"Error decoding frames of {name}: {e}")
+        frames = []
+
+    result = {"frames": frames}
+    if roi is not None and frames:
+        x, y, w, h = roi
+        result["roi"] = {"x": x, "y": y, "width": w, "height": h,
+                         "sourceWidth": source_width, "sourceHeight": source_height}
+    if "error" in decoded:
+        result["error"] = decoded["error"]
+    return result
+
+
+def render_clip(kind: str, filepath: str, name: str = "", profile: str = None, max_size: int = None,
+                crop: bool = False) -> dict:
+    """
+    Render a clip of the given kind ("dicom" or "apng") with an encoding
+    profile. max_size downscales the frames (preview mode); crop cuts every
+    frame down to the detected sector (see detect_roi), reported as "roi".
+    APNGs in a PNG profile keep their original frame data (see apng_passthrough).
+    """
+    if kind == "apng" and apng_passthrough(profile, max_size, crop):
+        return render_apng_passthrough(filepath, name)
+    decoded = decode_clip(kind, filepath, name)
+    roi = detect_roi(decoded["frames"]) if crop else None
+    return encode_clip(kind, decoded, profile, max_size, name, roi)
+
+
+def render_frame_range(kind: str, filepath: str, name: str = "", profile: str = None, max_size: int = None,
+                       start: int = 0, end: int = None, stride: int = 1) -> dict:
+    """
+    Render only frames start:end:stride of a DICOM: video DICOMs seek in the
+    stream, others read just those frames (see DicomFrames). The frames are
+    the same as in the full rendering; "frameCount" is the whole clip's.
+    """
+    try:
+        ds = open_dicom(filepath)
+        if is_video_dicom(ds):
+            frames, count = read_video_frames(video_bitstream(filepath, ds), start, end, stride)
+            decoded = {"frames": frames, "bgr": True}
+        else:
+            frames = DicomFrames(ds, filepath)
+            count = len(frames)
+            decoded = {"frames": frames[start:end:stride], "bgr": False}
+    except Exception as e:
+        print(f"Error decoding frames {start}:{end}:{stride} of {name}: {e}")
+        return {"frames": [], "frameCount": 0, "error": str(e)}
+    result = encode_clip(kind, decoded, profile, max_size, name)
+    result["frameCount"] = count
+    return result
+
+
+def frame_range_params(kind: str, profile: str = None, max_size: int = None,
+                       start: int = 0, end: int = None, stride: int = 1) -> dict:
+    """Parameters that identify a rendered frame range in the frame cache"""
+    return dict(render_params(kind, profile, max_size), frames=[start, end, stride])
+
+
+def render_params(kind: str, profile: str = None, max_size: int = None, crop: bool = False) -> dict:
+    """Parameters that identify a rendering in the frame cache"""
+    name = resolve_profile(kind, profile)
+    params = {"kind": kind, "version": RENDER_VERSION, "profile": name, "encoding": ENCODING_PROFILES[name]}
+    if max_size:
+        params["maxSize"] = max_size
+    if crop:
+        params["crop"] = True
+    if kind == "apng" and apng_passthrough(profile, max_size, crop):
+        params["passthrough"] = True
+    return params
+
+
+# ----- Previews and thumbnails -----
+PREVIEW_MAX_SIZE = int(os.environ.get("ECHO_PREVIEW_MAX_SIZE", "256"))
+THUMBNAIL_SIZE = int(os.environ.get("ECHO_THUMBNAIL_SIZE", "128"))
+
+
+def render_options(profile: str = None, preview: bool = False):
+    """
+    (profile, max_size) for a request. Preview mode downscales frames to
+    PREVIEW_MAX_SIZE and uses the "preview" profile unless one is named.
+    """
+    if not preview:
+        return profile, None
+    return profile or "preview", PREVIEW_MAX_SIZE
+
+
+def pick_keyframe(frames) -> int:
+    """
+    Index of a representative frame: the one closest to the clip's mean image,
+    i.e. a typical frame rather than a transition or a blank one.
+    """
+    if len(frames) <= 2:
+        return 0
+    small = [cv2.resize(_gray(frame), (32, 32), interpolation=cv2.INTER_AREA) for frame in frames]
+    small = np.stack(small).astype(np.float32)
+    distances = ((small - small.mean(axis=0)) ** 2).reshape(len(frames), -1).sum(axis=1)
+    return int(np.argmin(distances))
+
+
+def render_thumbnail(kind: str, filepath: str, name: str = "", profile: str = None,
+                     size: int = THUMBNAIL_SIZE, crop: bool = False) -> dict:
+    """
+    A single downscaled keyframe of a clip (see pick_keyframe), encoded with
+    the "preview" profile unless another is given. Returns
+    {"frames": [frame], "keyframe": index, "frameCount": n}.
+    """
+    decoded = decode_clip(kind, filepath, name)
+    frames = decoded["frames"]
+    result = {"frames": [], "keyframe": 0, "frameCount": len(frames)}
+    if "error" in decoded:
+        result["error"] = decoded["error"]
+    if not frames:
+        return result
+    keyframe = pick_keyframe(frames)
+    roi = detect_roi(frames) if crop else None
+    single = {"frames": [frames[keyframe]], "bgr": decoded["bgr"]}
+    encoded = encode_clip(kind, single, profile or "preview", size, name, roi)
+    result["frames"] = encoded["frames"]
+    result["keyframe"] = keyframe
+    if "roi" in encoded:
+        result["roi"] = encoded["roi"]
+    return result
+
+
+def thumbnail_params(kind: str, profile: str = None, size: int = THUMBNAIL_SIZE, crop: bool = False) -> dict:
+    """Parameters that identify a thumbnail in the frame cache"""
+    return dict(render_params(kind, profile or "preview", size, crop), thumbnail=True)
+
+
+def frames_to_images(name: str, frames, indices=None) -> list:
+    """
+    Turn rendered frames into the {"id", "src"} image objects the viewer expects.
+    indices are the frames' positions in the full clip (default 0, 1, 2, ...);
+    ids are 1-based, e.g. "clip.dcm-1".
+    """
+    if indices is None:
+        indices = range(len(frames))
+    images = []
+    for index, frame in zip(indices, frames):
+        image = {"id": f"{name}-{index + 1}", "src": to_data_uri(frame["data"], frame["mime"])}
+        if "delayMs" in frame:
+            image["delayMs"] = frame["delayMs"]
+        images.append(image)
+    return images
+
+
+# ----- Video delivery -----
+VIDEO_CONTAINERS = {
+    # container: (mime type, fourcc codes to try in order)
+    "webm": ("video/webm", ["VP80", "VP90"]),
+    "mp4": ("video/mp4", ["avc1", "mp4v"]),
+}
+DEFAULT_FPS = 30.0
+
+
+def dicom_frame_rate(ds, default: float = DEFAULT_FPS) -> float:
+    """Playback rate of a multi-frame DICOM from CineRate / RecommendedDisplayFrameRate / FrameTime"""
+    for keyword in ("CineRate", "RecommendedDisplayFrameRate"):
+        try:
+            value = float(getattr(ds, keyword, 0) or 0)
+        except (TypeError, ValueError):
+            value = 0
+        if value > 0:
+            return value
+    try:
+        frame_time = float(getattr(ds, "FrameTime", 0) or 0)  # milliseconds
+    except (TypeError, ValueError):
+        frame_time = 0
+    return 1000.0 / frame_time if frame_time > 0 else default
+
+
+def _to_video_frame(frame, bgr: bool = False):
+    """BGR uint8 frame for cv2.VideoWriter (frames from OpenCV are already BGR)"""
+    if not bgr:
+        frame = prepare_frame(frame)
+    if frame.dtype != np.uint8:
+        frame = ((frame - frame.min()) / max(float(frame.max() - frame.min()), 1e-6) * 255).astype(np.uint8)
+    if frame.ndim == 2:
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    elif frame.shape[2] == 4:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+    return frame
+
+
+def write_video(frames, fps: float, out_path: str, container: str = "webm", bgr: bool = False):
+    """
+    Encode an iterable of frames into a video file. Frames are resized to the
+    first frame's size if they differ. Raises if no usable codec is available
+    in this OpenCV build or if there were no frames.
+    """
+    writer = None
+    size = None
+    count = 0
+    try:
+        for frame in frames:
+            frame = _to_video_frame(frame, bgr)
+            if writer is None:
+                size = (frame.shape[1], frame.shape[0])
+                for code in VIDEO_CONTAINERS[container][1]:
+                    writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*code), fps, size)
+                    if writer.isOpened():
+                        break
+                    writer.release()
+                    writer = None
+                if writer is None:
+                    raise RuntimeError(f"No {container} video encoder available in this OpenCV build")
+            if (frame.shape[1], frame.shape[0]) != size:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            writer.write(frame)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    if count == 0:
+        raise ValueError("No frames to encode")
+
+
+def _iter_apng_canvas(apng_frames):
+    """APNG frames composited onto a canvas the size of the first frame (offsets honoured)"""
+    canvas = None
+    for apng_frame in apng_frames:
+        frame = cv2.imdecode(np.frombuffer(apng_frame.png, np.uint8), cv2.IMREAD_COLOR)  # BGR
+        if frame is None:
+            continue
+        if canvas is None:
+            canvas = frame.copy()
+        else:
+            x, y = apng_frame.x_offset, apng_frame.y_offset
+            h = min(frame.shape[0], canvas.shape[0] - y)
+            w = min(frame.shape[1], canvas.shape[1] - x)
+            if h > 0 and w > 0:
+                canvas[y:y + h, x:x + w] = frame[:h, :w]
+        yield canvas
+
+
+def _apng_frame_rate(apng_frames, default: float = DEFAULT_FPS) -> float:
+    delays = [frame.delay_ms / 1000.0 for frame in apng_frames if frame.delay_ms]
+    return len(delays) / sum(delays) if delays and sum(delays) > 0 else default
+
+
+def transcode_clip(kind: str, filepath: str, out_path: str, container: str = "webm"):
+    """Transcode a multi-frame DICOM or an APNG into a video file"""
+    if kind == "apng":
+        apng_frames = read_apng_frames(filepath)
+        write_video(_iter_apng_canvas(apng_frames), _apng_frame_rate(apng_frames), out_path, container, bgr=True)
+        return
+    ds = open_dicom(filepath)
+    if is_video_dicom(ds):
+        # Re-encode the embedded stream (e.g. when WebM was asked for)
+        with open_video(video_bitstream(filepath, ds)) as cap:
+            fps = cap.get(cv2.CAP_PROP_FPS) or dicom_frame_rate(ds)
+
+            def video_frames():
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    yield frame
+            write_video(video_frames(), fps, out_path, container, bgr=True)
+        return
+    write_video(DicomFrames(ds, filepath), dicom_frame_rate(ds), out_path, container)
@@ -0,0 +1,218 @@
+"""
+Offline pre-rendering of the whole archive into the frame cache.
+
+Walks the main CSV (patient_dicom_labels.csv) and renders every DICOM and
+APNG with the same functions and cache keys as /fetch-patient-dicoms, writing
+the results to the on-disk frame cache. Run it after a scan, e.g. overnight;
+the default main CSV and the cache directory are the server's (relative to
+the backend folder), wherever it is started from:
+
+    python prerender.py                      # full-size frames, default profiles
+    python prerender.py --preview --thumbnails
+    python prerender.py --profile lossless --workers 4
+
+It is resumable: clips whose cache entry is already on disk are skipped (the
+cache key covers the file's size and mtime, so edited files are rendered
+again). Clips that failed are remembered in a state file and skipped on the
+next run unless --retry-failed is given.
+
+This module does not import main.py (or FastAPI).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from media import (render_clip, render_params, render_thumbnail, thumbnail_params, render_options,
+                   ENCODING_PROFILES, THUMBNAIL_SIZE)
+from frame_cache import FrameCache, FRAME_CACHE_DIR, FRAME_CACHE_DISK_MB, cache_key, clip_size
+from label_store import MANIFEST_CSV_PATH, load_from_csv
+from workers import DECODE_WORKERS
+
+# ----- Configuration -----
+# Clips that failed to render, so reruns don't retry them every night
+PRERENDER_STATE_PATH = os.environ.get("ECHO_PRERENDER_STATE_PATH", "prerender_state.json")
+PRERENDER_PROGRESS_INTERVAL = float(os.environ.get("ECHO_PRERENDER_PROGRESS_INTERVAL", "10"))  # seconds
+
+
+def manifest_clips(csv_path: str):
+    """(kind, filepath, name) of every clip in the main CSV, in patient order"""
+    clips = []
+    for patient in load_from_csv(csv_path):
+        for kind in ("dicom", "apng"):
+            for entry in patient.get(f"{kind}s", []):
+                if entry.get("filepath"):
+                    clips.append((kind, entry["filepath"], entry["dicomName"]))
+    return clips
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {"failures": {}}
+    state.setdefault("failures", {})
+    return state
+
+
+def save_state(path: str, state: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+class PrerenderStats:
+    """Counters and throughput of one run"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.missing = 0
+        self.failed_before = 0   # skipped, failed on an earlier run
+        self.bytes = 0
+        self.started_at = time.time()
+
+    @property
+    def done(self) -> int:
+        return self.rendered + self.skipped + self.failed + self.missing + self.failed_before
+
+    def line(self) -> str:
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return (f"{self.done}/{self.total} clips | rendered {self.rendered} ({self.rendered / elapsed:.2f}/s, "
+                f"{self.bytes / elapsed / 1e6:.1f} MB/s) | skipped {self.skipped} | "
+                f"failed {self.failed} (+{self.failed_before} from earlier runs) | missing {self.missing} | "
+                f"{elapsed:.0f}s")
+
+
+def prerender(clips, cache: FrameCache, profile: str = None, max_size: int = None, crop: bool = False,
+              thumbnails: bool = False, workers: int = DECODE_WORKERS, state_path: str = PRERENDER_STATE_PATH,
+              retry_failed: bool = False) -> PrerenderStats:
+    """
+    Render clips into the cache in parallel. With thumbnails=True the keyframe
+    thumbnails of /patient-thumbnails are rendered as well.
+    """
+    state = load_state(state_path)
+    failures = state["failures"]
+
+    jobs = []
+    for kind, filepath, name in clips:
+        jobs.append((render_clip, render_params(kind, profile, max_size, crop), kind, filepath, name, max_size))
+        if thumbnails:
+            jobs.append((render_thumbnail, thumbnail_params(kind, profile, THUMBNAIL_SIZE, crop),
+                         kind, filepath, name, THUMBNAIL_SIZE))
+    stats = PrerenderStats(len(jobs))
+
+    # Only a couple of tasks per worker in flight, so finished clips don't
+    # pile up in memory before they're written out
+    max_pending = max(1, workers) * 2
+    pending = {}
+    last_report = [time.time()]
+
+    def report():
+        if time.time() - last_report[0] >= PRERENDER_PROGRESS_INTERVAL:
+            print(stats.line())
+            save_state(state_path, state)
+            last_report[0] = time.time()
+
+    def collect(futures):
+        for future in futures:
+            key, filepath, name = pending.pop(future)
+            try:
+                clip = future.result()
+            except Exception as e:
+                clip = {"frames": [], "error": str(e)}
+            if clip["frames"] and "error" not in clip:
+                cache.put(key, clip)
+                failures.pop(key, None)
+                stats.rendered += 1
+                stats.bytes += clip_size(clip)
+            else:
+                error = clip.get("error", "No frames")
+                print(f"Failed to render {name} ({filepath}): {error}")
+                failures[key] = {"file": filepath, "name": name, "error": error}
+                stats.failed += 1
+            report()
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for render, params, kind, filepath, name, size in jobs:
+            key = cache_key(filepath, params)
+            if key is None:
+                stats.missing += 1
+                continue
+            if cache.contains(key):
+                stats.skipped += 1
+                continue
+            if key in failures and not retry_failed:
+                stats.failed_before += 1
+                continue
+            while len(pending) >= max_pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            pending[pool.submit(render, kind, filepath, name, profile, size, crop)] = (key, filepath, name)
+            report()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    except KeyboardInterrupt:
+        print("Interrupted; run again to resume")
+    finally:
+        # On Ctrl+C, keep what was rendered so far; the next run resumes from there
+        pool.shutdown(wait=False, cancel_futures=True)
+        save_state(state_path, state)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-render every clip of the main CSV into the frame cache")
+    parser.add_argument("--manifest", default=None, help=f"main CSV to read clips from (default: {MANIFEST_CSV_PATH})")
+    parser.add_argument("--profile", choices=list(ENCODING_PROFILES), default=None,
+                        help="encoding profile (default: each kind's default, as the viewer uses)")
+    parser.add_argument("--preview", action="store_true", help="render downscaled preview frames")
+    parser.add_argument("--crop", action="store_true", help="render frames cropped to the ultrasound sector")
+    parser.add_argument("--thumbnails", action="store_true", help="also render keyframe thumbnails")
+    parser.add_argument("--workers", type=int, default=DECODE_WORKERS, help="decode processes")
+    parser.add_argument("--state", default=None, help=f"file remembering failed clips (default: {PRERENDER_STATE_PATH})")
+    parser.add_argument("--retry-failed", action="store_true", help="retry clips that failed on earlier runs")
+    args = parser.parse_args(argv)
+
+    # Resolve the user's paths first, then work from the backend folder so the
+    # cache directory is the one the server uses
+    manifest = os.path.abspath(args.manifest) if args.manifest else None
+    state_path = os.path.abspath(args.state) if args.state else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    manifest = manifest or os.path.abspath(MANIFEST_CSV_PATH)
+    state_path = state_path or os.path.abspath(PRERENDER_STATE_PATH)
+
+    if FRAME_CACHE_DISK_MB <= 0:
+        print("The on-disk frame cache is disabled (ECHO_FRAME_CACHE_DISK_MB=0); nothing to pre-render into")
+        return 1
+    # Disk tier only: the clips are for the server, not this process
+    cache = FrameCache(0, FRAME_CACHE_DIR, FRAME_CACHE_DISK_MB * 1024 * 1024)
+
+    clips = manifest_clips(manifest)
+    if not clips:
+        print(f"No clips found in {manifest}")
+        return 1
+    profile, max_size = render_options(args.profile, args.preview)
+    print(f"Pre-rendering {len(clips)} clips from {manifest} into {os.path.abspath(FRAME_CACHE_DIR)} "
+          f"with {args.workers} workers")
+
+    stats = prerender(clips, cache, profile, max_size, args.crop, args.thumbnails,
+                      args.workers, state_path, args.retry_failed)
+    print(f"Done: {stats.line()}")
+    if cache.disk.evictions:
+        print(f"Warning: {cache.disk.evictions} cache entries were evicted; the archive doesn't fit in "
+              f"ECHO_FRAME_CACHE_DISK_MB={FRAME_CACHE_DISK_MB}")
+    return 1 if stats.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+"""
+Directory scanning for the labeler backend.
+
+Walks the Butterfly / Vave / Butterfly 2 source roots and probes every file to
+decide whether it is a DICOM or an APNG cine loop. Per-file probing is fanned
+out over a process (or thread) pool and the source roots are walked at the same
+time, which matters a lot on network-mounted archives.
+
+Everything in this module is importable without FastAPI so the probe functions
+can be pickled into worker processes.
+"""
+import os
+import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pydicom
+from apng import APNG
+from apng_reader import apng_num_frames
+
+# ----- Configuration -----
+# Number of probe workers (0 = one per CPU core)
+SCAN_WORKERS = int(os.environ.get("ECHO_SCAN_WORKERS", "0")) or (os.cpu_count() or 4)
+# "process" for a process pool, "thread" for a thread pool (better for slow NFS mounts)
+SCAN_EXECUTOR = os.environ.get("ECHO_SCAN_EXECUTOR", "process")
+# Files sent to a worker per task; keeps inter-process overhead low
+SCAN_CHUNK_SIZE = int(os.environ.get("ECHO_SCAN_CHUNK_SIZE", "64"))
+# Persistent per-file metadata index used for incremental rescans
+SCAN_INDEX_PATH = os.environ.get("ECHO_SCAN_INDEX_PATH", "scan_index.json")
+# Bump when probing changes, so entries from older scans are re-probed
+SCAN_INDEX_VERSION = 2   # 2: APNG frame counts read from acTL
+
+# Marker for walk entries whose probe result has to come from the pool
+_PENDING = object()
+
+
+class ScanCancelled(Exception):
+    """Raised inside a scan when its ScanProgress has been cancelled."""
+
+
+class ScanProgress:
+    """
+    Thread-safe progress counters for a running scan, plus a cancel flag.
+
+    The walker threads count files as they are listed, and probe results are
+    counted as pool tasks complete, so snapshot() reflects live progress.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self.files_seen = 0
+        self.dicoms_found = 0
+        self.apngs_found = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def add(self, files: int = 0, probes=()):
+        with self._lock:
+            self.files_seen += files
+            for probe in probes:
+                if probe is None:
+                    continue
+                if probe[0] == "apng":
+                    self.apngs_found += 1
+                else:
+                    self.dicoms_found += 1
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check(self):
+        """Raise ScanCancelled if the scan has been cancelled."""
+        if self._cancel.is_set():
+            raise ScanCancelled()
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            return {
+                "filesSeen": self.files_seen,
+                "dicomsFound": self.dicoms_found,
+                "apngsFound": self.apngs_found,
+                "elapsedSeconds": round(elapsed, 2),
+                "filesPerSecond": round(self.files_seen / elapsed, 1) if elapsed > 0 else 0.0
+            }
+
+
+def is_apng_file(path: str) -> bool:
+    """
+    Fast APNG check: PNG signature + an 'acTL' chunk before the image data.
+    Falls back to APNG.open() if needed.
+    """
+    try:
+        return apng_num_frames(path) is not None
+    except Exception:
+        # Last resort: try parsing
+        try:
+            APNG.open(path)
+            return True
+        except Exception:
+            return False
+
+
+def apng_frame_count(path: str) -> int:
+    """Frame count from the acTL chunk; the frames themselves aren't parsed"""
+    try:
+        return max(1, apng_num_frames(path) or 0)
+    except Exception:
+        return 1
+
+
+def probe_file(filepath: str):
+    """
+    Work out what a single file is.
+
+    Returns ("apng", frame_count) or ("dicom", frame_count), or None when the
+    file is neither (plain PNGs, thumbnails, reports, ...).
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+
+    # 1) APNG path (accept .apng or .png that truly has acTL)
+    if ext in (".apng", ".png"):
+        try:
+            if is_apng_file(filepath):
+                return ("apng", apng_frame_count(filepath))
+        except Exception as e:
+            print(f"Error checking APNG {filepath}: {e}")
+        # Plain PNGs are skipped, we only include APNGs
+        return None
+
+    # 2) DICOM path (many DICOMs have no extension; try read unless definitely APNG)
+    try:
+        ds = pydicom.dcmread(filepath, stop_before_pixels=True)
+        if not hasattr(ds, 'SOPClassUID'):
+            # Not a valid DICOM; skip
+            return None
+        frame_count = int(ds.NumberOfFrames) if hasattr(ds, 'NumberOfFrames') else 1
+    except Exception:
+        # Not APNG, not DICOM -> skip
+        return None
+    return ("dicom", frame_count)
+
+
+def probe_files(filepaths):
+    """Probe a batch of files (one pool task)."""
+    return [probe_file(filepath) for filepath in filepaths]
+
+
+def load_scan_index(index_path: str = SCAN_INDEX_PATH):
+    """
+    Load the persistent scan index.
+
+    Returns a dict mapping filepath -> {"size", "mtime", "kind", "frameCount"}
+    where kind is "dicom", "apng" or None (probed, but not a media file).
+    A missing or unreadable index is treated as empty.
+    """
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"Error reading scan index {index_path}, starting a new one")
+        return {}
+    if data.get("version") != SCAN_INDEX_VERSION:
+        return {}
+    return data.get("files", {})
+
+
+def save_scan_index(index, index_path: str = SCAN_INDEX_PATH):
+    """Atomically write the scan index (write to a temp file, then replace)."""
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"version": SCAN_INDEX_VERSION, "files": index}, f)
+    os.replace(tmp_path, index_path)
+
+
+def _is_under(filepath: str, directory_path: str) -> bool:
+    root = os.path.normpath(os.path.abspath(directory_path))
+    path = os.path.normpath(os.path.abspath(filepath))
+    return path == root or path.startswith(root + os.sep)
+
+
+def walk_source(directory_path: str):
+    """
+    Yield (original_patient_name, filepath, filename) for every file below a
+    patient folder. Files directly inside the source root are ignored, and the
+    first path component below the root is the original patient name.
+    """
+    for root, dirs, files in os.walk(directory_path):
+        rel_path = os.path.relpath(root, directory_path)
+        if rel_path == ".":
+            continue
+        parts = rel_path.split(os.sep)
+        if not parts:
+            continue
+        original_patient_name = parts[0]
+        for file in files:
+            yield original_patient_name, os.path.join(root, file), file
+
+
+def _make_pool(executor_kind: str, workers: int):
+    if executor_kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    # Spawn, not fork: scans start from a worker thread of a threaded server
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _walk_and_submit(pool, directory_path: str, chunk_size: int, previous_index, progress):
+    """
+    Walk one source root, submitting probe batches as the walk goes.
+
+    Files whose size and mtime match the previous index reuse the stored probe
+    result and are never sent to the pool. Each returned chunk is
+    (entries, future) where future is None if nothing in the chunk needed probing.
+    """
+    chunks = []
+    batch = []
+    to_probe = []
+
+    def flush():
+        future = None
+        if to_probe:
+            future = pool.submit(probe_files, to_probe[:])
+            future.add_done_callback(
+                lambda f: progress.add(probes=f.result()) if not f.cancelled() and not f.exception() else None)
+        progress.add(probes=[e[4] for e in batch if e[4] is not _PENDING])
+        chunks.append((batch[:], future))
+        batch.clear()
+        to_probe.clear()
+
+    for original_patient_name, filepath, file in walk_source(directory_path):
+        progress.check()
+        progress.add(files=1)
+        try:
+            st = os.stat(filepath)
+            stat_sig = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stat_sig = None
+
+        probe = _PENDING
+        cached = previous_index.get(filepath) if stat_sig else None
+        if cached and (cached.get("size"), cached.get("mtime")) == stat_sig:
+            probe = (cached["kind"], cached["frameCount"]) if cached.get("kind") else None
+        else:
+            to_probe.append(filepath)
+
+        batch.append((original_patient_name, filepath, file, stat_sig, probe))
+        if len(to_probe) >= chunk_size or len(batch) >= chunk_size * 16:
+            flush()
+    if batch:
+        flush()
+    return chunks
+
+
+def scan_sources(sources, workers: int = None, executor_kind: str = None, chunk_size: int = None,
+                 index=None, reprobe: bool = False, progress: ScanProgress = None):
+    """
+    Scan several source roots in parallel.
+
+    Args:
+        sources: list of (directory_path, source) tuples, e.g.
+                 [("/data/butterfly", "butterfly"), ("/data/vave", "vave")]
+        workers: number of probe workers (defaults to SCAN_WORKERS)
+        executor_kind: "process" or "thread" (defaults to SCAN_EXECUTOR)
+        chunk_size: files per pool task (defaults to SCAN_CHUNK_SIZE)
+        index: optional scan index (see load_scan_index). Unchanged files reuse
+               their stored probe result; the dict is updated in place with
+               new/changed files and entries for deleted files are dropped.
+        reprobe: ignore stored index entries and probe every file again
+        progress: optional ScanProgress updated while the scan runs. Cancelling
+                  it stops the walk and raises ScanCancelled.
+
+    Returns:
+        patients_by_source keyed by "source:originalName". Results are merged
+        in walk order, so the structure is identical to a serial scan.
+    """
+    sources = [(path, source) for path, source in sources if path]
+    workers = workers or SCAN_WORKERS
+    executor_kind = executor_kind or SCAN_EXECUTOR
+    chunk_size = chunk_size or SCAN_CHUNK_SIZE
+    progress = progress or ScanProgress()
+
+    patients_by_source = {}
+    if not sources:
+        return patients_by_source
+
+    # Walkers read from a snapshot so the index can be updated while they run
+    previous_index = {} if (index is None or reprobe) else dict(index)
+    seen = set()
+
+    pool = _make_pool(executor_kind, workers)
+    walkers = ThreadPoolExecutor(max_workers=len(sources))
+    try:
+        # Walk every source root at the same time; the walkers only list
+        # directories, the heavy probing happens in the pool
+        walk_futures = [
+            walkers.submit(_walk_and_submit, pool, directory_path, chunk_size, previous_index, progress)
+            for directory_path, _ in sources
+        ]
+
+        for (directory_path, source), walk_future in zip(sources, walk_futures):
+            dicom_count = apng_count = reused_count = 0
+            for batch, probe_future in walk_future.result():
+                progress.check()
+                probed = iter(probe_future.result()) if probe_future else iter(())
+                for original_patient_name, filepath, dicomName, stat_sig, probe in batch:
+                    if probe is _PENDING:
+                        probe = next(probed)
+                    else:
+                        reused_count += 1
+
+                    if index is not None and stat_sig:
+                        seen.add(filepath)
+                        index[filepath] = {
+                            "size": stat_sig[0],
+                            "mtime": stat_sig[1],
+                            "kind": probe[0] if probe else None,
+                            "frameCount": probe[1] if probe else 0
+                        }
+
+                    # Create a unique key combining source and original name
+                    patient_key = f"{source}:{original_patient_name}"
+                    if patient_key not in patients_by_source:
+                        patients_by_source[patient_key] = {
+                            "originalName": original_patient_name,
+                            "source": source,
+                            "dicoms": {},
+                            "apngs": {}
+                        }
+                    if probe is None:
+                        continue
+
+                    kind, frame_count = probe
+                    if kind == "apng":
+                        apng_count += 1
+                    else:
+                        dicom_count += 1
+                    patients_by_source[patient_key]["apngs" if kind == "apng" else "dicoms"][dicomName] = {
+                        "dicomName": dicomName,
+                        "label": 0,
+                        "filepath": filepath,
+                        "frameCount": frame_count,
+                        "source": source,
+                        "originalPatientName": original_patient_name
+                    }
+            print(f"Scanned {source} directory {directory_path}: {dicom_count} DICOMs, "
+                  f"{apng_count} APNGs ({reused_count} files unchanged since last scan)")
+    except BaseException:
+        # Cancelled (or failed): stop the walkers and drop queued probe
+        # batches instead of draining them
+        progress.cancel()
+        walkers.shutdown(wait=False, cancel_futures=True)
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        walkers.shutdown()
+        pool.shutdown()
+
+    if index is not None:
+        # Drop entries for files that disappeared from the roots we just scanned
+        for filepath in list(index):
+            if filepath not in seen and any(_is_under(filepath, path) for path, _ in sources):
+                del index[filepath]
+
+    return patients_by_source
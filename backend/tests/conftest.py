@@ -0,0 +1,107 @@
+"""
+Shared fixtures.
+
+The backend modules are imported flat (as run.py runs them) and keep their
+files relative to the working directory, so every test runs in its own
+temporary directory.
+"""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# Worker processes are slower to start than the tiny test clips take to probe or decode
+os.environ.setdefault("ECHO_SCAN_EXECUTOR", "thread")
+os.environ.setdefault("ECHO_DECODE_EXECUTOR", "thread")
+# The background prefetcher would warm the frame cache behind the tests' backs; test_prefetch runs its own
+os.environ.setdefault("ECHO_PREFETCH_PATIENTS", "0")
+
+import label_store
+from media_files import build_archive
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(label_store, "_sqlite_store", None)
+    monkeypatch.setattr(label_store, "patient_index", label_store.PatientIndex())
+    yield tmp_path
+    # Pending writes and journals use relative paths; finish them before leaving the directory
+    label_store.label_writer.flush_all()
+    label_store.journal_compactor.flush()
+
+
+MANIFEST = [
+    {
+        "patientName": "Patient 1", "originalName": "", "source": "scan",
+        "dicoms": [
+            {"dicomName": "a.dcm", "label": 0, "filepath": "/archive/p1/a.dcm", "frameCount": 30},
+            {"dicomName": "b.dcm", "label": 0, "filepath": "/archive/p1/b.dcm", "frameCount": 12},
+        ],
+        "apngs": [
+            {"dicomName": "loop.png", "label": 0, "filepath": "/archive/p1/loop.png", "frameCount": 8},
+        ],
+    },
+    {
+        "patientName": "Patient 2", "originalName": "", "source": "scan",
+        "dicoms": [
+            {"dicomName": "c.dcm", "label": 0, "filepath": "/archive/p2/c.dcm", "frameCount": 5},
+        ],
+        "apngs": [],
+    },
+]
+
+
+@pytest.fixture
+def manifest(workdir):
+    """A small manifest (patient_dicom_labels.csv) written directly, without scanning"""
+    label_store.save_to_csv(MANIFEST, label_store.MANIFEST_CSV_PATH)
+    return MANIFEST
+
+
+@pytest.fixture(params=["sqlite", "csv", "journal"])
+def label_backend(request, workdir, monkeypatch):
+    monkeypatch.setattr(label_store, "LABEL_BACKEND", request.param)
+    return request.param
+
+
+def reload_from_disk(monkeypatch):
+    """Forget the labels held in memory, as a restarted server would"""
+    monkeypatch.setattr(label_store, "_sqlite_store", None)
+    monkeypatch.setattr(label_store, "patient_index", label_store.PatientIndex())
+
+
+@pytest.fixture
+def archive(workdir):
+    return build_archive(workdir / "archive")
+
+
+@pytest.fixture
+def client(workdir):
+    from fastapi.testclient import TestClient
+    # main mounts ../frontend/build on import
+    cwd = os.getcwd()
+    os.chdir(BACKEND_DIR)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return TestClient(main.app)
+
+
+def scan(client, archive, username="bob", **options):
+    response = client.post("/scan-directory", json={
+        "butterfly_directory_path": str(archive), "username": username, **options
+    })
+    assert response.status_code == 200, response.text
+    return response.json()["patients"]
+
+
+def clip_names(patients, key="dicoms"):
+    return {patient["originalName"]: sorted(clip["dicomName"] for clip in patient[key]) for patient in patients}
+
+
+def patient_name(patients, original_name):
+    return next(patient["patientName"] for patient in patients if patient["originalName"] == original_name)
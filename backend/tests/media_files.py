@@ -0,0 +1,141 @@
+"""Small synthetic DICOM / APNG files for the tests"""
+import io
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+from apng import APNG, PNG
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, UltrasoundMultiFrameImageStorage, generate_uid
+
+MPEG4_TRANSFER_SYNTAX = "1.2.840.10008.1.2.4.102"
+
+
+def dicom_dataset(transfer_syntax=ExplicitVRLittleEndian):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = UltrasoundMultiFrameImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = transfer_syntax
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "US"
+    return ds
+
+
+def write_dicom(path, frames, photometric=None, **elements):
+    """
+    Write frames (N x H x W, or N x H x W x 3 for colour) as an uncompressed
+    multi-frame DICOM. Extra keyword arguments are set as data elements.
+    """
+    frames = np.ascontiguousarray(frames)
+    ds = dicom_dataset()
+    ds.NumberOfFrames = len(frames)
+    ds.Rows, ds.Columns = frames.shape[1:3]
+    ds.SamplesPerPixel = 3 if frames.ndim == 4 else 1
+    ds.PhotometricInterpretation = photometric or ("RGB" if frames.ndim == 4 else "MONOCHROME2")
+    if frames.ndim == 4:
+        ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = frames.dtype.itemsize * 8
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 1 if frames.dtype.kind == "i" else 0
+    for keyword, value in elements.items():
+        setattr(ds, keyword, value)
+    ds.PixelData = frames.tobytes()
+    ds.save_as(str(path), enforce_file_format=True)
+    return str(path)
+
+
+def write_video_dicom(path, frames, fps=30):
+    """
+    Encode colour frames (N x H x W x 3, BGR) as MP4 and wrap the stream in
+    an MPEG-4 DICOM. Returns the MP4 bytes as embedded.
+    """
+    mp4_path = f"{path}.mp4"
+    height, width = frames.shape[1:3]
+    writer = cv2.VideoWriter(mp4_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for frame in frames:
+        writer.write(np.ascontiguousarray(frame))
+    writer.release()
+    with open(mp4_path, "rb") as f:
+        data = f.read()
+    os.remove(mp4_path)
+    if len(data) % 2:
+        data += b"\0"   # DICOM pads fragments to an even length
+
+    ds = dicom_dataset(MPEG4_TRANSFER_SYNTAX)
+    ds.NumberOfFrames = len(frames)
+    ds.Rows, ds.Columns = height, width
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = "YBR_PARTIAL_420"
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.CineRate = fps
+    ds.PixelData = encapsulate([data])
+    ds["PixelData"].VR = "OB"
+    ds.save_as(str(path), enforce_file_format=True)
+    return data
+
+
+def png_bytes(array):
+    buffer = io.BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def write_png(path, array):
+    with open(path, "wb") as f:
+        f.write(png_bytes(array))
+    return str(path)
+
+
+def write_apng(path, frames, delay_ms=40):
+    animation = APNG()
+    for frame in frames:
+        animation.append(PNG.from_bytes(png_bytes(frame)), delay=delay_ms, delay_den=1000)
+    animation.save(str(path))
+    return str(path)
+
+
+def gradient_frames(count, height=48, width=64, dtype=np.uint8):
+    """Frames that differ from each other, so a wrong frame index shows up"""
+    y, x = np.mgrid[0:height, 0:width]
+    top = np.iinfo(dtype).max
+    return np.stack([((x + y * 2 + i * 9) % 97) * top // 96 for i in range(count)]).astype(dtype)
+
+
+def color_frames(count, height=48, width=64):
+    """Colour frames with a bright square moving across them"""
+    frames = np.zeros((count, height, width, 3), dtype=np.uint8)
+    frames[..., 0] = 40
+    for i in range(count):
+        x = i * (width - 16) // max(count - 1, 1)
+        frames[i, 16:32, x:x + 16] = (255, 200, 60)
+    return frames
+
+
+def build_archive(root):
+    """
+    A source root with two patient folders:
+
+        p1/a.dcm           6-frame DICOM
+        p1/loop.png        4-frame APNG
+        p1/still.png       plain PNG (skipped)
+        p1/notes.txt       not a clip (skipped)
+        p2/scans/b         single-frame 16-bit DICOM without extension
+        stray.dcm          directly under the root (ignored)
+    """
+    for folder in ("p1", "p2/scans"):
+        (root / folder).mkdir(parents=True, exist_ok=True)
+    write_dicom(root / "p1" / "a.dcm", gradient_frames(6))
+    write_apng(root / "p1" / "loop.png", gradient_frames(4, 32, 32))
+    write_png(root / "p1" / "still.png", gradient_frames(1, 16, 16)[0])
+    (root / "p1" / "notes.txt").write_text("not a clip")
+    write_dicom(root / "p2" / "scans" / "b", gradient_frames(1, dtype=np.uint16))
+    write_dicom(root / "stray.dcm", gradient_frames(2))
+    return root
@@ -0,0 +1,99 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+from apng import APNG, PNG
+
+from apng_reader import apng_num_frames, read_apng_frames
+from media import render_clip, render_params
+from scanner import probe_file
+
+
+def png_bytes(array, mode=None):
+    buffer = io.BytesIO()
+    image = Image.fromarray(array)
+    if mode == "P":
+        image = image.convert("P", palette=Image.ADAPTIVE, colors=16)
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def pixels(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"))
+
+
+def write_apng(path, frames):
+    """frames: (png bytes, append() options) pairs"""
+    animation = APNG()
+    for data, options in frames:
+        animation.append(PNG.from_bytes(data), **options)
+    animation.save(str(path))
+    return str(path)
+
+
+rng = np.random.default_rng(0)
+
+CASES = {
+    "rgb": [(png_bytes(rng.integers(0, 255, (24, 32, 3), dtype=np.uint8)), {"delay": i + 1, "delay_den": 25})
+            for i in range(4)],
+    "rgba": [(png_bytes(rng.integers(0, 255, (24, 32, 4), dtype=np.uint8)), {"delay": 40}) for _ in range(3)],
+    "gray": [(png_bytes(rng.integers(0, 255, (16, 16), dtype=np.uint8)), {"delay": 5, "delay_den": 0})
+             for _ in range(3)],
+    "palette": [(png_bytes(rng.integers(0, 255, (20, 20, 3), dtype=np.uint8), "P"), {"delay": 10})
+                for _ in range(2)],
+    "offsets": [
+        (png_bytes(rng.integers(0, 255, (40, 50, 3), dtype=np.uint8)), {"delay": 4}),
+        (png_bytes(rng.integers(0, 255, (10, 12, 3), dtype=np.uint8)), {"delay": 4, "x_offset": 5, "y_offset": 7}),
+    ],
+}
+
+
+@pytest.mark.parametrize("case", list(CASES))
+def test_matches_apng_library(tmp_path, case):
+    path = write_apng(tmp_path / f"{case}.png", CASES[case])
+    expected = APNG.open(path).frames
+
+    assert apng_num_frames(path) == len(expected)
+    frames = read_apng_frames(path)
+    assert len(frames) == len(expected)
+    for frame, (png, control) in zip(frames, expected):
+        assert (frame.width, frame.height) == (control.width, control.height)
+        assert (frame.x_offset, frame.y_offset) == (control.x_offset, control.y_offset)
+        assert frame.delay_ms == int(1000 * control.delay / (control.delay_den or 100))
+        assert (frame.dispose_op, frame.blend_op) == (control.depose_op, control.blend_op)
+        assert np.array_equal(pixels(frame.png), pixels(png.to_bytes()))
+
+
+def test_plain_png(tmp_path):
+    path = tmp_path / "plain.png"
+    path.write_bytes(png_bytes(rng.integers(0, 255, (8, 8, 3), dtype=np.uint8)))
+    assert apng_num_frames(str(path)) is None
+    assert read_apng_frames(str(path)) == []
+
+
+def test_not_a_png(tmp_path):
+    path = tmp_path / "clip.dcm"
+    path.write_bytes(b"\0" * 128 + b"DICM")
+    assert apng_num_frames(str(path)) is None
+    with pytest.raises(ValueError):
+        read_apng_frames(str(path))
+
+
+def test_scanner_counts_frames_from_the_header(tmp_path):
+    path = write_apng(tmp_path / "loop.png", CASES["rgb"])
+    assert probe_file(path) == ("apng", 4)
+
+
+def test_png_renders_pass_frames_through(tmp_path):
+    path = write_apng(tmp_path / "loop.png", CASES["offsets"])
+    clip = render_clip("apng", path, "loop.png")
+    assert [frame["data"] for frame in clip["frames"]] == [frame.png for frame in read_apng_frames(path)]
+    assert [frame["delayMs"] for frame in clip["frames"]] == [4, 4]
+    assert render_params("apng")["passthrough"]
+
+    # Anything that changes the pixels is decoded and encoded again
+    assert "passthrough" not in render_params("apng", "preview")
+    assert "passthrough" not in render_params("apng", None, 16)
+    clip = render_clip("apng", path, "loop.png", max_size=16)
+    assert clip["frames"][0]["data"] != read_apng_frames(path)[0].png
@@ -0,0 +1,89 @@
+import os
+
+import cv2
+import pytest
+
+import media
+from conftest import scan, patient_name
+from media import video_bitstream
+from media_files import write_video_dicom, color_frames
+
+
+@pytest.fixture
+def fetch_video(client, archive):
+    (archive / "p3").mkdir()
+    mp4 = write_video_dicom(archive / "p3" / "video.dcm", color_frames(10))
+    patients = scan(client, archive)
+    names = {"a.dcm": "p1", "loop.png": "p1", "video.dcm": "p3"}
+
+    def fetch_video(dicom_name, **params):
+        return client.get("/fetch-clip-video", params={
+            "username": "bob", "patientName": patient_name(patients, names[dicom_name]),
+            "dicomName": dicom_name, **params
+        })
+    fetch_video.mp4 = mp4
+    return fetch_video
+
+
+def decoded_frames(workdir, response, suffix):
+    path = str(workdir / f"decoded{suffix}")
+    with open(path, "wb") as f:
+        f.write(response.content)
+    capture = cv2.VideoCapture(path)
+    count = 0
+    while capture.read()[0]:
+        count += 1
+    capture.release()
+    return count
+
+
+def cache_files(workdir):
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(workdir / "video_cache") for file in files)
+
+
+def test_mpeg4_dicom_passthrough(fetch_video, workdir):
+    for container in ("auto", "mp4"):
+        response = fetch_video("video.dcm", container=container)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "video/mp4"
+        assert response.content == fetch_video.mp4
+
+
+@pytest.mark.parametrize("dicom_name, frames", [("a.dcm", 6), ("loop.png", 4), ("video.dcm", 10)])
+def test_transcode(fetch_video, workdir, dicom_name, frames):
+    response = fetch_video(dicom_name, container="webm")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "video/webm"
+    assert decoded_frames(workdir, response, ".webm") == frames
+
+
+def test_auto_and_mp4_containers(fetch_video, workdir):
+    response = fetch_video("a.dcm")
+    assert response.headers["content-type"] == "video/webm"
+    response = fetch_video("a.dcm", container="mp4")
+    assert response.headers["content-type"] == "video/mp4"
+    assert decoded_frames(workdir, response, ".mp4") == 6
+
+
+def test_transcodes_are_cached(fetch_video, workdir):
+    first = fetch_video("a.dcm", container="webm").content
+    files = cache_files(workdir)
+    assert len(files) == 1 and files[0].endswith(".webm")
+    assert fetch_video("a.dcm", container="webm").content == first
+    assert cache_files(workdir) == files
+
+
+def test_bad_requests(fetch_video):
+    assert fetch_video("a.dcm", container="avi").status_code == 400
+    assert fetch_video("a.dcm", kind="apng").status_code == 404
+
+
+def test_passthrough_shares_the_decoders_extracted_stream(fetch_video, archive, workdir, monkeypatch):
+    assert video_bitstream(str(archive / "p3" / "video.dcm")) == fetch_video.mp4
+    files = cache_files(workdir)
+
+    def extract(ds):
+        raise AssertionError("extracted again")
+    monkeypatch.setattr(media, "extract_video_bitstream", extract)
+    assert fetch_video("video.dcm").content == fetch_video.mp4
+    assert cache_files(workdir) == files
@@ -0,0 +1,43 @@
+import pytest
+
+import workers
+from media import render_clip
+
+
+@pytest.fixture
+def main(client):
+    import main
+    return main
+
+
+def frames(clip):
+    return [frame["data"] for frame in clip["frames"]]
+
+
+def test_load_clips_keeps_order_and_isolates_errors(main, archive):
+    clips = [("dicom", str(archive / "p1" / "a.dcm"), "a.dcm"),
+             ("dicom", str(archive / "p1" / "missing.dcm"), "missing.dcm"),
+             ("apng", str(archive / "p1" / "loop.png"), "loop.png"),
+             ("dicom", str(archive / "p1" / "notes.txt"), "notes.txt")]
+    results = main.load_clips(clips)
+    assert frames(results[0]) == frames(render_clip(*clips[0]))
+    assert frames(results[2]) == frames(render_clip(*clips[2]))
+    for failed in (results[1], results[3]):
+        assert failed["frames"] == [] and failed["error"]
+
+
+def test_process_pool(main, archive, monkeypatch):
+    monkeypatch.setattr(workers, "DECODE_EXECUTOR", "process")
+    workers.reset_decode_pool()
+    try:
+        clip = ("apng", str(archive / "p1" / "loop.png"), "loop.png")
+        assert frames(main.load_clips([clip])[0]) == frames(render_clip(*clip))
+    finally:
+        workers.reset_decode_pool()
+
+
+def test_reset_decode_pool():
+    pool = workers.decode_pool()
+    assert workers.decode_pool() is pool
+    workers.reset_decode_pool()
+    assert workers.decode_pool() is not pool
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from pydicom.uid import RLELossless
+
+from media import DicomFrames, open_dicom, _scale_to_uint8
+from media_files import write_dicom, gradient_frames
+
+
+def frames_of(path):
+    return DicomFrames(open_dicom(str(path)), str(path))
+
+
+def test_uncompressed_frames_are_memory_mapped(tmp_path):
+    stack = gradient_frames(300, 64, 80)
+    path = write_dicom(tmp_path / "long.dcm", stack)
+    frames = frames_of(path)
+    assert isinstance(frames._view, np.memmap)
+    # The pixel data stays on disk until frames are read
+    assert frames.ds.get_item(0x7FE00010, keep_deferred=True).value is None
+
+    assert len(frames) == 300
+    assert np.array_equal(frames[7], stack[7])
+    assert np.array_equal(frames[-1], stack[-1])
+    assert [np.array_equal(a, b) for a, b in zip(frames[2:5], stack[2:5])] == [True] * 3
+    assert all(np.array_equal(a, b) for a, b in zip(frames, stack))
+    with pytest.raises(IndexError):
+        frames[300]
+
+
+def test_16bit_frames_share_one_range(tmp_path):
+    stack = gradient_frames(5, dtype=np.uint16) // 4
+    path = write_dicom(tmp_path / "u16.dcm", stack, BitsStored=16)
+    frames = frames_of(path)
+    expected = _scale_to_uint8(stack, float(stack.min()), float(stack.max()))
+    assert frames.value_range() == (float(stack.min()), float(stack.max()))
+    # Random access agrees with streaming, and with normalizing the whole stack at once
+    assert np.array_equal(frames[3], expected[3])
+    assert all(np.array_equal(a, b) for a, b in zip(frames, expected))
+
+
+def test_encapsulated_frames_are_decoded_one_by_one(tmp_path):
+    stack = gradient_frames(4)
+    path = write_dicom(tmp_path / "plain.dcm", stack)
+    ds = open_dicom(path)
+    ds.compress(RLELossless, stack, encoding_plugin="pydicom")
+    ds.save_as(str(tmp_path / "rle.dcm"))
+
+    frames = frames_of(tmp_path / "rle.dcm")
+    assert frames._view is None and frames._stack is None
+    assert np.array_equal(frames[2], stack[2])
+    assert all(np.array_equal(a, b) for a, b in zip(frames, stack))
+
+
+def no_pre_scan(self):
+    raise AssertionError("walked every frame")
+
+
+@pytest.mark.parametrize("photometric, elements, expected", [
+    ("MONOCHROME2", {"WindowCenter": 1050, "WindowWidth": 100}, (1000, 1100)),
+    ("MONOCHROME1", {}, (0, 255)),
+    ("MONOCHROME2", {"BitsStored": 6, "HighBit": 5}, (0, 63)),
+])
+def test_range_from_metadata_skips_the_pre_scan(tmp_path, monkeypatch, photometric, elements, expected):
+    dtype = np.uint16 if "WindowCenter" in elements else np.uint8
+    stack = gradient_frames(5, dtype=dtype) // (4 if "BitsStored" in elements else 1)
+    frames = frames_of(write_dicom(tmp_path / "clip.dcm", stack, photometric, **elements))
+    monkeypatch.setattr(DicomFrames, "_iter_raw", no_pre_scan)
+    assert frames.value_range() == expected
+    assert frames[3].dtype == np.uint8
+
+
+def test_range_without_metadata_comes_from_the_frames(tmp_path):
+    stack = gradient_frames(5, dtype=np.uint16) // 4
+    frames = frames_of(write_dicom(tmp_path / "u16.dcm", stack, RescaleSlope=2, RescaleIntercept=0))
+    assert frames.value_range() == (2.0 * stack.min(), 2.0 * stack.max())
@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.pixels import convert_color_space
+
+from media import render_clip
+from media_files import write_dicom
+
+
+def halves(*pairs, size=32, dtype=np.uint8):
+    """One frame per (left, right) pair, each half a flat value (so JPEG keeps it)"""
+    frames = np.zeros((len(pairs), size, size), dtype=dtype)
+    for frame, (left, right) in zip(frames, pairs):
+        frame[:, :size // 2] = left
+        frame[:, size // 2:] = right
+    return frames
+
+
+def rendered(path):
+    """Rendered frames decoded back to arrays: (left, right) pixel per frame"""
+    clip = render_clip("dicom", str(path), "clip")
+    assert "error" not in clip
+    pixels = []
+    for frame in clip["frames"]:
+        image = cv2.imdecode(np.frombuffer(frame["data"], np.uint8), cv2.IMREAD_UNCHANGED)
+        h, w = image.shape[:2]
+        pixels.append((image[h // 2, w // 4].astype(int), image[h // 2, 3 * w // 4].astype(int)))
+    return pixels
+
+
+def close(actual, expected, tolerance=3):
+    return np.all(np.abs(np.asarray(actual) - np.asarray(expected)) <= tolerance)
+
+
+def test_8bit_grayscale_is_unchanged(tmp_path):
+    path = write_dicom(tmp_path / "u8.dcm", halves((10, 200), (60, 120)))
+    pixels = rendered(path)
+    assert close(pixels, [(10, 200), (60, 120)])
+    assert np.ndim(pixels[0][0]) == 0   # encoded as single-channel JPEG
+
+
+def test_16bit_frames_share_one_normalization(tmp_path):
+    path = write_dicom(tmp_path / "u16.dcm", halves((0, 1000), (0, 4000), dtype=np.uint16))
+    assert close(rendered(path), [(0, 64), (0, 255)])
+
+
+def test_modality_lut(tmp_path):
+    # Stored values map to -1000..1000; with a slope of -1 the bright half turns dark
+    path = write_dicom(tmp_path / "ct.dcm", halves((0, 2000), (1000, 1000), dtype=np.uint16),
+                       RescaleSlope=-1, RescaleIntercept=1000)
+    assert close(rendered(path), [(255, 0), (128, 128)])
+
+
+def test_window_maps_onto_the_full_range(tmp_path):
+    frames = halves((1000, 1100), (1050, 1050), dtype=np.uint16)
+    # A wide window keeps close values close to mid-gray instead of stretching them apart
+    path = write_dicom(tmp_path / "wide.dcm", frames, WindowCenter=1050, WindowWidth=20000)
+    assert close(rendered(path), [(127, 128), (127, 127)])
+    path = write_dicom(tmp_path / "narrow.dcm", frames, WindowCenter=1050, WindowWidth=50)
+    assert close(rendered(path), [(0, 255), (127, 127)])
+    # Only the first of several windows is used
+    path = write_dicom(tmp_path / "multi.dcm", frames, WindowCenter=[1050, 0], WindowWidth=[20000, 10])
+    assert close(rendered(path), [(127, 128), (127, 127)])
+    path = write_dicom(tmp_path / "m1.dcm", frames, photometric="MONOCHROME1", WindowCenter=1050, WindowWidth=50)
+    assert close(rendered(path), [(255, 0), (128, 128)])
+
+
+def test_window_applies_to_8bit_frames(tmp_path):
+    path = write_dicom(tmp_path / "u8.dcm", halves((100, 140)), WindowCenter=120, WindowWidth=40)
+    assert close(rendered(path), [(0, 255)])
+
+
+def test_sigmoid_window(tmp_path):
+    path = write_dicom(tmp_path / "sigmoid.dcm", halves((1050, 3000), dtype=np.uint16),
+                       WindowCenter=1050, WindowWidth=200, VOILUTFunction="SIGMOID")
+    assert close(rendered(path), [(127, 255)])
+
+
+def test_voi_lut_table(tmp_path):
+    lut = Dataset()
+    lut.LUTDescriptor = [256, 0, 12]
+    lut.LUTData = (np.arange(256, dtype="<u2") * 16).tobytes()
+    # Output 0..4080 of 0..4095: the LUT's range, not the clip's, maps onto 0..255
+    path = write_dicom(tmp_path / "lut.dcm", halves((64, 128), dtype=np.uint16), VOILUTSequence=[lut],
+                       WindowCenter=0, WindowWidth=1)
+    assert close(rendered(path), [(64, 127)])
+
+
+def test_monochrome1_is_inverted(tmp_path):
+    path = write_dicom(tmp_path / "m1.dcm", halves((0, 255), (0, 255)), photometric="MONOCHROME1")
+    assert close(rendered(path), [(255, 0), (255, 0)])
+
+
+def rgb_frames():
+    frames = np.zeros((2, 32, 32, 3), dtype=np.uint8)
+    frames[:, :, :16] = (230, 30, 20)
+    frames[:, :, 16:] = (20, 40, 220)
+    return frames
+
+
+def test_rgb(tmp_path):
+    pixels = rendered(write_dicom(tmp_path / "rgb.dcm", rgb_frames()))
+    # OpenCV decodes to BGR
+    assert close(pixels[0], [(20, 30, 230), (220, 40, 20)], tolerance=12)
+
+
+def test_raw_ybr(tmp_path):
+    ybr = convert_color_space(rgb_frames(), "RGB", "YBR_FULL")
+    pixels = rendered(write_dicom(tmp_path / "ybr.dcm", ybr, photometric="YBR_FULL"))
+    assert close(pixels[0], [(20, 30, 230), (220, 40, 20)], tolerance=12)
+
+
+def test_palette_color(tmp_path):
+    ramp = np.arange(256, dtype=np.uint16) * 257
+    lut = {
+        "Red": ramp, "Green": np.zeros(256, dtype=np.uint16), "Blue": ramp[::-1],
+    }
+    elements = {}
+    for color, values in lut.items():
+        elements[f"{color}PaletteColorLookupTableDescriptor"] = [256, 0, 16]
+        elements[f"{color}PaletteColorLookupTableData"] = values.astype("<u2").tobytes()
+    path = write_dicom(tmp_path / "palette.dcm", halves((0, 255), (0, 255)), photometric="PALETTE COLOR",
+                       **elements)
+    assert close(rendered(path)[0], [(255, 0, 0), (0, 0, 255)], tolerance=12)
@@ -0,0 +1,75 @@
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import scan, patient_name
+from media_files import write_apng, gradient_frames
+
+
+@pytest.fixture
+def fetch(client, archive):
+    rgba = np.zeros((3, 16, 16, 4), dtype=np.uint8)
+    rgba[..., 0] = 200
+    rgba[:, :, 8:, 3] = 255     # left half transparent
+    write_apng(archive / "p1" / "alpha.png", rgba)
+    patients = scan(client, archive)
+    params = {"username": "bob", "patientName": patient_name(patients, "p1")}
+
+    def fetch(path, **query):
+        return client.get(path, params={**params, **query})
+    fetch.params = params
+    return fetch
+
+
+def decode_src(src):
+    header, data = src.split(",", 1)
+    return header[len("data:"):-len(";base64")], base64.b64decode(data)
+
+
+def mimes(fetch, dicom_name, **query):
+    return {decode_src(image["src"])[0] for image in fetch("/fetch-clip", dicomName=dicom_name, **query).json()["images"]}
+
+
+def test_defaults(fetch):
+    assert mimes(fetch, "a.dcm") == {"image/jpeg"}
+    assert mimes(fetch, "loop.png") == {"image/png"}
+
+
+@pytest.mark.parametrize("profile, mime", [("label", "image/jpeg"), ("preview", "image/webp"), ("lossless", "image/png")])
+def test_profiles(fetch, profile, mime):
+    assert mimes(fetch, "a.dcm", profile=profile) == {mime}
+    assert mimes(fetch, "loop.png", profile=profile) == {mime}
+    response = fetch("/clip-frame", dicomName="a.dcm", index=0, profile=profile)
+    assert response.headers["content-type"] == mime
+    assert cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_UNCHANGED) is not None
+
+
+def test_lossless_keeps_pixels(fetch):
+    images = fetch("/fetch-clip", dicomName="a.dcm", profile="lossless").json()["images"]
+    decoded = [cv2.imdecode(np.frombuffer(decode_src(image["src"])[1], np.uint8), cv2.IMREAD_UNCHANGED)
+               for image in images]
+    assert np.array_equal(np.stack(decoded), gradient_frames(6))
+
+
+@pytest.mark.parametrize("profile", ["lossless", "preview"])
+def test_alpha_is_kept(fetch, profile):
+    image = fetch("/fetch-clip", dicomName="alpha.png", profile=profile).json()["images"][0]
+    frame = cv2.imdecode(np.frombuffer(decode_src(image["src"])[1], np.uint8), cv2.IMREAD_UNCHANGED)
+    assert frame.shape[2] == 4
+    assert frame[8, 2, 3] == 0 and frame[8, 12, 3] == 255
+
+
+def test_profile_is_part_of_urls_and_etags(fetch):
+    default_etag = fetch("/clip-frame", dicomName="a.dcm", index=0).headers["etag"]
+    assert fetch("/clip-frame", dicomName="a.dcm", index=0, profile="preview").headers["etag"] != default_etag
+    image = fetch("/fetch-clip", dicomName="a.dcm", transport="url", profile="preview").json()["images"][0]
+    assert "profile=preview" in image["src"]
+
+
+def test_unknown_profile(fetch, client):
+    assert fetch("/fetch-clip", dicomName="a.dcm", profile="gif").status_code == 400
+    assert fetch("/clip-frame", dicomName="a.dcm", index=0, profile="gif").status_code == 400
+    assert client.post("/fetch-patient-dicoms", json={**fetch.params, "profile": "gif"}).status_code == 400
+    assert set(client.get("/encoding-profiles").json()["profiles"]) == {"label", "preview", "lossless"}
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from conftest import scan, patient_name
+
+
+@pytest.fixture
+def fetch(client, archive):
+    patients = scan(client, archive)
+
+    def fetch(dicom_name, original_name="p1", **params):
+        return client.get("/fetch-clip", params={
+            "username": "bob", "patientName": patient_name(patients, original_name), "dicomName": dicom_name, **params
+        })
+    return fetch
+
+
+def ids(body):
+    return [image["id"] for image in body["images"]]
+
+
+def test_whole_clip(fetch):
+    body = fetch("a.dcm").json()
+    assert (body["kind"], body["frameCount"], body["label"]) == ("dicom", 6, 0)
+    assert ids(body) == [f"a.dcm-{i}" for i in range(1, 7)]
+    assert all(image["src"].startswith("data:image/") for image in body["images"])
+
+    body = fetch("loop.png").json()
+    assert (body["kind"], body["frameCount"]) == ("apng", 4)
+    assert [image["delayMs"] for image in body["images"]] == [40] * 4
+
+
+def test_frame_range(fetch):
+    body = fetch("a.dcm", start=1, end=5, stride=2).json()
+    assert (body["frameCount"], body["start"], body["end"], body["stride"]) == (6, 1, 5, 2)
+    assert ids(body) == ["a.dcm-2", "a.dcm-4"]
+    assert ids(fetch("a.dcm", start=4, end=100).json()) == ["a.dcm-5", "a.dcm-6"]
+    assert ids(fetch("a.dcm", start=10).json()) == []
+
+
+def test_ranges_merge_into_the_whole_clip(fetch):
+    whole = fetch("a.dcm").json()["images"]
+    assert fetch("a.dcm", end=3).json()["images"] + fetch("a.dcm", start=3).json()["images"] == whole
+    assert fetch("a.dcm", stride=3).json()["images"] == whole[::3]
+
+
+@pytest.mark.parametrize("params", [{"start": -1}, {"stride": 0}, {"start": 3, "end": 2}, {"kind": "mp4"}])
+def test_bad_requests(fetch, params):
+    assert fetch("a.dcm", **params).status_code == 400
+
+
+def test_unknown_clips(fetch):
+    assert fetch("missing.dcm").status_code == 404
+    assert fetch("a.dcm", kind="apng").status_code == 404
+    assert fetch("b", original_name="p1").status_code == 404
+
+
+def test_missing_file(fetch, archive):
+    os.remove(archive / "p2" / "scans" / "b")
+    body = fetch("b", original_name="p2").json()
+    assert (body["frameCount"], body["images"], body["error"]) == (0, [], "Missing file")
+
+
+def test_failed_range_render(fetch, client, monkeypatch):
+    import main
+
+    def render_frame_range(*args):
+        raise RuntimeError("decoder blew up")
+    monkeypatch.setattr(main, "render_frame_range", render_frame_range)
+    body = fetch("a.dcm", start=1, end=3).json()
+    assert (body["frameCount"], body["images"], body["error"]) == (0, [], "decoder blew up")
+
+    response = client.get("/fetch-clip-binary", params={
+        "username": "bob", "patientName": body["patientName"], "dicomName": "a.dcm", "start": 1, "end": 3
+    })
+    assert (response.status_code, response.headers["x-frame-count"], response.content) == (200, "0", b"")
@@ -0,0 +1,71 @@
+import pytest
+
+from conftest import scan, patient_name
+
+
+@pytest.fixture
+def fetch(client, archive):
+    patients = scan(client, archive)
+    response = client.post("/update-csv", json={
+        "patientName": patient_name(patients, "p2"), "dicomName": "b", "label": 1, "username": "bob"
+    })
+    assert response.status_code == 200
+
+    def fetch(**params):
+        return client.get("/fetch-csv", params={"username": "bob", **params})
+    fetch.names = {patient["patientName"]: patient["originalName"] for patient in patients}
+    return fetch
+
+
+def originals(fetch, body):
+    return [fetch.names[patient["patientName"]] for patient in body["patients"]]
+
+
+def test_limit_and_offset(fetch):
+    body = fetch(limit=1).json()
+    assert (body["total"], body["offset"], body["limit"]) == (2, 0, 1)
+    assert [patient["patientName"] for patient in body["patients"]] == ["Patient 1"]
+    body = fetch(offset=1, limit=5).json()
+    assert [patient["patientName"] for patient in body["patients"]] == ["Patient 2"]
+    assert fetch(offset=2).json()["patients"] == []
+    for params in ({"limit": 0}, {"offset": -1}):
+        assert fetch(**params).status_code == 400
+
+
+def test_without_options(fetch):
+    body = fetch().json()
+    assert (body["total"], body["offset"], body["limit"]) == (2, 0, None)
+    assert all(clip["filepath"] for patient in body["patients"] for clip in patient["dicoms"] + patient["apngs"])
+
+
+def test_filters(fetch):
+    body = fetch(unlabeled="true", kind="apng").json()
+    assert body["total"] == 1 and originals(fetch, body) == ["p1"]
+    assert [clip["dicomName"] for clip in body["patients"][0]["apngs"]] == ["loop.png"]
+    assert body["patients"][0]["dicoms"] == []
+
+    body = fetch(label=1).json()
+    assert originals(fetch, body) == ["p2"]
+    assert [clip["dicomName"] for clip in body["patients"][0]["dicoms"]] == ["b"]
+    assert fetch(unlabeled="true").json()["total"] == 1
+    assert fetch(kind="mp4").status_code == 400
+
+
+def test_compact_fields(fetch):
+    body = fetch(fields="compact").json()
+    for patient in body["patients"]:
+        assert set(patient) == {"patientName", "dicoms", "apngs"}
+        for clip in patient["dicoms"] + patient["apngs"]:
+            assert set(clip) == {"dicomName", "label", "frameCount"}
+    assert fetch(fields="everything").status_code == 400
+
+
+def test_summary(fetch):
+    body = fetch(summary="true").json()
+    summaries = {fetch.names[patient.pop("patientName")]: patient for patient in body["patients"]}
+    assert summaries == {
+        "p1": {"dicoms": 1, "apngs": 1, "labeled": 0, "unlabeled": 2, "labelCounts": {"0": 2}},
+        "p2": {"dicoms": 1, "apngs": 0, "labeled": 1, "unlabeled": 0, "labelCounts": {"1": 1}},
+    }
+    assert [patient["labeled"] for patient in fetch(summary="true", limit=1, offset=1).json()["patients"]] == \
+        [summaries[fetch.names["Patient 2"]]["labeled"]]
@@ -0,0 +1,113 @@
+import os
+
+from conftest import scan, patient_name
+from frame_cache import FrameCache, DiskLRU, cache_key, clip_size, serialize_clip, deserialize_clip
+
+
+def clip(tag, size=1000):
+    return {"frames": [{"data": tag * size, "mime": "image/png"}], "fps": 30}
+
+
+def test_serialize_round_trip():
+    value = {"frames": [{"data": b"abc", "mime": "image/png"}, {"data": b"", "mime": "image/png"}], "fps": 25}
+    assert deserialize_clip(serialize_clip(value)) == value
+
+
+def test_cache_key_follows_file_and_params(tmp_path):
+    path = tmp_path / "a.dcm"
+    path.write_bytes(b"1")
+    key = cache_key(str(path), {"v": 1})
+    assert key == cache_key(str(path), {"v": 1})
+    assert key != cache_key(str(path), {"v": 2})
+    path.write_bytes(b"22")
+    assert key != cache_key(str(path), {"v": 1})
+    assert cache_key(str(tmp_path / "missing.dcm"), {"v": 1}) is None
+
+
+def test_memory_lru_eviction():
+    cache = FrameCache(memory_bytes=3 * clip_size(clip(b"a")) - 1)
+    cache.put("a", clip(b"a"))
+    cache.put("b", clip(b"b"))
+    assert cache.get("a") == clip(b"a")     # a is now the most recently used
+    cache.put("c", clip(b"c"))
+    assert cache.get("b") is None
+    assert cache.get("a") == clip(b"a") and cache.get("c") == clip(b"c")
+    # Clips larger than the whole memory tier are not kept
+    cache.put("big", clip(b"x", 10000))
+    assert not cache.contains("big")
+
+    stats = cache.stats()
+    assert (stats["memoryHits"], stats["misses"], stats["memoryEvictions"]) == (3, 1, 1)
+    assert stats["memoryEntries"] == 2
+    assert stats["memoryBytes"] == 2 * clip_size(clip(b"a"))
+
+
+def test_disk_tier_is_shared(tmp_path):
+    cache = FrameCache(1 << 20, str(tmp_path / "cache"), 1 << 20)
+    assert cache.get("k1") is None
+    cache.put("k1", clip(b"a"))
+    # Another process sees the entry on disk, then keeps it in memory
+    other = FrameCache(1 << 20, str(tmp_path / "cache"), 1 << 20)
+    assert not other.contains("k1", memory_only=True) and other.contains("k1")
+    assert other.get("k1") == clip(b"a")
+    assert other.get("k1") == clip(b"a")
+    assert other.get("k2") is None
+    stats = other.stats()
+    assert (stats["diskHits"], stats["memoryHits"], stats["misses"], stats["hitRate"]) == (1, 1, 1, 0.667)
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_lru_eviction(tmp_path):
+    disk = DiskLRU(str(tmp_path / "cache"), 3000)
+    for age, key in enumerate(["a", "b", "c"]):
+        path = disk.write(key, b"x" * 1000)
+        os.utime(path, (100 + age, 100 + age))
+    assert disk.read("a") == b"x" * 1000       # touches a
+    disk.write("d", b"x" * 1000)
+    # Over the bound: least recently used entries go until it's back under 90%
+    assert [key for key in "abcd" if disk.read(key)] == ["a", "d"]
+    assert disk.evictions == 2
+
+
+def test_disk_lru_ignores_files_being_written(tmp_path):
+    disk = DiskLRU(str(tmp_path / "cache"), 3000)
+    tmp_paths = [disk.temp_path("a", ".webm"), disk.path_for("b") + ".1.2.tmp"]
+    for path in tmp_paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * 5000)
+        os.utime(path, (1, 1))
+    disk.write("c", b"x" * 1000)
+    disk.write("d", b"x" * 1000, ".mp4")
+    # In-flight temp files neither count towards the bound nor get evicted
+    assert disk._disk_usage()[0] == 2000
+    assert disk.evictions == 0 and all(os.path.exists(path) for path in tmp_paths)
+    disk.clear()
+    assert all(os.path.exists(path) for path in tmp_paths)
+
+
+def test_fetch_patient_dicoms_uses_cache(client, archive):
+    patients = scan(client, archive)
+    request = {"patientName": patient_name(patients, "p1"), "username": "bob"}
+    before = client.get("/frame-cache/stats").json()
+    first = client.post("/fetch-patient-dicoms", json=request).json()
+    assert [len(item["images"]) for item in first["dicoms"] + first["apngs"]] == [6, 4]
+    middle = client.get("/frame-cache/stats").json()
+    assert middle["misses"] - before["misses"] == 2
+    assert client.post("/fetch-patient-dicoms", json=request).json() == first
+    after = client.get("/frame-cache/stats").json()
+    assert after["memoryHits"] - middle["memoryHits"] == 2
+    assert after["misses"] == middle["misses"]
+
+
+def test_failed_renders_are_not_cached(client, archive):
+    broken = archive / "p2" / "broken.dcm"
+    data = (archive / "p1" / "a.dcm").read_bytes()
+    broken.write_bytes(data[:len(data) - 5000])
+    patients = scan(client, archive)
+    request = {"patientName": patient_name(patients, "p2"), "username": "bob"}
+    for _ in range(2):
+        before = client.get("/frame-cache/stats").json()
+        items = {item["dicomName"]: item for item in client.post("/fetch-patient-dicoms", json=request).json()["dicoms"]}
+        assert items["broken.dcm"]["images"] == []
+        assert client.get("/frame-cache/stats").json()["misses"] - before["misses"] >= 1
@@ -0,0 +1,100 @@
+import base64
+import json
+import os
+import struct
+
+import pytest
+
+from conftest import scan, patient_name
+from media_files import write_dicom, gradient_frames
+
+
+@pytest.fixture
+def clip_params(client, archive):
+    patients = scan(client, archive)
+    return {"username": "bob", "patientName": patient_name(patients, "p1"), "dicomName": "a.dcm"}
+
+
+def data_uri_bytes(src):
+    header, data = src.split(",", 1)
+    return header[len("data:"):-len(";base64")], base64.b64decode(data)
+
+
+def read_records(body):
+    records, offset = [], 0
+    while offset < len(body):
+        (header_len,) = struct.unpack(">I", body[offset:offset + 4])
+        header = json.loads(body[offset + 4:offset + 4 + header_len])
+        offset += 4 + header_len
+        records.append((header, body[offset:offset + header["size"]]))
+        offset += header["size"]
+    return records
+
+
+def test_clip_frame(client, clip_params):
+    inline = client.get("/fetch-clip", params=clip_params).json()["images"]
+    for index, image in enumerate(inline):
+        response = client.get("/clip-frame", params={**clip_params, "index": index})
+        assert response.status_code == 200
+        assert (response.headers["content-type"], response.content) == data_uri_bytes(image["src"])
+    assert client.get("/clip-frame", params={**clip_params, "index": len(inline)}).status_code == 404
+
+
+def test_clip_frame_etag(client, clip_params, archive):
+    params = {**clip_params, "index": 2}
+    etag = client.get("/clip-frame", params=params).headers["etag"]
+    assert etag != client.get("/clip-frame", params={**params, "index": 3}).headers["etag"]
+    response = client.get("/clip-frame", params=params, headers={"If-None-Match": etag})
+    assert (response.status_code, response.content) == (304, b"")
+
+    # Changing the file changes the ETag
+    path = archive / "p1" / "a.dcm"
+    mtime_ns = os.stat(path).st_mtime_ns
+    write_dicom(path, gradient_frames(6)[::-1])
+    os.utime(path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    response = client.get("/clip-frame", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["etag"] != etag
+
+
+def test_clip_frame_revalidation_does_not_render(client, clip_params, monkeypatch):
+    import main
+    params = {**clip_params, "index": 2}
+    etag = client.get("/clip-frame", params=params).headers["etag"]
+
+    def load_frame_range(*args):
+        raise AssertionError("rendered for a 304")
+    monkeypatch.setattr(main, "load_frame_range", load_frame_range)
+    response = client.get("/clip-frame", params=params, headers={"If-None-Match": etag})
+    assert (response.status_code, response.headers["etag"]) == (304, etag)
+
+
+def test_url_transport(client, clip_params):
+    inline = client.get("/fetch-clip", params={**clip_params, "end": 3}).json()["images"]
+    by_url = client.get("/fetch-clip", params={**clip_params, "end": 3, "transport": "url"}).json()["images"]
+    assert [image["id"] for image in by_url] == [image["id"] for image in inline]
+    for url_image, inline_image in zip(by_url, inline):
+        assert url_image["src"].startswith("/clip-frame?")
+        assert client.get(url_image["src"]).content == data_uri_bytes(inline_image["src"])[1]
+
+    patient = client.post("/fetch-patient-dicoms", json={
+        "username": "bob", "patientName": clip_params["patientName"], "transport": "url"
+    }).json()
+    assert all(image["src"].startswith("/clip-frame?") for item in patient["dicoms"] + patient["apngs"]
+               for image in item["images"])
+    assert client.get("/fetch-clip", params={**clip_params, "transport": "carrier-pigeon"}).status_code == 400
+
+
+def test_binary_stream(client, clip_params):
+    inline = client.get("/fetch-clip", params=clip_params).json()["images"]
+    response = client.get("/fetch-clip-binary", params=clip_params)
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["x-frame-count"] == "6"
+    records = read_records(response.content)
+    assert [header["id"] for header, _ in records] == [image["id"] for image in inline]
+    assert [(header["mime"], data) for header, data in records] == [data_uri_bytes(image["src"]) for image in inline]
+
+    records = read_records(client.get("/fetch-clip-binary", params={**clip_params, "start": 1, "stride": 2}).content)
+    assert [header["index"] for header, _ in records] == [1, 3, 5]
+
+    apng = client.get("/fetch-clip-binary", params={**clip_params, "dicomName": "loop.png"})
+    assert [header["delayMs"] for header, _ in read_records(apng.content)] == [40] * 4
@@ -0,0 +1,57 @@
+import label_store
+from conftest import scan, patient_name, reload_from_disk
+
+
+def labels(patients):
+    return {(patient["originalName"], clip["dicomName"]): clip["label"]
+            for patient in patients for clip in patient["dicoms"] + patient["apngs"]}
+
+
+def fetch_labels(client, username="bob"):
+    response = client.get("/fetch-csv", params={"username": username})
+    assert response.status_code == 200
+    return labels(response.json()["patients"])
+
+
+def set_labels(client, patients, *changes, username="bob"):
+    for original_name, dicom_name, label, kind in changes:
+        response = client.post("/update-csv", json={
+            "patientName": patient_name(patients, original_name), "dicomName": dicom_name,
+            "label": label, "kind": kind, "username": username
+        })
+        assert response.status_code == 200 and response.json()["success"]
+
+
+def test_labels_survive_a_restart(client, archive, label_backend, monkeypatch):
+    patients = scan(client, archive)
+    set_labels(client, patients, ("p1", "a.dcm", 2, "dicom"), ("p1", "loop.png", 3, "apng"))
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client) == {("p1", "a.dcm"): 2, ("p1", "loop.png"): 3, ("p2", "b"): 0}
+    assert set(fetch_labels(client, "eve").values()) == {0}
+
+
+def test_user_csv_is_imported_into_sqlite(client, archive, monkeypatch):
+    monkeypatch.setattr(label_store, "LABEL_BACKEND", "csv")
+    patients = scan(client, archive)
+    set_labels(client, patients, ("p2", "b", 4, "dicom"))
+
+    monkeypatch.setattr(label_store, "LABEL_BACKEND", "sqlite")
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client)[("p2", "b")] == 4
+
+
+def test_export_and_import(client, archive, label_backend, monkeypatch):
+    patients = scan(client, archive)
+    set_labels(client, patients, ("p1", "a.dcm", 1, "dicom"))
+    response = client.get("/export-csv", params={"username": "bob"})
+    assert response.status_code == 200
+    assert any(row.split(",")[3:5] == ["a.dcm", "1"] for row in response.text.splitlines())
+
+    # Edit the export and load it back
+    with open(label_store.get_user_csv_path("bob"), "w", newline="") as f:
+        f.write(response.text.replace(",a.dcm,1,", ",a.dcm,5,"))
+    assert client.post("/import-csv", params={"username": "bob"}).status_code == 200
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client)[("p1", "a.dcm")] == 5
+
+    assert client.get("/export-csv", params={"username": "nobody"}).status_code == 404
@@ -0,0 +1,73 @@
+from concurrent.futures import wait
+
+import pytest
+
+import label_store
+from conftest import scan, patient_name, reload_from_disk
+from test_label_backends import fetch_labels
+
+
+def test_batch_update(client, archive, label_backend, monkeypatch):
+    patients = scan(client, archive)
+    p1, p2 = patient_name(patients, "p1"), patient_name(patients, "p2")
+    response = client.post("/update-csv-batch", json={"username": "bob", "updates": [
+        {"patientName": p1, "dicomName": "a.dcm", "label": 1, "kind": "dicom"},
+        {"patientName": p1, "dicomName": "loop.png", "label": 2, "kind": "apng"},
+        {"patientName": p2, "dicomName": "b", "label": 3, "kind": "mp4"},
+        {"patientName": p2, "dicomName": "b", "label": 4, "kind": "dicom"},
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert not body["success"]
+    assert [result["success"] for result in body["results"]] == [True, True, False, True]
+    assert "kind" in body["results"][2]["error"]
+
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client) == {("p1", "a.dcm"): 1, ("p1", "loop.png"): 2, ("p2", "b"): 4}
+
+
+def test_coalesced_writes(client, archive, label_backend, monkeypatch):
+    patients = scan(client, archive)
+    p1 = patient_name(patients, "p1")
+    writer = label_store.LabelWriteCoalescer(0.2)
+    futures = [writer.submit("bob", {"patientName": p1, "dicomName": "a.dcm", "label": label, "kind": "dicom"})
+               for label in range(1, 6)]
+    futures.append(writer.submit("bob", {"patientName": p1, "dicomName": "loop.png", "label": 2, "kind": "apng"}))
+    wait(futures, timeout=10)
+    assert [future.result()["success"] for future in futures] == [True] * 6
+    # One write for the whole burst, applied in order
+    assert (writer.batches, writer.updates) == (1, 6)
+    reload_from_disk(monkeypatch)
+    labels = fetch_labels(client)
+    assert (labels[("p1", "a.dcm")], labels[("p1", "loop.png")]) == (5, 2)
+
+
+def test_update_csv_waits_for_its_write(client, archive, label_backend, monkeypatch):
+    patients = scan(client, archive)
+    response = client.post("/update-csv", json={
+        "patientName": patient_name(patients, "p2"), "dicomName": "b", "label": 3, "username": "bob"
+    })
+    assert response.json() == {"success": True}
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client)[("p2", "b")] == 3
+
+
+@pytest.mark.parametrize("change, error", [
+    ({"patientName": "Patient 1", "dicomName": "", "label": 1}, "required"),
+    ({"patientName": "Patient 1", "dicomName": "a.dcm", "label": "x"}, "integer"),
+    ({"patientName": "Patient 1", "dicomName": "a.dcm", "label": 1, "kind": "mp4"}, "Unknown kind"),
+])
+def test_invalid_updates(change, error):
+    with pytest.raises(ValueError, match=error):
+        label_store.validate_label_update(change)
+
+
+def test_update_csv_rejects_invalid_updates(client, archive):
+    patients = scan(client, archive)
+    p1 = patient_name(patients, "p1")
+    for update in ({"patientName": p1, "dicomName": ""},
+                   {"patientName": p1, "dicomName": "a.dcm", "kind": "mp4"}):
+        response = client.post("/update-csv", json=dict(update, label=1, username="bob"))
+        assert response.status_code == 400
+    assert label_store.validate_label_update({"patientName": p1, "dicomName": "a.dcm", "label": "2"}) == \
+        {"patientName": p1, "dicomName": "a.dcm", "label": 2, "kind": "dicom"}
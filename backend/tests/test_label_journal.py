@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import label_store
+from conftest import scan, reload_from_disk
+from test_label_backends import fetch_labels, set_labels
+
+
+@pytest.fixture
+def journaled(client, archive, monkeypatch):
+    monkeypatch.setattr(label_store, "LABEL_BACKEND", "journal")
+    patients = scan(client, archive)
+    csv_path = label_store.get_user_csv_path("bob")
+    return patients, csv_path, label_store.journal_path(csv_path)
+
+
+def test_updates_go_to_the_journal(client, journaled, monkeypatch):
+    patients, csv_path, journal = journaled
+    csv_before = open(csv_path).read()
+    set_labels(client, patients, ("p1", "a.dcm", 2, "dicom"), ("p1", "loop.png", 3, "apng"),
+               ("p1", "a.dcm", 1, "dicom"))
+    assert open(csv_path).read() == csv_before
+    assert len(label_store.read_journal(csv_path)) == 3
+
+    reload_from_disk(monkeypatch)
+    expected = {("p1", "a.dcm"): 1, ("p1", "loop.png"): 3, ("p2", "b"): 0}
+    assert fetch_labels(client) == expected
+
+    # Compaction folds the journal into the CSV
+    assert label_store.compact_journal(csv_path)
+    assert not os.path.exists(journal)
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client) == expected
+
+
+def test_torn_journal_line_is_skipped(client, journaled, monkeypatch):
+    patients, csv_path, journal = journaled
+    set_labels(client, patients, ("p1", "a.dcm", 2, "dicom"))
+    # A crash in the middle of an append
+    with open(journal, "a") as f:
+        f.write('{"patientName": "Patient')
+    set_labels(client, patients, ("p2", "b", 4, "dicom"))
+    assert len(label_store.read_journal(csv_path)) == 2
+    reload_from_disk(monkeypatch)
+    assert fetch_labels(client) == {("p1", "a.dcm"): 2, ("p1", "loop.png"): 0, ("p2", "b"): 4}
+
+
+def test_compactor_flush(client, journaled):
+    patients, csv_path, journal = journaled
+    set_labels(client, patients, ("p2", "b", 4, "dicom"))
+    label_store.journal_compactor.flush()
+    assert not os.path.exists(journal)
+    assert any(row.split(",")[3:5] == ["b", "4"] for row in open(csv_path).read().splitlines())
@@ -0,0 +1,180 @@
+import copy
+
+import pytest
+
+import label_store
+from conftest import reload_from_disk, scan, MANIFEST
+from media_files import build_archive
+from label_store import (set_user_labels, load_user_patients, load_user_patient, load_user_overlay,
+                         save_user_patients, create_user_labels, user_labels_exist, export_user_csv, save_to_csv,
+                         merge_labels, indexed_patients, MANIFEST_CSV_PATH)
+
+
+def labels(patient, key):
+    return [(clip["dicomName"], clip["label"]) for clip in patient[key]]
+
+
+def test_new_user_starts_from_the_manifest(manifest, label_backend):
+    assert not user_labels_exist("bob")
+    create_user_labels("bob")
+    assert user_labels_exist("bob")
+    assert load_user_overlay("bob") == []
+    patients = load_user_patients("bob")
+    assert [patient["patientName"] for patient in patients] == ["Patient 1", "Patient 2"]
+    assert labels(patients[0], "dicoms") == [("a.dcm", 0), ("b.dcm", 0)]
+    assert labels(patients[0], "apngs") == [("loop.png", 0)]
+    assert patients[0]["dicoms"][0]["filepath"] == "/archive/p1/a.dcm"
+
+
+def test_overlay_round_trip(manifest, label_backend, monkeypatch):
+    set_user_labels("bob", [
+        {"patientName": "Patient 1", "dicomName": "b.dcm", "label": 1, "kind": "dicom"},
+        {"patientName": "Patient 1", "dicomName": "loop.png", "label": 2, "kind": "apng"},
+        {"patientName": "Patient 2", "dicomName": "c.dcm", "label": 3, "kind": "dicom"},
+    ])
+    expected = load_user_patients("bob")
+    reload_from_disk(monkeypatch)
+    assert load_user_patients("bob") == expected
+    assert labels(expected[0], "dicoms") == [("a.dcm", 0), ("b.dcm", 1)]
+    assert labels(expected[0], "apngs") == [("loop.png", 2)]
+    assert labels(expected[1], "dicoms") == [("c.dcm", 3)]
+    assert load_user_patient("bob", "Patient 2") == expected[1]
+
+    # Saving the merged set back stores only the labeled clips
+    save_user_patients("bob", expected)
+    overlay = load_user_overlay("bob")
+    assert sum(len(p["dicoms"]) + len(p["apngs"]) for p in overlay) == 3
+    assert load_user_patients("bob") == expected
+
+    rows = export_user_csv("bob").splitlines()
+    assert rows[0].split(",") == label_store.CSV_HEADERS
+    assert "Patient 1,,scan,loop.png,2,/archive/p1/loop.png,8,,apng" in rows
+    assert len(rows) == 5
+
+
+def test_later_scans_show_up(manifest, label_backend):
+    set_user_labels("bob", [{"patientName": "Patient 2", "dicomName": "c.dcm", "label": 3, "kind": "dicom"}])
+    rescanned = copy.deepcopy(MANIFEST)
+    rescanned[1]["dicoms"].append({"dicomName": "d.dcm", "label": 0, "filepath": "/archive/p2/d.dcm",
+                                   "frameCount": 9})
+    save_to_csv(rescanned, MANIFEST_CSV_PATH)
+    assert labels(load_user_patient("bob", "Patient 2"), "dicoms") == [("c.dcm", 3), ("d.dcm", 0)]
+
+
+def test_full_label_sets_still_read_back(manifest, label_backend, monkeypatch):
+    # A user CSV from before overlays: a full copy of the manifest
+    full = copy.deepcopy(MANIFEST)
+    full[0]["dicoms"][1]["label"] = 4
+    save_to_csv(full, label_store.get_user_csv_path("bob"))
+    reload_from_disk(monkeypatch)
+    patient = load_user_patient("bob", "Patient 1")
+    assert labels(patient, "dicoms") == [("a.dcm", 0), ("b.dcm", 4)]
+
+
+def test_apng_label_without_kind(manifest, label_backend):
+    assert set_user_labels("bob", [{"patientName": "Patient 1", "dicomName": "loop.png", "label": 2}]) == [
+        {"success": True}
+    ]
+    patient = load_user_patient("bob", "Patient 1")
+    assert labels(patient, "apngs") == [("loop.png", 2)]
+    assert labels(patient, "dicoms") == [("a.dcm", 0), ("b.dcm", 0)]
+    overlay = load_user_overlay("bob")
+    assert [(labels(p, "dicoms"), labels(p, "apngs")) for p in overlay] == [([], [("loop.png", 2)])]
+
+
+def test_given_kind_is_corrected_from_the_manifest(manifest, label_backend):
+    set_user_labels("bob", [{"patientName": "Patient 1", "dicomName": "loop.png", "label": 3, "kind": "dicom"}])
+    patient = load_user_patient("bob", "Patient 1")
+    assert labels(patient, "apngs") == [("loop.png", 3)]
+    assert [clip["dicomName"] for clip in patient["dicoms"]] == ["a.dcm", "b.dcm"]
+
+
+def test_label_zero_removes_the_overlay_row(manifest, label_backend, monkeypatch):
+    set_user_labels("bob", [
+        {"patientName": "Patient 1", "dicomName": "a.dcm", "label": 1},
+        {"patientName": "Patient 1", "dicomName": "loop.png", "label": 2},
+    ])
+    set_user_labels("bob", [
+        {"patientName": "Patient 1", "dicomName": "a.dcm", "label": 0},
+        {"patientName": "Patient 1", "dicomName": "loop.png", "label": 0},
+    ])
+    assert load_user_overlay("bob") == []
+    reload_from_disk(monkeypatch)
+    assert load_user_overlay("bob") == []
+    patient = load_user_patient("bob", "Patient 1")
+    assert labels(patient, "dicoms") == [("a.dcm", 0), ("b.dcm", 0)]
+    assert labels(patient, "apngs") == [("loop.png", 0)]
+
+
+def test_unknown_clips_are_rejected(manifest, label_backend):
+    results = set_user_labels("bob", [
+        {"patientName": "Patient 1", "dicomName": "missing.dcm", "label": 1},
+        {"patientName": "Patient 9", "dicomName": "a.dcm", "label": 1},
+        {"patientName": "Patient 2", "dicomName": "c.dcm", "label": 4},
+    ])
+    assert [result["success"] for result in results] == [False, False, True]
+    assert "Unknown clip" in results[0]["error"]
+    patients = load_user_patients("bob")
+    assert [patient["patientName"] for patient in patients] == ["Patient 1", "Patient 2"]
+    assert labels(patients[1], "dicoms") == [("c.dcm", 4)]
+
+
+def test_merge_applies_dicom_rows_to_apngs_of_the_same_name(manifest):
+    # Labels written without a kind before the manifest lookup were stored as dicoms
+    overlay = [{"patientName": "Patient 1", "dicoms": [{"dicomName": "loop.png", "label": 5}], "apngs": []}]
+    patient = merge_labels(indexed_patients(MANIFEST_CSV_PATH), overlay)[0]
+    assert labels(patient, "apngs") == [("loop.png", 5)]
+    assert [clip["dicomName"] for clip in patient["dicoms"]] == ["a.dcm", "b.dcm"]
+
+
+@pytest.mark.parametrize("label_backend", ["sqlite"], indirect=True)
+def test_update_csv_without_kind(client, manifest, label_backend):
+    response = client.post("/update-csv", json={
+        "patientName": "Patient 1", "dicomName": "loop.png", "label": 2, "username": "bob"
+    })
+    assert response.status_code == 200
+    patients = client.get("/fetch-csv", params={"username": "bob"}).json()["patients"]
+    assert labels(patients[0], "apngs") == [("loop.png", 2)]
+    assert [clip["dicomName"] for clip in patients[0]["dicoms"]] == ["a.dcm", "b.dcm"]
+    response = client.post("/update-csv", json={
+        "patientName": "Patient 1", "dicomName": "missing.dcm", "label": 2, "username": "bob"
+    })
+    assert response.status_code == 400
+
+
+def test_clips_missing_from_the_manifest_are_left_out(manifest, label_backend):
+    # e.g. labels of clips a later scan no longer found
+    overlay = [
+        {"patientName": "Patient 1", "dicoms": [{"dicomName": "gone.dcm", "label": 2}], "apngs": []},
+        {"patientName": "Patient 9", "dicoms": [{"dicomName": "a.dcm", "label": 1}], "apngs": []},
+    ]
+    patients = merge_labels(indexed_patients(MANIFEST_CSV_PATH), overlay)
+    assert [patient["patientName"] for patient in patients] == ["Patient 1", "Patient 2"]
+    assert labels(patients[0], "dicoms") == [("a.dcm", 0), ("b.dcm", 0)]
+
+    save_to_csv(overlay, label_store.get_user_csv_path("bob"))
+    assert load_user_patient("bob", "Patient 9") is None
+    assert [patient["patientName"] for patient in load_user_patients("bob")] == ["Patient 1", "Patient 2"]
+
+
+def test_scans_of_other_sources_are_merged_into_the_manifest(client, archive, workdir):
+    bob = scan(client, archive)
+    p1 = next(patient["patientName"] for patient in bob if patient["originalName"] == "p1")
+    assert set_user_labels("bob", [{"patientName": p1, "dicomName": "a.dcm", "label": 3}])[0]["success"]
+
+    other = build_archive(workdir / "other")
+    alice = scan(client, other, "alice", butterfly_directory_path="", vave_directory_path=str(other))
+    assert sorted(patient["source"] for patient in alice) == ["butterfly", "butterfly", "vave", "vave"]
+    assert len({patient["patientName"] for patient in alice}) == 4
+
+    # Bob keeps their patients and label, and sees the new source's patients too
+    patients = {patient["patientName"]: patient for patient in load_user_patients("bob")}
+    assert set(patients) == {patient["patientName"] for patient in alice}
+    assert labels(patients[p1], "dicoms") == [("a.dcm", 3)]
+
+    # Rescanning a source only replaces that source's patients
+    (archive / "p2" / "scans" / "b").unlink()
+    scan(client, archive)
+    sources = sorted(patient["source"] for patient in indexed_patients(MANIFEST_CSV_PATH))
+    assert sources == ["butterfly", "vave", "vave"]
+    assert labels(load_user_patient("bob", p1), "dicoms") == [("a.dcm", 3)]
@@ -0,0 +1,59 @@
+import os
+
+import label_store
+from label_store import save_to_csv, indexed_patients, indexed_patient, append_journal
+
+
+def patients(label=0):
+    return [
+        {"patientName": "Patient 1", "originalName": "p1", "source": "butterfly",
+         "dicoms": [{"dicomName": "a.dcm", "label": label, "filepath": "/archive/p1/a.dcm", "frameCount": 6}],
+         "apngs": [{"dicomName": "loop.png", "label": 0, "filepath": "/archive/p1/loop.png", "frameCount": 4}]},
+        {"patientName": "Patient 2", "originalName": "p2", "source": "butterfly",
+         "dicoms": [{"dicomName": "b", "label": 0, "filepath": "/archive/p2/scans/b", "frameCount": 1}],
+         "apngs": []},
+    ]
+
+
+def dicom_labels(patient):
+    return [(clip["dicomName"], clip["label"]) for clip in patient["dicoms"]]
+
+
+def test_reads_are_served_from_memory(workdir):
+    save_to_csv(patients(), "labels.csv")
+    index = label_store.patient_index
+    for _ in range(3):
+        assert [patient["patientName"] for patient in indexed_patients("labels.csv")] == ["Patient 1", "Patient 2"]
+        assert dicom_labels(indexed_patient("labels.csv", "Patient 2")) == [("b", 0)]
+    assert indexed_patient("labels.csv", "Patient 9") is None
+    # save_to_csv wrote through, so nothing was parsed
+    assert index.loads == 0
+
+
+def test_callers_get_copies(workdir):
+    save_to_csv(patients(), "labels.csv")
+    indexed_patient("labels.csv", "Patient 1")["dicoms"][0]["label"] = 7
+    indexed_patients("labels.csv")[0]["dicoms"].clear()
+    assert dicom_labels(indexed_patient("labels.csv", "Patient 1")) == [("a.dcm", 0)]
+
+
+def test_files_changed_elsewhere_are_reloaded(workdir):
+    save_to_csv(patients(), "labels.csv")
+    index = label_store.patient_index
+    # Another process rewrites the file behind this one's back
+    with open("labels.csv") as f:
+        text = f.read()
+    with open("labels.csv", "w") as f:
+        f.write(text.replace(",a.dcm,0,", ",a.dcm,3,"))
+    stat = os.stat("labels.csv")
+    os.utime("labels.csv", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert dicom_labels(indexed_patient("labels.csv", "Patient 1")) == [("a.dcm", 3)]
+    assert index.loads == 1
+
+
+def test_journal_appends_write_through(workdir):
+    save_to_csv(patients(), "labels.csv")
+    indexed_patients("labels.csv")
+    append_journal("labels.csv", [{"patientName": "Patient 1", "dicomName": "a.dcm", "kind": "dicom", "label": 2}])
+    assert dicom_labels(indexed_patient("labels.csv", "Patient 1")) == [("a.dcm", 2)]
+    assert label_store.patient_index.loads == 0
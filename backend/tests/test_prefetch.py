@@ -0,0 +1,109 @@
+import time
+
+import pytest
+
+from conftest import scan
+from frame_cache import frame_cache, cache_key
+from media import render_params
+from media_files import write_dicom, gradient_frames
+
+CLIPS = {"p1": ["a.dcm", "loop.png"], "p2": ["b"], "p3": ["c.dcm", "d.dcm"]}
+
+
+@pytest.fixture
+def patients(client, archive):
+    (archive / "p3").mkdir()
+    write_dicom(archive / "p3" / "c.dcm", gradient_frames(3))
+    write_dicom(archive / "p3" / "d.dcm", gradient_frames(2))
+    # In the user's (shuffled) patient order
+    return scan(client, archive)
+
+
+@pytest.fixture
+def prefetcher(monkeypatch):
+    import main
+    prefetcher = main.Prefetcher(2, 1 << 30)
+    monkeypatch.setattr(main, "prefetcher", prefetcher)
+    return prefetcher
+
+
+def names(clips):
+    return [name for _, _, name in clips]
+
+
+def clips_of(*patients):
+    return [name for patient in patients for name in CLIPS[patient["originalName"]]]
+
+
+def cached(clips, profile=None):
+    return [frame_cache.contains(cache_key(filepath, render_params(kind, profile, None, False)))
+            for kind, filepath, _ in clips]
+
+
+def label_all(client, patient):
+    updates = [{"patientName": patient["patientName"], "dicomName": clip["dicomName"], "label": 1, "kind": kind}
+               for kind, key in (("dicom", "dicoms"), ("apng", "apngs")) for clip in patient[key]]
+    assert client.post("/update-csv-batch", json={"username": "bob", "updates": updates}).json()["success"]
+
+
+def test_upcoming_clips_skip_labeled_patients(client, patients, prefetcher):
+    first, second, third = patients
+    assert names(prefetcher.upcoming_clips("bob", first["patientName"])) == clips_of(second, third)
+    assert prefetcher.upcoming_clips("bob", third["patientName"]) == []
+    assert prefetcher.upcoming_clips("bob", "Patient 9") == []
+
+    label_all(client, second)
+    assert names(prefetcher.upcoming_clips("bob", first["patientName"])) == clips_of(third)
+    prefetcher.depth = 1
+    assert names(prefetcher.upcoming_clips("bob", first["patientName"])) == clips_of(third)
+
+
+def test_prefetch_warms_the_frame_cache(patients, prefetcher):
+    first = patients[0]["patientName"]
+    clips = prefetcher.upcoming_clips("bob", first)
+    assert not any(cached(clips))
+    lookups = [frame_cache.stats()[counter] for counter in ("memoryHits", "diskHits", "misses")]
+    prefetcher._generations["bob"] = 1
+    prefetcher._prefetch("bob", 1, first, None, None, False)
+    assert all(cached(clips))
+    assert prefetcher.stats()["clipsWarmed"] == len(clips)
+    # Background renders stay out of the hit rate
+    assert [frame_cache.stats()[counter] for counter in ("memoryHits", "diskHits", "misses")] == lookups
+    # Already cached clips are skipped
+    prefetcher._prefetch("bob", 1, first, None, None, False)
+    assert prefetcher.stats()["clipsWarmed"] == len(clips)
+
+
+def test_prefetch_stops_at_the_byte_budget(patients, prefetcher):
+    prefetcher.max_bytes = 1
+    prefetcher._generations["bob"] = 1
+    prefetcher._prefetch("bob", 1, patients[0]["patientName"], "lossless", None, False)
+    assert prefetcher.stats()["clipsWarmed"] == 1
+
+
+def test_superseded_plans_stop(patients, prefetcher):
+    first = patients[0]["patientName"]
+    prefetcher.cancel("bob")
+    prefetcher._prefetch("bob", 0, first, "preview", None, False)
+    stats = prefetcher.stats()
+    assert (stats["clipsWarmed"], stats["cancelled"]) == (0, 1)
+    assert not any(cached(prefetcher.upcoming_clips("bob", first), "preview"))
+
+
+def test_serving_a_patient_prefetches_the_next(client, patients, prefetcher):
+    first, second = patients[0], patients[1]
+    request = {"username": "bob", "profile": "preview"}
+    response = client.post("/fetch-patient-dicoms", json={**request, "patientName": first["patientName"]})
+    assert response.status_code == 200
+    warmed = len(clips_of(*patients[1:]))
+    deadline = time.monotonic() + 10
+    while client.get("/frame-cache/stats").json()["prefetch"]["clipsWarmed"] < warmed:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    before = client.get("/frame-cache/stats").json()
+    response = client.post("/fetch-patient-dicoms", json={**request, "patientName": second["patientName"]})
+    assert response.status_code == 200
+    after = client.get("/frame-cache/stats").json()
+    assert after["memoryHits"] - before["memoryHits"] == len(clips_of(second))
+    assert after["misses"] == before["misses"]
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+import prerender
+from frame_cache import FrameCache, cache_key
+from label_store import MANIFEST_CSV_PATH
+from media import render_params, thumbnail_params, THUMBNAIL_SIZE
+from conftest import scan
+
+
+@pytest.fixture
+def clips(client, archive):
+    scan(client, archive)
+    return prerender.manifest_clips(MANIFEST_CSV_PATH)
+
+
+@pytest.fixture
+def cache(workdir):
+    return FrameCache(0, str(workdir / "cache"), 1 << 30)
+
+
+def run(clips, cache, workdir, **options):
+    return prerender.prerender(clips, cache, workers=1, state_path=str(workdir / "state.json"), **options)
+
+
+def test_manifest_clips(clips):
+    assert sorted((kind, name) for kind, _, name in clips) == [("apng", "loop.png"), ("dicom", "a.dcm"),
+                                                               ("dicom", "b")]
+
+
+def test_prerender_is_resumable(clips, cache, workdir):
+    stats = run(clips, cache, workdir)
+    assert (stats.rendered, stats.skipped, stats.failed) == (3, 0, 0)
+    # The server's keys are hits, from a separate cache on the same directory
+    server = FrameCache(1 << 20, str(workdir / "cache"), 1 << 30)
+    for kind, filepath, _ in clips:
+        assert server.get(cache_key(filepath, render_params(kind))) is not None
+
+    stats = run(clips, cache, workdir)
+    assert (stats.rendered, stats.skipped) == (0, 3)
+    stats = run(clips, cache, workdir, profile="preview")
+    assert (stats.rendered, stats.skipped) == (3, 0)
+
+
+def test_thumbnails(clips, cache, workdir):
+    stats = run(clips, cache, workdir, thumbnails=True)
+    assert (stats.total, stats.rendered) == (6, 6)
+    kind, filepath, _ = clips[0]
+    assert cache.contains(cache_key(filepath, thumbnail_params(kind, None, THUMBNAIL_SIZE)))
+
+
+def test_failures_are_remembered(cache, workdir):
+    bad = workdir / "bad.dcm"
+    bad.write_bytes(b"not a dicom")
+    clips = [("dicom", str(bad), "bad.dcm"), ("dicom", str(workdir / "gone.dcm"), "gone.dcm")]
+    stats = run(clips, cache, workdir)
+    assert (stats.failed, stats.missing, stats.rendered) == (1, 1, 0)
+    failures = json.loads((workdir / "state.json").read_text())["failures"]
+    assert [failure["name"] for failure in failures.values()] == ["bad.dcm"]
+
+    stats = run(clips, cache, workdir)
+    assert (stats.failed, stats.failed_before) == (0, 1)
+    stats = run(clips, cache, workdir, retry_failed=True)
+    assert (stats.failed, stats.failed_before) == (1, 0)
+
+
+def test_cli(clips, workdir, monkeypatch):
+    monkeypatch.setattr(prerender, "FRAME_CACHE_DIR", str(workdir / "cache"))
+    argv = ["--manifest", str(workdir / MANIFEST_CSV_PATH), "--state", str(workdir / "state.json"),
+            "--workers", "1", "--preview"]
+    assert prerender.main(argv) == 0
+    cache = FrameCache(0, str(workdir / "cache"), 1 << 30)
+    assert all(cache.contains(cache_key(filepath, render_params(kind, "preview", 256))) for kind, filepath, _ in clips)
+    assert (workdir / "state.json").exists()
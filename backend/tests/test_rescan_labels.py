@@ -0,0 +1,23 @@
+from conftest import scan, patient_name
+
+
+def labels(patients):
+    return {(patient["originalName"], clip["dicomName"]): clip["label"]
+            for patient in patients for clip in patient["dicoms"] + patient["apngs"]}
+
+
+def test_rescan_keeps_labels(client, archive):
+    patients = scan(client, archive)
+    for original_name, dicom_name, label, kind in (("p1", "a.dcm", 2, "dicom"), ("p1", "loop.png", 3, "apng"),
+                                                   ("p2", "b", 1, "dicom")):
+        response = client.post("/update-csv", json={
+            "patientName": patient_name(patients, original_name), "dicomName": dicom_name,
+            "label": label, "kind": kind, "username": "bob"
+        })
+        assert response.status_code == 200
+
+    expected = {("p1", "a.dcm"): 2, ("p1", "loop.png"): 3, ("p2", "b"): 1}
+    assert labels(scan(client, archive)) == expected
+    assert labels(scan(client, archive, full_rescan=True)) == expected
+    # Labels belong to the user who gave them
+    assert set(labels(scan(client, archive, username="eve")).values()) == {0}
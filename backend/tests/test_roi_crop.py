@@ -0,0 +1,85 @@
+import base64
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import scan, patient_name
+from media import detect_roi
+from media_files import write_dicom
+
+
+def sector_clip(count=10, height=200, width=300):
+    """Speckle in a box at x 60..240, y 40..180, a static UI bar and a small blinking timestamp"""
+    rng = np.random.default_rng(0)
+    frames = np.zeros((count, height, width), dtype=np.uint8)
+    frames[:, 40:180, 60:240] = rng.integers(20, 230, (count, 140, 180))
+    frames[:, 5:15, 10:290] = 200
+    frames[::2, 185:192, 270:277] = 255
+    return frames
+
+
+def decode_src(src):
+    data = base64.b64decode(src.split(",", 1)[1])
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def test_detect_roi():
+    assert detect_roi(list(sector_clip())) == (56, 36, 188, 148)
+
+
+def test_nothing_to_crop():
+    assert detect_roi([]) is None
+    still = np.full((10, 100, 100), 80, dtype=np.uint8)
+    assert detect_roi(list(still)) is None
+    # Motion everywhere: the box would be the whole frame
+    noise = np.random.default_rng(1).integers(0, 255, (6, 100, 100), dtype=np.uint8)
+    assert detect_roi(list(noise)) is None
+    # Too small to be a sector
+    blink = np.zeros((6, 100, 100), dtype=np.uint8)
+    blink[::2, 10:14, 10:14] = 255
+    assert detect_roi(list(blink)) is None
+
+
+def test_single_frame_uses_max_projection():
+    frame = np.zeros((100, 100), dtype=np.uint8)
+    frame[20:70, 30:80] = 120
+    assert detect_roi([frame]) == (26, 16, 58, 58)
+
+
+@pytest.fixture
+def fetch(client, archive):
+    write_dicom(archive / "p1" / "sector.dcm", sector_clip())
+    patients = scan(client, archive)
+    params = {"username": "bob", "patientName": patient_name(patients, "p1"), "dicomName": "sector.dcm"}
+
+    def fetch(path, **query):
+        return client.get(path, params={**params, **query})
+    return fetch
+
+
+def test_cropped_clip(fetch):
+    body = fetch("/fetch-clip", crop="true", profile="lossless").json()
+    assert body["roi"] == {"x": 56, "y": 36, "width": 188, "height": 148, "sourceWidth": 300, "sourceHeight": 200}
+    assert len(body["images"]) == 10
+    assert decode_src(body["images"][0]["src"]).shape[:2] == (148, 188)
+
+    body = fetch("/fetch-clip", profile="lossless").json()
+    assert "roi" not in body
+    assert decode_src(body["images"][0]["src"]).shape[:2] == (200, 300)
+
+
+def test_cropped_binary_stream(fetch):
+    response = fetch("/fetch-clip-binary", crop="true")
+    assert response.status_code == 200
+    assert json.loads(response.headers["x-clip-roi"])["width"] == 188
+    assert "x-clip-roi" not in fetch("/fetch-clip-binary").headers
+
+
+def test_cropped_thumbnails(fetch):
+    body = fetch("/patient-thumbnails", crop="true").json()
+    item = next(item for item in body["dicoms"] if item["dicomName"] == "sector.dcm")
+    assert (item["roi"]["width"], item["roi"]["height"]) == (188, 148)
+    image = decode_src(item["thumbnail"]["src"])
+    assert image.shape[:2] == (101, 128)
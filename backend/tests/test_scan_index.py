@@ -0,0 +1,93 @@
+import json
+import os
+
+import scanner
+from conftest import scan, clip_names
+from media_files import write_dicom, write_apng, gradient_frames
+from scanner import scan_sources, load_scan_index, save_scan_index
+
+
+def rescan(archive, index, **options):
+    return scan_sources([(str(archive), "butterfly")], workers=2, executor_kind="thread", index=index, **options)
+
+
+def count_probes(monkeypatch):
+    probed = []
+    probe_file = scanner.probe_file
+
+    def counting_probe(filepath):
+        probed.append(os.path.basename(filepath))
+        return probe_file(filepath)
+
+    monkeypatch.setattr(scanner, "probe_file", counting_probe)
+    return probed
+
+
+def touch_later(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_incremental_rescan_matches_full_scan(archive, monkeypatch):
+    index = {}
+    assert rescan(archive, index) == rescan(archive, None)
+    assert index[str(archive / "p1" / "a.dcm")]["frameCount"] == 6
+    assert index[str(archive / "p1" / "still.png")]["kind"] is None
+
+    # Change, add and delete files
+    write_dicom(archive / "p1" / "a.dcm", gradient_frames(9))
+    touch_later(archive / "p1" / "a.dcm")
+    write_apng(archive / "p2" / "new.png", gradient_frames(3, 16, 16))
+    os.remove(archive / "p2" / "scans" / "b")
+
+    probed = count_probes(monkeypatch)
+    incremental = rescan(archive, index)
+    assert sorted(probed) == ["a.dcm", "new.png"]
+    assert incremental == rescan(archive, None)
+    assert incremental["butterfly:p1"]["dicoms"]["a.dcm"]["frameCount"] == 9
+    assert list(incremental["butterfly:p2"]["apngs"]) == ["new.png"]
+
+
+def test_unchanged_files_are_not_probed_again(archive, monkeypatch):
+    index = {}
+    rescan(archive, index)
+    probed = count_probes(monkeypatch)
+    rescan(archive, index)
+    assert probed == []
+    rescan(archive, index, reprobe=True)
+    assert sorted(probed) == ["a.dcm", "b", "loop.png", "notes.txt", "still.png"]
+
+
+def test_deleted_files_are_pruned(archive):
+    other = str(archive.parent / "elsewhere" / "x.dcm")
+    index = {other: {"size": 1, "mtime": 1, "kind": "dicom", "frameCount": 1}}
+    rescan(archive, index)
+    os.remove(archive / "p1" / "loop.png")
+    rescan(archive, index)
+    assert str(archive / "p1" / "loop.png") not in index
+    assert str(archive / "p1" / "a.dcm") in index
+    # Entries outside the scanned roots are left alone
+    assert other in index
+
+
+def test_index_round_trip(workdir, archive):
+    index = {}
+    rescan(archive, index)
+    save_scan_index(index, "index.json")
+    assert load_scan_index("index.json") == index
+
+    with open("index.json") as f:
+        data = json.load(f)
+    data["version"] = -1
+    with open("index.json", "w") as f:
+        json.dump(data, f)
+    assert load_scan_index("index.json") == {}
+    assert load_scan_index("missing.json") == {}
+
+
+def test_rescan_endpoint_drops_deleted_clips(client, archive):
+    scan(client, archive)
+    os.remove(archive / "p1" / "loop.png")
+    patients = scan(client, archive)
+    assert clip_names(patients, "apngs") == {"p1": [], "p2": []}
+    assert clip_names(scan(client, archive, full_rescan=True)) == {"p1": ["a.dcm"], "p2": ["b"]}
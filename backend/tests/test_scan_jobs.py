@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+
+import pytest
+
+import scanner
+from conftest import scan
+from scanner import scan_sources, ScanProgress, ScanCancelled
+
+
+def test_progress_counters(archive):
+    progress = ScanProgress()
+    scan_sources([(str(archive), "butterfly")], workers=2, executor_kind="thread", progress=progress)
+    snapshot = progress.snapshot()
+    assert (snapshot["filesSeen"], snapshot["dicomsFound"], snapshot["apngsFound"]) == (5, 2, 1)
+
+
+def test_cancel_stops_the_scan(archive, monkeypatch):
+    progress = ScanProgress()
+    probe_file = scanner.probe_file
+
+    def cancelling_probe(filepath):
+        progress.cancel()
+        return probe_file(filepath)
+
+    monkeypatch.setattr(scanner, "probe_file", cancelling_probe)
+    index = {str(archive / "gone.dcm"): {"size": 1, "mtime": 1, "kind": "dicom", "frameCount": 1}}
+    with pytest.raises(ScanCancelled):
+        scan_sources([(str(archive), "butterfly")], workers=1, executor_kind="thread", chunk_size=1,
+                     index=index, progress=progress)
+    # A cancelled scan doesn't prune the index
+    assert str(archive / "gone.dcm") in index
+
+
+def wait_for(client, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        snapshot = client.get(f"/scan-jobs/{job_id}").json()
+        if snapshot["status"] in ("completed", "failed", "cancelled"):
+            return snapshot
+        time.sleep(0.02)
+    raise AssertionError(f"scan job {job_id} did not finish")
+
+
+def test_scan_job(client, archive):
+    job = client.post("/scan-jobs", json={"butterfly_directory_path": str(archive), "username": "bob"}).json()
+    snapshot = wait_for(client, job["jobId"])
+    assert snapshot["status"] == "completed"
+    assert (snapshot["filesSeen"], snapshot["dicomsFound"], snapshot["apngsFound"]) == (5, 2, 1)
+    assert snapshot["patientCount"] == 2
+
+    result = client.get(f"/scan-jobs/{job['jobId']}/result")
+    assert result.status_code == 200
+    assert result.json()["patients"] == scan(client, archive)
+
+    # The event stream of a finished job ends with its final status
+    events = [json.loads(line[len("data: "):])
+              for line in client.get(f"/scan-jobs/{job['jobId']}/events").text.splitlines() if line]
+    assert events[-1]["status"] == "completed"
+
+    assert client.get("/scan-jobs/unknown").status_code == 404
+
+
+def test_cancel_scan_job(client, archive, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    probe_file = scanner.probe_file
+
+    def blocking_probe(filepath):
+        started.set()
+        release.wait(10)
+        return probe_file(filepath)
+
+    monkeypatch.setattr(scanner, "probe_file", blocking_probe)
+    job = client.post("/scan-jobs", json={"butterfly_directory_path": str(archive), "username": "bob"}).json()
+    assert started.wait(10)
+    client.delete(f"/scan-jobs/{job['jobId']}")
+    release.set()
+    assert wait_for(client, job["jobId"])["status"] == "cancelled"
+    assert client.get(f"/scan-jobs/{job['jobId']}/result").status_code != 200
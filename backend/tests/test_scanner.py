@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import scan, clip_names
+from scanner import scan_sources, probe_file
+
+
+def test_probe_file(archive):
+    assert probe_file(str(archive / "p1" / "a.dcm")) == ("dicom", 6)
+    assert probe_file(str(archive / "p1" / "loop.png")) == ("apng", 4)
+    assert probe_file(str(archive / "p2" / "scans" / "b")) == ("dicom", 1)
+    assert probe_file(str(archive / "p1" / "still.png")) is None
+    assert probe_file(str(archive / "p1" / "notes.txt")) is None
+
+
+def describe(patients_by_source):
+    return {
+        key: {kind: {name: (clip["frameCount"], clip["filepath"]) for name, clip in patient[kind].items()}
+              for kind in ("dicoms", "apngs")}
+        for key, patient in patients_by_source.items()
+    }
+
+
+@pytest.mark.parametrize("executor_kind", ["thread", "process"])
+def test_scan_sources(archive, executor_kind):
+    patients = scan_sources([(str(archive), "butterfly"), ("", "vave")], workers=2,
+                            executor_kind=executor_kind, chunk_size=1)
+    assert describe(patients) == {
+        "butterfly:p1": {
+            "dicoms": {"a.dcm": (6, str(archive / "p1" / "a.dcm"))},
+            "apngs": {"loop.png": (4, str(archive / "p1" / "loop.png"))},
+        },
+        "butterfly:p2": {
+            "dicoms": {"b": (1, str(archive / "p2" / "scans" / "b"))},
+            "apngs": {},
+        },
+    }
+
+
+def test_sources_are_kept_apart(archive):
+    patients = scan_sources([(str(archive), "butterfly"), (str(archive / "p1"), "vave")], workers=2)
+    # Below the vave root the patient folders are one level deeper; only the nested ones count
+    assert sorted(patients) == ["butterfly:p1", "butterfly:p2"]
+    patients = scan_sources([(str(archive), "butterfly"), (str(archive), "vave")], workers=2)
+    assert describe(patients)["vave:p1"] == describe(patients)["butterfly:p1"]
+
+
+def test_scan_directory(client, archive):
+    patients = scan(client, archive)
+    assert sorted(patient["patientName"] for patient in patients) == ["Patient 1", "Patient 2"]
+    assert clip_names(patients) == {"p1": ["a.dcm"], "p2": ["b"]}
+    assert clip_names(patients, "apngs") == {"p1": ["loop.png"], "p2": []}
+    # Rescanning keeps the patient numbering
+    assert scan(client, archive) == patients
@@ -0,0 +1,86 @@
+import base64
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import scan, patient_name
+from media import pick_keyframe
+from media_files import write_dicom
+
+LEVELS = [0, 100, 110, 120, 255]
+
+
+@pytest.fixture
+def fetch(client, archive):
+    frames = np.stack([np.full((400, 600), level, dtype=np.uint8) for level in LEVELS])
+    write_dicom(archive / "p1" / "big.dcm", frames)
+    patients = scan(client, archive)
+    params = {"username": "bob", "patientName": patient_name(patients, "p1")}
+
+    def fetch(path, **query):
+        return client.get(path, params={**params, **query})
+    return fetch
+
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def decode_src(src):
+    header, data = src.split(",", 1)
+    return header[len("data:"):-len(";base64")], decode(base64.b64decode(data))
+
+
+def test_pick_keyframe():
+    frames = [np.full((40, 40), level, dtype=np.uint8) for level in LEVELS]
+    # Mean level is 117; the frame closest to it wins over the blank and saturated ones
+    assert pick_keyframe(frames) == 3
+    assert pick_keyframe(frames[:2]) == 0
+
+
+def test_patient_thumbnails(fetch):
+    body = fetch("/patient-thumbnails").json()
+    items = {item["dicomName"]: item for item in body["dicoms"] + body["apngs"]}
+    assert set(items) == {"a.dcm", "big.dcm", "loop.png"}
+    big = items["big.dcm"]
+    assert (big["kind"], big["frameCount"], big["keyframe"]) == ("dicom", 5, 3)
+    assert big["thumbnail"]["id"] == "big.dcm-4"
+    mime, image = decode_src(big["thumbnail"]["src"])
+    assert mime == "image/webp"
+    assert image.shape[:2] == (85, 128)
+    assert abs(int(image.mean()) - 120) <= 3
+    assert items["loop.png"]["frameCount"] == 4
+
+    items = {item["dicomName"]: item for item in fetch("/patient-thumbnails", size=64).json()["dicoms"]}
+    image = decode_src(items["big.dcm"]["thumbnail"]["src"])[1]
+    assert max(image.shape[:2]) == 64
+
+
+def test_thumbnail_of_a_missing_file(fetch, archive):
+    os.remove(archive / "p1" / "a.dcm")
+    items = {item["dicomName"]: item for item in fetch("/patient-thumbnails").json()["dicoms"]}
+    assert (items["a.dcm"]["thumbnail"], items["a.dcm"]["error"]) == (None, "Missing file")
+    assert items["big.dcm"]["thumbnail"]
+
+
+def test_bad_thumbnail_requests(fetch):
+    assert fetch("/patient-thumbnails", size=8).status_code == 400
+    assert fetch("/patient-thumbnails", patientName="Patient 9").status_code == 404
+
+
+def test_preview_frames(fetch):
+    images = fetch("/fetch-clip", dicomName="big.dcm", preview="true").json()["images"]
+    assert len(images) == 5
+    mime, image = decode_src(images[0]["src"])
+    assert mime == "image/webp" and image.shape[:2] == (171, 256)
+    # Already small clips are not scaled up
+    assert decode_src(fetch("/fetch-clip", dicomName="a.dcm", preview="true").json()["images"][0]["src"])[1] \
+        .shape[:2] == (48, 64)
+
+    response = fetch("/clip-frame", dicomName="big.dcm", index=1, preview="true")
+    assert decode(response.content).shape[:2] == (171, 256)
+    response = fetch("/clip-frame", dicomName="big.dcm", index=1, preview="true", profile="lossless")
+    assert response.headers["content-type"] == "image/png"
+    assert decode(fetch("/clip-frame", dicomName="big.dcm", index=1).content).shape[:2] == (400, 600)
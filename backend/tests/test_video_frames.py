@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from conftest import scan, patient_name
+import media
+from frame_cache import frame_cache, video_cache, cache_key
+from media import (read_video_frames, render_clip, render_frame_range, frame_range_params, render_params,
+                   video_bitstream, VIDEO_PASSTHROUGH_PARAMS)
+from media_files import write_video_dicom, write_dicom, color_frames, gradient_frames
+
+
+@pytest.fixture
+def video(workdir):
+    path = workdir / "video.dcm"
+    return str(path), write_video_dicom(path, color_frames(10))
+
+
+def test_read_video_frames_seeks(video):
+    _, mp4 = video
+    everything, count = read_video_frames(mp4)
+    assert (len(everything), count) == (10, 10)
+    frames, count = read_video_frames(mp4, 3, 8, 2)
+    assert count == 10
+    assert [np.array_equal(a, b) for a, b in zip(frames, everything[3:8:2])] == [True] * 3
+    frames, count = read_video_frames(mp4, 7)
+    assert len(frames) == 3 and np.array_equal(frames[0], everything[7])
+    assert read_video_frames(mp4, 10) == ([], 10)
+
+
+def test_video_bitstream_is_shared_through_the_video_cache(video, monkeypatch):
+    path, mp4 = video
+    assert video_bitstream(path) == mp4
+    cached = video_cache.get_path(cache_key(path, VIDEO_PASSTHROUGH_PARAMS), ".mp4")
+    with open(cached, "rb") as f:
+        assert f.read() == mp4
+
+    def extract(ds):
+        raise AssertionError("extracted again")
+    monkeypatch.setattr(media, "extract_video_bitstream", extract)
+    assert video_bitstream(path) == mp4
+
+
+@pytest.mark.parametrize("clip", ["video", "plain"])
+def test_frame_range_matches_full_rendering(workdir, video, clip):
+    path = video[0] if clip == "video" else write_dicom(workdir / "plain.dcm", gradient_frames(10))
+    full = render_clip("dicom", path, clip)
+    part = render_frame_range("dicom", path, clip, start=2, end=9, stride=3)
+    assert part["frameCount"] == 10
+    assert [frame["data"] for frame in part["frames"]] == [frame["data"] for frame in full["frames"][2:9:3]]
+
+
+def test_frame_range_of_a_missing_file(workdir):
+    clip = render_frame_range("dicom", str(workdir / "gone.dcm"), "gone.dcm", start=1, end=2)
+    assert (clip["frames"], clip["frameCount"]) == ([], 0) and clip["error"]
+
+
+def test_partial_requests_decode_only_their_frames(client, archive):
+    (archive / "p3").mkdir()
+    path = str(archive / "p3" / "video.dcm")
+    write_video_dicom(path, color_frames(10))
+    patients = scan(client, archive)
+    params = {"username": "bob", "patientName": patient_name(patients, "p3"), "dicomName": "video.dcm"}
+
+    body = client.get("/fetch-clip", params={**params, "start": 4, "end": 6}).json()
+    assert (body["frameCount"], body["start"], body["end"], len(body["images"])) == (10, 4, 6, 2)
+    assert frame_cache.contains(cache_key(path, frame_range_params("dicom", None, None, 4, 6, 1)))
+    assert not frame_cache.contains(cache_key(path, render_params("dicom")))
+
+    response = client.get("/clip-frame", params={**params, "index": 9})
+    assert response.status_code == 200
+    assert client.get("/clip-frame", params={**params, "index": 10}).status_code == 404
+
+    # With the whole clip rendered, ranges are served from it
+    whole = client.get("/fetch-clip", params=params).json()
+    assert whole["frameCount"] == 10
+    assert client.get("/fetch-clip", params={**params, "start": 4, "end": 6}).json()["images"] == \
+        whole["images"][4:6]
@@ -0,0 +1,54 @@
+import asyncio
+import inspect
+import threading
+import time
+
+from workers import offload, run_blocking, endpoint_limit
+
+
+def test_endpoint_limit(monkeypatch):
+    assert endpoint_limit("fetch-clip") == 4
+    monkeypatch.setenv("ECHO_LIMIT_FETCH_CLIP", "1")
+    assert endpoint_limit("fetch-clip") == 1
+
+
+def test_run_blocking_respects_the_limit(monkeypatch):
+    monkeypatch.setenv("ECHO_LIMIT_TEST_RUN_BLOCKING", "2")
+    lock = threading.Lock()
+    running, peak, threads = [0], [0], set()
+
+    def work(i):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            threads.add(threading.current_thread().name)
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return i * 2
+
+    async def main():
+        return await asyncio.gather(*(run_blocking("io", "test-run-blocking", work, i) for i in range(6)))
+
+    assert asyncio.run(main()) == [0, 2, 4, 6, 8, 10]
+    assert peak[0] == 2
+    assert all(name.startswith("io") for name in threads)
+
+
+def test_offload_keeps_the_signature():
+    def endpoint(username: str, count: int = 3):
+        return threading.current_thread().name, username, count
+
+    wrapped = offload("io", "test-offload")(endpoint)
+    assert inspect.signature(wrapped) == inspect.signature(endpoint)
+    assert inspect.iscoroutinefunction(wrapped)
+    name, username, count = asyncio.run(wrapped("bob", count=5))
+    assert name.startswith("io") and (username, count) == ("bob", 5)
+
+
+def test_endpoint_parameters_may_share_run_blocking_names():
+    def endpoint(pool: str, limit: int, fn: str = "x"):
+        return pool, limit, fn
+
+    wrapped = offload("io", "test-offload-names")(endpoint)
+    assert asyncio.run(wrapped(pool="p", limit=3, fn="f")) == ("p", 3, "f")
@@ -0,0 +1,119 @@
+"""
+Worker pools for the blocking parts of the API.
+
+Every endpoint in main.py is served by the asyncio event loop, but most of
+them do blocking work (pydicom reads, OpenCV decodes, CSV rewrites). That work
+runs on bounded thread pools instead:
+
+  * "media" - decoding / encoding clips (CPU and disk heavy)
+  * "io"    - label saves, CSV reads, accounts (short, latency sensitive)
+
+Keeping them apart means a burst of decodes can't delay a label save. On top
+of the pools, each endpoint has its own concurrency limit, so one slow
+endpoint can't take every worker of its pool.
+
+The actual clip decoding is fanned out further to a process pool (see
+decode_pool), so the clips of one patient decode on all CPU cores.
+"""
+import os
+import asyncio
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# ----- Configuration -----
+MEDIA_WORKERS = int(os.environ.get("ECHO_MEDIA_WORKERS", "0")) or min(8, os.cpu_count() or 4)
+IO_WORKERS = int(os.environ.get("ECHO_IO_WORKERS", "8"))
+# Clip decoding: "process" decodes on all cores, "thread" keeps it in-process
+DECODE_WORKERS = int(os.environ.get("ECHO_DECODE_WORKERS", "0")) or (os.cpu_count() or 4)
+DECODE_EXECUTOR = os.environ.get("ECHO_DECODE_EXECUTOR", "process")
+
+# Max requests of each endpoint doing blocking work at once. Override with
+# ECHO_LIMIT_<NAME>, e.g. ECHO_LIMIT_FETCH_PATIENT_DICOMS=1
+DEFAULT_ENDPOINT_LIMITS = {
+    "fetch-patient-dicoms": 2,
+    "patient-thumbnails": 2,
+    "fetch-clip": 4,
+    "clip-frame": 8,
+    "fetch-clip-binary": 4,
+    "fetch-clip-video": 2,
+    "fetch-csv": 4,
+    "update-csv": 8,
+    "reset-csv": 1,
+    "accounts": 4,
+    "login": 4,
+}
+
+pools = {
+    "media": ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media"),
+    "io": ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io"),
+}
+
+_semaphores = {}
+
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+
+def decode_pool():
+    """
+    The shared pool clips are decoded on, created on first use. Worker
+    processes are spawned rather than forked, since the server process is
+    multi-threaded by the time the pool starts.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            if DECODE_EXECUTOR == "thread":
+                _decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+            else:
+                _decode_pool = ProcessPoolExecutor(max_workers=DECODE_WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+        return _decode_pool
+
+
+def reset_decode_pool():
+    """Drop a broken decode pool (e.g. after a worker crashed) so the next call starts a new one"""
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is not None:
+            _decode_pool.shutdown(wait=False, cancel_futures=True)
+        _decode_pool = None
+
+
+def endpoint_limit(name: str) -> int:
+    env_name = "ECHO_LIMIT_" + name.upper().replace("-", "_")
+    return int(os.environ.get(env_name, DEFAULT_ENDPOINT_LIMITS.get(name, 4)))
+
+
+def _semaphore(name: str) -> asyncio.Semaphore:
+    # Created lazily so they belong to the running event loop
+    if name not in _semaphores:
+        _semaphores[name] = asyncio.Semaphore(endpoint_limit(name))
+    return _semaphores[name]
+
+
+async def run_blocking(pool: str, limit: str, fn, /, *args, **kwargs):
+    """Run a blocking function on one of the pools, within the given endpoint's concurrency limit"""
+    async with _semaphore(limit):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pools[pool], functools.partial(fn, *args, **kwargs))
+
+
+def offload(pool: str, limit: str):
+    """
+    Decorator turning a blocking endpoint function into an async one that runs
+    on a worker pool. The signature is preserved, so FastAPI still sees the
+    original parameters:
+
+        @app.post("/update-csv")
+        @offload("io", "update-csv")
+        def update_csv(update_request: UpdateRequest): ...
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await run_blocking(pool, limit, fn, *args, **kwargs)
+        return wrapper
+    return decorator